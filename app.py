@@ -1,51 +1,404 @@
 import os
 import re
+import hashlib
+import json
+import sys
 import time
 import uuid
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+import tempfile
+import zipfile
 import numpy as np
-from flask import Flask, render_template, send_from_directory
+from flask import Flask, Response, render_template, request, send_from_directory
 from flask_socketio import SocketIO, emit
-import ollama
-import csv
-import math
+from llm_backend import OllamaBackend, ScriptedBackend
+from context_window import ContextWindow, RollingSummarizer, message_tokens
+from emotion_preclassifier import EmotionPreclassifier
+from message_queue import create_client_manager
+from metrics import TurnMetrics
+from persistence import BatchedCsvWriter
+from response_cache import ResponseCache
+from session_store import MemorySessionStore, RedisSessionStore, SqliteSessionStore
+from sqlite_store import BatchedSqliteWriter, SqliteReader
 
 # --- 定数 ---
+# LLMバックエンド ("ollama" または、負荷試験用に録音済み応答を再生する "scripted")
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "ollama")
 # LLMモデル
 LLM_MODEL = "qwen3:8b"
+# scripted バックエンドの応答元と再生速度
+SCRIPTED_RESPONSES_PATH = 'conversation_data.csv'
+SCRIPTED_TIME_TO_FIRST_TOKEN = 0.5   # 秒
+SCRIPTED_TOKEN_RATE = 30.0           # トークン/秒
 # CSVファイルパス
 CSV_FILE_PATH = 'emotion_data.csv'
 CONVERSATION_CSV_PATH = 'conversation_data.csv'
 # CSVヘッダー
 CSV_HEADERS = ['subject_id', 'timestamp', 'emotion_label', 'animationDuration', 'eyeOpenness', 'pupilSize', 'pupilAngle', 'upperEyelidAngle', 'upperEyelidCoverage', 'lowerEyelidCoverage', 'mouthCurve', 'mouthHeight', 'mouthWidth']
 CONVERSATION_CSV_HEADERS = ['session_id', 'timestamp', 'user_message', 'bot_response', 'emotion_v', 'emotion_a', 'emotion_label']
+# True のとき、各ターンの会話を保存する
+SAVE_CONVERSATION_LOG = False
+# 保存先 ("csv" または、WALモードの SQLite に保存する "sqlite")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "csv")
+SQLITE_DB_PATH = 'chat_data.db'
+# 書き込みは件数か経過秒数のどちらかでまとめて行う
+CSV_WRITE_BATCH_SIZE = 100
+CSV_FLUSH_INTERVAL = 1.0
+
+
+# プロンプトキャッシュ活用モード: system指示を毎ターン同じバイト列の先頭に固定し、
+# 前回の感情に関する制約は後ろのメッセージに回す。モデルは keep_alive で常駐させ、起動時に温めておく
+PROMPT_PREFIX_CACHE = False
+LLM_KEEP_ALIVE = "60m"
+
+# ターンごとの処理時間を1行1ターンのJSONLで書き出すファイル (None なら書き出さない)
+METRICS_TRACE_PATH = None
+
+# 複数ワーカー構成で使う Socket.IO のメッセージキュー (None なら1プロセス構成)。
+# "local://127.0.0.1:6100" は message_queue.py の簡易ブローカー、"redis://..." などは本番用
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+SOCKETIO_CHANNEL = "emotion-chat"
+
+# 手動更新 (manual_update_expression) の1クライアントあたりの最大更新回数/秒。
+# 間隔内に届いた値は最新のものだけを残し、途中の値は捨てる
+MANUAL_UPDATE_MAX_RATE = 30.0
+
+# 生成中に同じセッションから新しい発話が届いたら (または切断されたら) 生成を中断する。
+# 新しいターンは、中断したターンが途中までの返答を履歴に書き終わるまで待つ (この秒数ごとに警告を出す)
+CANCEL_WAIT_WARNING_INTERVAL = 2.0
+
+# True のとき、LLMの感情を待たずにユーザー発話から仮の感情を推定して先に表情を送る
+# (emotion_preclassifier.py, 会話ログで学習)。LLMの感情が届いたらそちらで置き換える
+PROVISIONAL_EXPRESSION = False
+
+# 応答キャッシュ: 直近の発話 (正規化したもの) と前回の感情の区画が同じターンは、LLMを呼ばずに
+# 前回の応答を RESPONSE_CACHE_REPLAY_RATE トークン/秒で再生する (キャッシュはワーカープロセスごと)
+RESPONSE_CACHE_ENABLED = False
+RESPONSE_CACHE_MAX_BYTES = 4 * 1024 * 1024   # 保持する返答文の合計バイト数の上限
+RESPONSE_CACHE_TTL = 60 * 60                 # 秒
+RESPONSE_CACHE_CONTEXT_MESSAGES = 1          # キーに含める直近の発話の数 (1 なら今回のユーザー発話だけ)
+RESPONSE_CACHE_EMOTION_BUCKET = 0.5          # 前回の感情 (v, a) を区切る幅
+RESPONSE_CACHE_REPLAY_RATE = 30.0            # トークン/秒
+
+
+# --- ログ設定 ---
+# 既定の INFO では1ターン1行だけを出力する。DEBUG にすると受信データ・履歴・重み表なども出力する
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+logger = logging.getLogger("emotion_chat")
+
+
+def setup_logging(level=LOG_LEVEL):
+    """ログをキュー経由で出力する (書き込みはリスナースレッドが行い、Socket.IOのワーカーではI/Oしない)"""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(level)
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 
 
 # --- FlaskとSocket.IOの初期化 ---
 # 静的ファイルとテンプレートフォルダをルートディレクトリに設定
 app = Flask(__name__, static_folder='static', template_folder='.')
 app.config["SECRET_KEY"] = "C0HThSwr"
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-# セッション管理用の辞書
-session_store = {}
-
-# --- Ollamaの初期化 ---
-client = ollama.Client()
-
-# --- 時間計測用表示関数 ---
-def print_timing_table(total_time, llm_time, param_time):
-    """処理時間を表形式で出力する"""
-    print("\n" + "="*50)
-    print("           処理時間計測結果")
-    print("="*50)
-    print(f"{'項目':<20} | {'時間(秒)':<10} | {'割合(%)':<8}")
-    print("-"*50)
-    print(f"{'全体処理時間':<20} | {total_time:<10.4f} | {'100.0':<8}")
-    print(f"{'LLM応答生成':<20} | {llm_time:<10.4f} | {(llm_time/total_time*100 if total_time > 0 else 0):<8.1f}")
-    print(f"{'パラメータ計算':<20} | {param_time:<10.4f} | {(param_time/total_time*100 if total_time > 0 else 0):<8.1f}")
-    other_time = total_time - llm_time - param_time
-    print(f"{'その他処理':<20} | {other_time:<10.4f} | {(other_time/total_time*100 if total_time > 0 else 0):<8.1f}")
-    print("="*50 + "\n")
+# 複数ワーカー構成で、他のワーカーに接続しているクライアントへの送信を中継するメッセージキュー
+socketio_options = {}
+if SOCKETIO_MESSAGE_QUEUE:
+    socketio_options["client_manager"] = create_client_manager(SOCKETIO_MESSAGE_QUEUE, SOCKETIO_CHANNEL)
+socketio = SocketIO(app, cors_allowed_origins="*", **socketio_options)
+
+# --- セッション管理 ---
+# 会話履歴はサーバー側でセッションIDごとに保持し、クライアントは新しい発話だけを送る
+SESSION_MAX_MESSAGES = 40          # 1セッションで保持する履歴 (user/assistant) の上限
+SESSION_IDLE_TIMEOUT = 30 * 60     # この秒数アクセスがないセッションは破棄する
+SESSION_MAX_COUNT = 1000           # 保持するセッション数の上限 (超えたら最も古く使われたものから破棄)
+
+# セッションの保存先 ("memory": プロセス内、"sqlite": 同じマシンのワーカー間で共有、"redis://...": 複数マシンで共有)
+SESSION_STORE = os.environ.get("SESSION_STORE", "memory")
+SESSION_DB_PATH = 'sessions.db'
+
+# コンテキスト管理: True のとき、LLMに送るプロンプト全体 (system 指示・前回の感情の制約・要約・履歴) を
+# CONTEXT_TOKEN_BUDGET トークン (見積もり) に収め、予算を超えた古いターンはターンの合間にバックグラウンドで
+# 要約に畳み込む (context_window.py)。古い発話は要約に畳んでから消すので、SESSION_MAX_MESSAGES では捨てない
+CONTEXT_MANAGEMENT = False
+CONTEXT_TOKEN_BUDGET = 2200
+CONTEXT_FOLD_TARGET = 0.5          # 畳むときは履歴を予算のこの割合まで減らす
+CONTEXT_MIN_RECENT_MESSAGES = 4    # 予算にかかわらずそのまま送る直近の発話の数
+CONTEXT_SUMMARY_MAX_CHARS = 400    # 要約の最大文字数
+CONTEXT_SUMMARY_MAX_TOKENS = 300   # 要約を生成するときの num_predict
+
+
+def create_session_store(spec=None):
+    """設定に応じたセッションの保存先を作る"""
+    spec = spec or SESSION_STORE
+    if spec == "memory":
+        return MemorySessionStore(SESSION_IDLE_TIMEOUT, SESSION_MAX_COUNT)
+    if spec == "sqlite":
+        return SqliteSessionStore(SESSION_DB_PATH, SESSION_IDLE_TIMEOUT, SESSION_MAX_COUNT)
+    if spec.startswith(("redis://", "rediss://")):
+        return RedisSessionStore(spec, SESSION_IDLE_TIMEOUT)
+    raise ValueError(f"未知のセッションの保存先です: {spec}")
+
+
+session_store = create_session_store()
+
+
+def expire_sessions(now=None):
+    """アイドル時間を過ぎたセッションと、上限を超えた古いセッションを破棄する"""
+    session_store.expire(now)
+
+
+def update_session(session_id, mutate):
+    """セッション (なければ新規作成) に mutate(session) を適用して保存し、保存後のコピーを返す"""
+    def create():
+        # 保存済みの会話があれば履歴を復元する
+        messages, last_emotion = load_stored_session(session_id)
+        return {"messages": messages, "last_emotion": last_emotion}
+
+    session = session_store.update(session_id, mutate, create)
+    session["id"] = session_id
+    expire_sessions()
+    return session
+
+
+def load_stored_session(session_id):
+    """保存先から (履歴, 前回の感情) を復元する。SQLite に保存していない場合は空"""
+    if session_reader is None:
+        return [], None
+    try:
+        rows = session_reader.session_history(session_id, SESSION_MAX_MESSAGES // 2)
+    except Exception as e:
+        logger.warning("セッション履歴の読み出しに失敗しました: %s", e)
+        return [], None
+    messages = []
+    for row in rows:
+        messages.append({"role": "user", "content": row["user_message"]})
+        if row["bot_response"]:
+            messages.append({"role": "assistant", "content": row["bot_response"]})
+    trim_history(messages)
+    last = rows[-1] if rows else None
+    last_emotion = None
+    if last and last["emotion_v"] is not None and last["emotion_a"] is not None:
+        last_emotion = {"v": last["emotion_v"], "a": last["emotion_a"], "label": last["emotion_label"]}
+    return messages, last_emotion
+
+
+def append_session_message(session, role, content, interrupted=False):
+    """セッション履歴にメッセージを追加し、上限を超えた古い発話を捨てる"""
+    messages = session["messages"]
+    message = {"role": role, "content": content}
+    if interrupted:
+        message["interrupted"] = True  # 生成を途中で打ち切った返答
+    messages.append(message)
+    trim_history(messages)
+
+
+def trim_history(messages):
+    """上限を超えた古い発話を捨てる (履歴は必ず user の発話から始める)
+
+    コンテキスト管理が有効なときは、古い発話は要約に畳み込んでから消す (fold_session_history) ので、
+    まだ要約されていない発話を上限で捨てることはしない。
+    """
+    limit = SESSION_MAX_MESSAGES if context_window is None else None
+    while (limit is not None and len(messages) > limit) or (messages and messages[0]["role"] != "user"):
+        messages.pop(0)
+
+
+def start_session_turn(data):
+    """受信データをセッション履歴に反映し、(session_id, session) を返す"""
+    session_id = data.get("session_id") or str(uuid.uuid4())
+
+    def apply(session):
+        if "messages" in data:
+            # 旧クライアント互換: 全履歴が送られてきた場合はそれで置き換える
+            session["messages"] = [m for m in data["messages"] if m["role"] != "system"]
+            trim_history(session["messages"])
+        else:
+            append_session_message(session, "user", data["message"])
+        if data.get("last_emotion") is not None:
+            session["last_emotion"] = data["last_emotion"]
+
+    return session_id, update_session(session_id, apply)
+
+
+def finish_session_turn(session, turn):
+    """ボットの応答と今回の感情をセッションに記録する"""
+    reply = turn.full_text.strip()
+    emotion = turn.current_emotion()
+
+    def apply(stored):
+        if turn.interrupted:
+            # 途中までの返答 (空でも) を中断済みとして残し、user / assistant の交互を保つ
+            append_session_message(stored, "assistant", reply, interrupted=True)
+        elif reply:
+            append_session_message(stored, "assistant", reply)
+        if emotion is not None:
+            stored["last_emotion"] = emotion
+
+    update_session(session["id"], apply)
+    if history_summarizer is not None:
+        history_summarizer.schedule(session["id"])
+
+# --- LLMバックエンドの初期化 ---
+def create_llm_backend(name=None):
+    """設定に応じたLLMバックエンドを作る"""
+    name = name or LLM_BACKEND
+    if name == "ollama":
+        return OllamaBackend(LLM_MODEL)
+    if name == "scripted":
+        return ScriptedBackend.from_conversation_csv(
+            SCRIPTED_RESPONSES_PATH,
+            time_to_first_token=SCRIPTED_TIME_TO_FIRST_TOKEN,
+            token_rate=SCRIPTED_TOKEN_RATE,
+        )
+    raise ValueError(f"未知のLLMバックエンドです: {name}")
+
+
+llm_backend = create_llm_backend()
+
+# --- 応答キャッシュ ---
+response_cache = None
+if RESPONSE_CACHE_ENABLED:
+    response_cache = ResponseCache(
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        ttl=RESPONSE_CACHE_TTL,
+        context_messages=RESPONSE_CACHE_CONTEXT_MESSAGES,
+        bucket_size=RESPONSE_CACHE_EMOTION_BUCKET,
+        replay_rate=RESPONSE_CACHE_REPLAY_RATE,
+    )
+
+
+def lookup_cached_response(session):
+    """応答キャッシュを引き、(キー, キャッシュされた応答 or None) を返す
+
+    キャッシュが無効か、発話がキャッシュの対象にならない (正規化すると空になる) ときはキーも None。
+    """
+    if response_cache is None:
+        return None, None
+    key = response_cache.key(session["messages"], session["last_emotion"])
+    if key is None:
+        return None, None
+    return key, response_cache.get(key)
+
+
+def store_cached_response(key, turn):
+    """LLMが生成した応答をキャッシュに入れる (感情タグが取れなかった応答は入れない)"""
+    emotion = turn.current_emotion()
+    reply = turn.full_text.strip()
+    if key is not None and emotion is not None and reply and not turn.parser.fallback_reason and not turn.interrupted:
+        response_cache.put(key, emotion, reply)
+
+# --- 履歴の要約 (コンテキスト管理) ---
+SUMMARY_INSTRUCTION = """You maintain a running summary of a conversation between a user and you, an empathetic robot friend.
+Merge the current summary and the new conversation into one updated summary written in Japanese.
+Keep facts about the user, ongoing topics, promises, and how your feelings changed. Drop greetings and small talk.
+Output only the summary text (no tags, no headings), at most {max_chars} characters."""
+# LLMに送るときに要約の前に置く見出し
+SUMMARY_HEADER = "# SUMMARY OF EARLIER CONVERSATION\n"
+SUMMARY_STRIP_PATTERN = re.compile(r'<\s*(thought|think)\s*>.*?</\s*\1\s*>|<emotion[^>]*>.*?</emotion>',
+                                   re.IGNORECASE | re.DOTALL)
+
+context_window = None
+history_summarizer = None
+
+
+def summarize_history(summary, messages):
+    """これまでの要約と古い発話から新しい要約を作る (LLMが使えなければ発話の冒頭をつなげる)"""
+    transcript = "\n".join(f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}" for m in messages)
+    prompt = [
+        {"role": "system", "content": SUMMARY_INSTRUCTION.format(max_chars=CONTEXT_SUMMARY_MAX_CHARS)},
+        {"role": "user", "content": f"# Current summary\n{summary or '(none)'}\n\n# New conversation\n{transcript}"},
+    ]
+    try:
+        text = llm_backend.complete(prompt, options={"num_predict": CONTEXT_SUMMARY_MAX_TOKENS}, **llm_chat_kwargs())
+        text = SUMMARY_STRIP_PATTERN.sub("", text).strip()
+    except Exception as e:
+        logger.warning("LLMでの要約に失敗しました: %s", e)
+        text = ""
+    if not text:
+        text = " / ".join(filter(None, [summary] + [m["content"][:40] for m in messages if m["role"] == "user"]))
+    # 上限を超えたら古い側 (先頭) を捨てる
+    return text[-CONTEXT_SUMMARY_MAX_CHARS:]
+
+
+def prompt_reserved_tokens(session):
+    """プロンプトのうち履歴と要約の本文以外 (system 指示・前回の感情の制約・要約の見出し) のトークン数"""
+    reserved = message_tokens({"content": SYSTEM_INSTRUCTION}) + message_tokens({"content": SUMMARY_HEADER})
+    if session["messages"] and session["last_emotion"] is not None:
+        reserved += message_tokens({"content": previous_emotion_instruction(session["last_emotion"])})
+    return reserved
+
+
+def fold_session_history(session_id):
+    """予算を超えたセッションの古いターンを要約に畳み込む (RollingSummarizer のスレッドで実行)"""
+    session = session_store.get(session_id)
+    if session is None:
+        return
+    count = context_window.fold_count(session["messages"], session["summary"], prompt_reserved_tokens(session))
+    if not count:
+        return
+    folded = session["messages"][:count]
+    start_time = time.time()
+    summary = summarize_history(session["summary"], folded)
+
+    def apply(stored):
+        # 要約している間に履歴の先頭が変わっていたら (他のワーカーが先に畳んだなど) 何もしない
+        if stored["messages"][:count] == folded and stored.get("summary", "") == session["summary"]:
+            stored["summary"] = summary
+            del stored["messages"][:count]
+
+    # 要約している間にセッションが破棄されていたら、作り直さない
+    if session_store.update(session_id, apply, create=False) is None:
+        logger.debug("要約中にセッションが破棄されました: session=%s", session_id)
+        return
+    logger.debug("履歴を要約しました: session=%s 発話%d件 %.2f秒", session_id, count, time.time() - start_time)
+
+
+if CONTEXT_MANAGEMENT:
+    context_window = ContextWindow(CONTEXT_TOKEN_BUDGET, CONTEXT_FOLD_TARGET, CONTEXT_MIN_RECENT_MESSAGES)
+    history_summarizer = RollingSummarizer(fold_session_history)
+
+# --- 仮の感情の推定 ---
+emotion_preclassifier = None
+if PROVISIONAL_EXPRESSION:
+    try:
+        emotion_preclassifier = EmotionPreclassifier.from_conversation_csv(CONVERSATION_CSV_PATH)
+    except OSError as e:
+        logger.warning("仮の感情の推定に使う会話ログを読めません: %s", e)
+
+# --- データの書き込み (バックグラウンドスレッドでまとめて書き込む) ---
+def create_data_writer(name=None):
+    """設定に応じた書き込み先を作る。(writer, {"emotion": 書き込み先, "conversation": 書き込み先}) を返す"""
+    name = name or STORAGE_BACKEND
+    options = {"batch_size": CSV_WRITE_BATCH_SIZE, "flush_interval": CSV_FLUSH_INTERVAL}
+    if name == "csv":
+        return BatchedCsvWriter(**options), {"emotion": CSV_FILE_PATH, "conversation": CONVERSATION_CSV_PATH}
+    if name == "sqlite":
+        return BatchedSqliteWriter(SQLITE_DB_PATH, **options), {"emotion": "emotion_data", "conversation": "conversations"}
+    raise ValueError(f"未知の保存先です: {name}")
+
+
+data_writer, data_targets = create_data_writer()
+atexit.register(data_writer.close)
+# SQLite に保存している場合は、新しく作るセッションの履歴をそこから復元する
+session_reader = SqliteReader(SQLITE_DB_PATH) if STORAGE_BACKEND == "sqlite" else None
+
+# --- 処理時間の計測 ---
+turn_metrics = TurnMetrics(METRICS_TRACE_PATH)
+atexit.register(turn_metrics.close)
+if response_cache is not None:
+    turn_metrics.add_source(response_cache.prometheus_lines)
 
 # --- 表情計算ロジック ---
 
@@ -124,189 +477,321 @@ KEYFRAME_VA = {
  
         
         
+# --- 表情計算エンジン (ベクトル化) ---
+# 起動時に一度だけキーフレームを行列へ積み上げ、以降は配列演算のみで補間する
+EMOTION_NAMES = list(KEYFRAME_VA.keys())
+PARAM_NAMES = [
+    "eyeOpenness", "pupilSize", "pupilAngle", "upperEyelidAngle",
+    "upperEyelidCoverage", "lowerEyelidCoverage", "mouthCurve",
+    "mouthHeight", "mouthWidth"
+]
+EYE_OPENNESS_INDEX = PARAM_NAMES.index("eyeOpenness")
+UPPER_EYELID_COVERAGE_INDEX = PARAM_NAMES.index("upperEyelidCoverage")
+
+KEYFRAME_VA_MATRIX = np.stack([KEYFRAME_VA[name] for name in EMOTION_NAMES]).astype(float)          # (6, 2)
+KEYFRAME_PARAMS_MATRIX = np.stack([KEYFRAME_PARAMS[name] for name in EMOTION_NAMES]).astype(float)  # (6, 9)
+
+# ソフトマックスの温度パラメータ
+SOFTMAX_TEMPERATURE = 1.0
+
+# eyeOpenness のファジー制御: 「開く」グループは +1, 「細める」グループは -1
+EYE_WIDE_EMOTIONS = ("happy", "angry", "sad", "astonished")
+EYE_OPENNESS_SIGNS = np.array([1.0 if name in EYE_WIDE_EMOTIONS else -1.0 for name in EMOTION_NAMES])
+EYE_OPENNESS_GAIN = 20.0
+MIN_OPENNESS = 0.2
+MAX_OPENNESS = 1.0
+
+# upperEyelidCoverage のゲート: 「被る」グループは +1, 「被らない」グループは -1
+EYELID_COVER_EMOTIONS = ("angry", "sad")
+EYELID_COVER_SIGNS = np.array([1.0 if name in EYELID_COVER_EMOTIONS else -1.0 for name in EMOTION_NAMES])
+EYELID_COVER_GAIN = 20.0
+
+# 重み・パラメータの表は、このロガーが DEBUG のときだけ組み立てて出力する
+expression_logger = logging.getLogger("emotion_chat.expression")
+
+
+def format_expression_debug(target_v, target_a, distances, rtop_values, softmax_weights, base_params, sigmoid_gate, final_params):
+    """表情計算の途中経過を表形式の文字列にする (DEBUG ログ用)"""
+    lines = [f"=== V={target_v}, A={target_a} の重み分析 ===",
+             f"{'感情':<10} | {'距離':<8} | {'rtop_k':<11} | {'r_k (softmax)':<15}",
+             "-" * 65]
+    for name, distance, rtop_k, r_k in zip(EMOTION_NAMES, distances, rtop_values, softmax_weights):
+        lines.append(f"{name:<12} | {distance:<10.4f} | {rtop_k:<15.6f} | {r_k:<15.6f}")
+    lines.append("=" * 65)
+
+    lines.append(f"--- ベース補間結果 (ファジー適用前) ---")
+    lines.append(f"Base eyeOpenness: {base_params[EYE_OPENNESS_INDEX]:.4f}")
+    lines.append(f"Base upperEyelidCoverage: {base_params[UPPER_EYELID_COVERAGE_INDEX]:.4f}")
+    lines.append(f"Sigmoid出力 (ゲート): {sigmoid_gate:.4f}")
+    lines.append("-" * 35)
+
+    lines.append(f"--- 補間結果 (ファジー適用後): V={target_v}, A={target_a} ---")
+    lines.append(f"{'Parameter':<20} | {'Value':<12}")
+    lines.append("-" * 35)
+    for i, (name, value) in enumerate(zip(PARAM_NAMES, final_params)):
+        if i == EYE_OPENNESS_INDEX:
+            lines.append(f"{name:<20} | {value:<12.4f}  <-- ファジー制御 (EyeOpen)")
+        elif i == UPPER_EYELID_COVERAGE_INDEX:
+            lines.append(f"{name:<20} | {value:<12.4f}  <-- ファジー制御 (EyelidCov)")
+        else:
+            lines.append(f"{name:<20} | {value:<12.4f}")
+    lines.append("=" * 35)
+    return "\n".join(lines)
+
+
+# バッチ計算時に一度に処理する行数 (中間配列をキャッシュに収めるため)
+EXPRESSION_BATCH_CHUNK = 8192
+
+
+def _compute_expression_batch(va_points):
+    """(N, 2) のVA座標から中間値を含む表情計算結果をまとめて求める"""
+    v = va_points[:, 0:1]
+    a = va_points[:, 1:2]
+
+    # ===== 距離と生の重み rtop_k = 1 / (d + ε) =====
+    dv = v - KEYFRAME_VA_MATRIX[:, 0]
+    da = a - KEYFRAME_VA_MATRIX[:, 1]
+    distances = np.sqrt(dv * dv + da * da)                      # (N, 6)
+    rtop_values = 1.0 / (distances + EPSILON)
+
+    # ===== ソフトマックス正規化 (安定化 & 温度スケーリング) =====
+    exp_rtop = np.exp((rtop_values - rtop_values.max(axis=1, keepdims=True)) / SOFTMAX_TEMPERATURE)
+    softmax_weights = exp_rtop / exp_rtop.sum(axis=1, keepdims=True)
+
+    # ===== 1. 重み付き平均 (ベース計算) =====
+    base_params = softmax_weights @ KEYFRAME_PARAMS_MATRIX      # (N, 9)
+    final_params = base_params.copy()
+
+    # ===== 2a. eyeOpenness のファジー上書き =====
+    eye_score = softmax_weights @ EYE_OPENNESS_SIGNS
+    sigmoid_eye = 1.0 / (1.0 + np.exp(-EYE_OPENNESS_GAIN * eye_score))
+    final_params[:, EYE_OPENNESS_INDEX] = MIN_OPENNESS + (MAX_OPENNESS - MIN_OPENNESS) * sigmoid_eye
+
+    # ===== 2b. upperEyelidCoverage のゲート (ゲート * Base値) =====
+    cover_score = softmax_weights @ EYELID_COVER_SIGNS
+    sigmoid_gate = 1.0 / (1.0 + np.exp(-EYELID_COVER_GAIN * cover_score))
+    final_params[:, UPPER_EYELID_COVERAGE_INDEX] = sigmoid_gate * base_params[:, UPPER_EYELID_COVERAGE_INDEX]
+
+    return distances, rtop_values, softmax_weights, base_params, sigmoid_gate, final_params
+
+
+def get_interpolated_expressions(va_points):
+    """複数のVA座標 (N, 2) を一括で表情パラメータ (N, 9) と感情の重み (N, 6) に変換する
+
+    get_interpolated_expression と同じソフトマックス・ファジー制御を適用する。
+    重みの列順は EMOTION_NAMES、パラメータの列順は PARAM_NAMES に従う。
+    """
+    va_points = np.asarray(va_points, dtype=float).reshape(-1, 2)
+    n = len(va_points)
+    params = np.empty((n, len(PARAM_NAMES)))
+    weights = np.empty((n, len(EMOTION_NAMES)))
+    for start in range(0, n, EXPRESSION_BATCH_CHUNK):
+        end = start + EXPRESSION_BATCH_CHUNK
+        _, _, chunk_weights, _, _, chunk_params = _compute_expression_batch(va_points[start:end])
+        params[start:end] = chunk_params
+        weights[start:end] = chunk_weights
+    return params, weights
+
+
 def get_interpolated_expression(target_v, target_a):
     """ターゲットのVA座標に基づき、表情パラメータを補間する"""
-    target_va = np.array([target_v, target_a])
+    target_va = np.array([[target_v, target_a]], dtype=float)
+    distances, rtop_values, softmax_weights, base_params, sigmoid_gate, final_params = _compute_expression_batch(target_va)
 
-    rtop_values = []  # 各emotionの生の重み
-    params_list = []
-    emotion_names = []
-    
+    if expression_logger.isEnabledFor(logging.DEBUG):
+        expression_logger.debug(format_expression_debug(
+            target_v, target_a, distances[0], rtop_values[0], softmax_weights[0], base_params[0], sigmoid_gate[0], final_params[0]))
+    return final_params[0]
 
-    for emotion_name, key_va in KEYFRAME_VA.items():
-        distance = np.linalg.norm(target_va - key_va)
-        # rtop_k = 1 / ((distance)^W + ε)
-        rtop_k = 1.0 / (((distance)) + EPSILON)
-        #rtop_k = np.exp(- (distance ** 2))  # 距離が大きいほど小さくなるように指数関数で変換
-        rtop_values.append(rtop_k)
-        params_list.append(KEYFRAME_PARAMS[emotion_name])
-        emotion_names.append(emotion_name)
-
-    # ===== ソフトマックス正規化 =====
-    rtop_values = np.array(rtop_values)
-    # exp_rtop = np.exp(rtop_values - np.max(rtop_values))  # 安定化
-    # softmax_weights = exp_rtop / np.sum(exp_rtop)
-    T = 1  # 温度パラメータ
-    # 安定化 & 温度スケーリング
-    exp_rtop = np.exp((rtop_values - np.max(rtop_values)) / T)
-    softmax_weights = exp_rtop / np.sum(exp_rtop)
-
-
-    print(f"\n=== V={target_v}, A={target_a} の重み分析 ===")
-    print(f"{'感情':<10} | {'距離':<8} | {'rtop_k':<11} | {'r_k (softmax)':<15}")
-    print("-" * 65)
-    for i, emotion_name in enumerate(emotion_names):
-        distance = np.linalg.norm(target_va - KEYFRAME_VA[emotion_name])
-        print(f"{emotion_name:<12} | {distance:<10.4f} | {rtop_values[i]:<15.6f} | {softmax_weights[i]:<15.6f}")
-    print("=" * 65 + "\n")
-    
-    # ========================
-    #     r_k の表示部分
-    # ========================
-    print("\n=== r_k values (emotion weights, normalized) ===")
-    for name, rk in zip(emotion_names, softmax_weights):   # ← rk_values は不要
-        print(f"{name}: {rk}")   # 桁数多めで表示
-    print("===============================================\n")
-    
-    # # ===== 重み付き平均 =====
-    # final_params = np.zeros(9)
-    # for w, p in zip(softmax_weights, params_list):
-    #     final_params += w * p
-
-    # ===== 1. 従来の重み付き平均 (ベース計算) =====
-    # まず、全9パラメータを従来の加重平均で計算する
-    final_params = np.zeros(9)
-    for w, p in zip(softmax_weights, params_list):
-        final_params += w * p
-
-    # ベースとなる値（ファジー適用前）を保持
-    base_eyeOpenness = final_params[0]
-    base_upperEyelidCoverage = final_params[4]
-
-    print(f"--- ベース補間結果 (ファジー適用前) ---")
-    print(f"Base eyeOpenness: {base_eyeOpenness:.4f}")
-    print(f"Base upperEyelidCoverage: {base_upperEyelidCoverage:.4f}")
-    print("-" * 35)
-
-
-    # ===== 2. ファジー制御による上書き =====
-
-    # 感情名と重みの辞書を作成 (後の計算用)
-    weights_dict = {name: weight for name, weight in zip(emotion_names, softmax_weights)}
-
-    # --- 2a. eyeOpenness (インデックス0) の上書き ---
-    Wide_Score = weights_dict.get("happy", 0) + weights_dict.get("angry", 0) + \
-                 weights_dict.get("sad", 0) + weights_dict.get("astonished", 0)
-    Narrow_Score = weights_dict.get("sleepy", 0) + weights_dict.get("relaxed", 0)
-    Score = Wide_Score - Narrow_Score
-    k = 20.0 
-    sigmoid_output_eye = 1.0 / (1.0 + math.exp(-k * Score))
-    
-    MIN_OPENNESS = 0.2
-    MAX_OPENNESS = 1.0
-    target_eyeOpenness = MIN_OPENNESS + (MAX_OPENNESS - MIN_OPENNESS) * sigmoid_output_eye
-    
-    # final_params のインデックス0 を上書き
-    final_params[0] = target_eyeOpenness
 
-    # --- 2b. upperEyelidCoverage (インデックス4) の上書き (ハイブリッド方式) ---
-    
-        # --- ゲート(ON/OFF)の計算 ---
-    # 「被る」グループの重みの合計を計算
-    w_angry = weights_dict.get("angry", 0)
-    w_sad = weights_dict.get("sad", 0)
-    Cover_Score = w_angry + w_sad
-
-    # 「被らない」グループの重みの合計を計算
-    No_Cover_Score = weights_dict.get("happy", 0) + weights_dict.get("astonished", 0) + \
-                     weights_dict.get("sleepy", 0) + weights_dict.get("relaxed", 0)
-    
-    # 「被る」と「被らない」のどちらが優勢か
-    Score_coverage = Cover_Score - No_Cover_Score
+# --- 表情ルックアップテーブル (LUT) ---
+# VA平面 [-1, 1]^2 上の格子で表情パラメータを事前計算し、双線形補間で引く高速モード
+EXPRESSION_LUT_ENABLED = False
+# 格子の一辺の点数 (401 → 刻み 0.005)
+EXPRESSION_LUT_RESOLUTION = 401
+# 厳密計算との許容誤差 (全パラメータの絶対誤差の最大値)。超える場合は格子を細かくする
+EXPRESSION_LUT_MAX_ERROR = 0.05
+EXPRESSION_LUT_MAX_RESOLUTION = 1601
+# キャッシュファイルの保存先 (キーフレーム定数のハッシュでファイル名を決める)
+EXPRESSION_LUT_CACHE_DIR = '.cache'
 
-    # ゲイン k (大きいほど急激に 0.0 か 1.0 に振り切れる)
-    k_coverage = 20.0
+_expression_lut = None          # (res, res, 9) の表。None のときは未構築
+_expression_lut_step = None
 
-    # シグモイド関数 (ゲートの開閉度: 0.0～1.0)
-    # Score がプラス (Cover優勢) なら 1.0 に、マイナス (No_Cover優勢) なら 0.0 に近づく
-    sigmoid_gate = 1.0 / (1.0 + math.exp(-k_coverage * Score_coverage))
-    
-    # --- 最終的な値の決定 ---
-    # target = ゲート(0 or 1) * 目標値(Base値)
-    # これにより、「微妙な値」はゲートが0.0になり消滅し、
-    # 「意図した値」はゲートが1.0になりそのまま使われる。
-    target_coverage = sigmoid_gate * base_upperEyelidCoverage
-    
-    print(f"--- upperEyelidCoverage ファジー計算 (ゲート * Base値 方式) ---")
-    print(f"Cover_Score: {Cover_Score:.4f}, No_Cover_Score: {No_Cover_Score:.4f}, Score: {Score_coverage:.4f}")
-    print(f"Sigmoid出力 (ゲート): {sigmoid_gate:.4f}")
-    print(f"目標値 (Base値): {base_upperEyelidCoverage:.4f}")
-    print(f"target_coverage (出力): {target_coverage:.4f}")
 
-    # final_params のインデックス4 を上書き
-    final_params[4] = target_coverage
+def expression_lut_key(resolution):
+    """キーフレーム定数と計算設定から LUT キャッシュのキーを作る"""
+    h = hashlib.sha256()
+    h.update(KEYFRAME_VA_MATRIX.tobytes())
+    h.update(KEYFRAME_PARAMS_MATRIX.tobytes())
+    h.update(EYE_OPENNESS_SIGNS.tobytes())
+    h.update(EYELID_COVER_SIGNS.tobytes())
+    h.update(repr((EPSILON, SOFTMAX_TEMPERATURE, EYE_OPENNESS_GAIN, MIN_OPENNESS, MAX_OPENNESS,
+                   EYELID_COVER_GAIN, resolution)).encode())
+    return h.hexdigest()[:16]
 
 
-    # ===== 3. 最終結果の表示 =====
-    print(f"\n--- 補間結果 (ファジー適用後): V={target_v}, A={target_a} ---")
-    param_names = [
-    "eyeOpenness", "pupilSize", "pupilAngle", "upperEyelidAngle",
-    "upperEyelidCoverage", "lowerEyelidCoverage", "mouthCurve",
-    "mouthHeight", "mouthWidth"
-    ]
-    print(f"{'Parameter':<20} | {'Value':<12}")
-    print("-" * 35)
-    for i, (name, value) in enumerate(zip(param_names, final_params)):
-        if i == 0:
-            print(f"{name:<20} | {value:<12.4f}  <-- ファジー制御 (EyeOpen)")
-        elif i == 4:
-            print(f"{name:<20} | {value:<12.4f}  <-- ファジー制御 (EyelidCov)")
+def build_expression_lut(resolution):
+    """格子点で厳密計算した表と、セル中心での最大誤差を返す"""
+    grid = np.linspace(-1.0, 1.0, resolution)
+    gv, ga = np.meshgrid(grid, grid, indexing='ij')
+    params, _ = get_interpolated_expressions(np.stack([gv.ravel(), ga.ravel()], axis=1))
+    table = params.reshape(resolution, resolution, len(PARAM_NAMES))
+
+    # 双線形補間の誤差はセル中心で最大になるので、そこで厳密値と比較する
+    centers = (grid[:-1] + grid[1:]) / 2
+    cv, ca = np.meshgrid(centers, centers, indexing='ij')
+    exact, _ = get_interpolated_expressions(np.stack([cv.ravel(), ca.ravel()], axis=1))
+    exact = exact.reshape(resolution - 1, resolution - 1, len(PARAM_NAMES))
+    approx = (table[:-1, :-1] + table[1:, :-1] + table[:-1, 1:] + table[1:, 1:]) / 4
+    max_error = float(np.abs(approx - exact).max())
+    return table, max_error
+
+
+def read_expression_lut_cache(path):
+    """キャッシュの (table, max_error) を返す。壊れている・書きかけのファイルなら None"""
+    try:
+        with np.load(path) as cached:
+            return cached['table'], float(cached['max_error'])
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        logger.warning("表情LUTのキャッシュを読めないため、作り直します: %s (%s)", path, e)
+        return None
+
+
+def write_expression_lut_cache(path, table, max_error):
+    """同じディレクトリの一時ファイルに書いてから置き換える (同時に起動したワーカーに書きかけを読ませない)"""
+    os.makedirs(EXPRESSION_LUT_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=EXPRESSION_LUT_CACHE_DIR, suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, table=table, max_error=max_error)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_or_build_expression_lut():
+    """キャッシュから LUT を読み込み、なければ構築して保存する。誤差上限を満たさなければ無効化する"""
+    global _expression_lut, _expression_lut_step
+    resolution = EXPRESSION_LUT_RESOLUTION
+    while True:
+        path = os.path.join(EXPRESSION_LUT_CACHE_DIR, f"expression_lut_{expression_lut_key(resolution)}.npz")
+        cached = read_expression_lut_cache(path) if os.path.isfile(path) else None
+        if cached is not None:
+            table, max_error = cached
+            logger.info("表情LUTをキャッシュから読み込みました: %s (誤差 %.5f)", path, max_error)
         else:
-            print(f"{name:<20} | {value:<12.4f}")
-    print("=" * 35 + "\n")
-    return final_params
-    
+            start_time = time.time()
+            table, max_error = build_expression_lut(resolution)
+            write_expression_lut_cache(path, table, max_error)
+            logger.info("表情LUTを構築しました: %dx%d, 誤差 %.5f, %.2f秒", resolution, resolution, max_error, time.time() - start_time)
 
-# --- Flaskルーティング ---
-@app.route("/", methods=["GET"])
-def index():
-    """ index.htmlをレンダリング """
-    return render_template("index.html")
+        if max_error <= EXPRESSION_LUT_MAX_ERROR:
+            _expression_lut = table
+            _expression_lut_step = 2.0 / (resolution - 1)
+            return True
+        if resolution * 2 - 1 > EXPRESSION_LUT_MAX_RESOLUTION:
+            logger.warning("表情LUTが誤差上限 %s を満たせないため、厳密計算を使います", EXPRESSION_LUT_MAX_ERROR)
+            return False
+        resolution = resolution * 2 - 1
 
-# --- Socket.IOイベントハンドラ ---
-@socketio.on("user_message")
-def handle_message(data):
-    """ ユーザーからのメッセージを処理し、LLM と表情パラメータを返す """
-    start_time = time.time()  # 全体処理開始時間を記録
-    llm_start_time = None     # LLM処理開始時間
-    llm_end_time = None       # LLM処理終了時間
-    param_start_time = None   # パラメータ計算開始時間
-    param_end_time = None     # パラメータ計算終了時間
-    messages = data["messages"]
-    emotion_line = None  # EMOTION行を保存する変数
-    v_val = None
-    a_val = None  
-    emotion_label = None
-    
-    # デバッグ: 受信データの確認
-    print(f"--- 受信データ確認 ---")
-    print(f"last_emotion in data: {'last_emotion' in data}")
-    if "last_emotion" in data:
-        print(f"last_emotion value: {data['last_emotion']}")
-        print(f"last_emotion type: {type(data['last_emotion'])}")
-    print("--- 受信データ確認終了 ---")
-    
-    # 前回の感情座標を取得（最後のassistantメッセージから）
-    last_emotion_info = ""
-    if len(messages) > 0:
-        # 直近のbotの感情座標をデータから取得
-        if "last_emotion" in data and data["last_emotion"] is not None:
-            last_v = data["last_emotion"].get("v", "不明")
-            last_a = data["last_emotion"].get("a", "不明")
-            last_label = data["last_emotion"].get("label", "不明")
-            last_emotion_info = f"\n\n# CRITICAL INSTRUCTION: PREVIOUS EMOTION STATE\nYour PREVIOUS emotion was: v={last_v}, a={last_a} ({last_label})\n\n**MANDATORY RULES:**\n1. You MUST NOT output the same coordinates (v={last_v}, a={last_a})\n2. The difference between your new coordinates and previous ones MUST be at least 0.3 in total distance\n3. If the user's input doesn't warrant a major emotional change, still vary your coordinates significantly\n4. FORBIDDEN: Any output with v={last_v} OR a={last_a} (even if the other coordinate changes)\n\n**VERIFY BEFORE OUTPUT:** Check that your new v,a values are sufficiently different from v={last_v}, a={last_a}"
-    
-    instruction = """You are an empathetic robot friend who understands user emotions and expresses your own emotions richly.
+
+def lookup_expression(target_v, target_a):
+    """LUT から表情パラメータを双線形補間で引く。範囲外の座標は厳密計算に回す"""
+    if not (-1.0 <= target_v <= 1.0 and -1.0 <= target_a <= 1.0):
+        return get_interpolated_expression(target_v, target_a)
+    last = _expression_lut.shape[0] - 2
+    fv = (target_v + 1.0) / _expression_lut_step
+    fa = (target_a + 1.0) / _expression_lut_step
+    i = min(int(fv), last)
+    j = min(int(fa), last)
+    tv = fv - i
+    ta = fa - j
+    cell = _expression_lut[i:i + 2, j:j + 2]
+    return ((1 - tv) * ((1 - ta) * cell[0, 0] + ta * cell[0, 1])
+            + tv * ((1 - ta) * cell[1, 0] + ta * cell[1, 1]))
+
+
+def init_expression_lut():
+    """LUT モードが有効なら LUT を用意する。用意できなければ LUT モードを無効にする"""
+    global EXPRESSION_LUT_ENABLED
+    if EXPRESSION_LUT_ENABLED and _expression_lut is None and not load_or_build_expression_lut():
+        EXPRESSION_LUT_ENABLED = False
+
+
+_server_prepared = False
+_server_prepare_lock = threading.Lock()
+
+
+def prepare_server():
+    """要求を受け付ける前の準備 (表情の LUT とモデルのウォームアップ)。起動方法によらず1回だけ行う
+
+    python app.py / wsgi.py (gunicorn など) の読み込み時 / ASGI の lifespan startup から呼ばれる。
+    準備中に呼ばれたら終わるまで待つ。
+    """
+    global _server_prepared
+    with _server_prepare_lock:
+        if _server_prepared:
+            return
+        init_expression_lut()
+        if PROMPT_PREFIX_CACHE:
+            warm_up_model()
+        _server_prepared = True
+
+
+def compute_expression(target_v, target_a):
+    """表情パラメータを求める。LUT モードが有効なら LUT を、そうでなければ厳密計算を使う"""
+    if EXPRESSION_LUT_ENABLED:
+        init_expression_lut()
+        if _expression_lut is not None:
+            return lookup_expression(target_v, target_a)
+    return get_interpolated_expression(target_v, target_a)
+
+
+def params_to_dict(params):
+    """パラメータ配列をフロントエンド送信用の辞書に変換する"""
+    return {name: float(val) for name, val in zip(PARAM_NAMES, params)}
+
+
+# --- 表情の軌跡 (サーバーで計算した遷移をまとめて送る) ---
+# True のとき、update_expression の代わりに前回の感情から今回の感情までの軌跡を
+# expression_trajectory イベント (float32 のバイナリ) で送り、クライアントはそれを再生する
+EXPRESSION_TRAJECTORY_MODE = False
+TRAJECTORY_DURATION = 1.0   # 遷移にかける秒数 (main.js の補間時間と同じ)
+TRAJECTORY_KEYFRAMES = 16   # 軌跡のキーフレーム数 (両端を含む)
+
+
+def ease_in_out(t):
+    """main.js の updateRightAnimation と同じ2次のイージング"""
+    t = np.asarray(t, dtype=float)
+    return np.where(t < 0.5, 2 * t * t, 1 - (-2 * t + 2) ** 2 / 2)
+
+
+def build_expression_trajectory(start_va, end_va, keyframes=TRAJECTORY_KEYFRAMES):
+    """start_va から end_va へ VA 空間を進む軌跡を表情パラメータの列 (keyframes, 9) にする
+
+    キーフレームは時間に対して等間隔で、VA 空間上の位置にイージングをかける。
+    パラメータ空間で直線補間するのと違い、途中の VA に対応する表情を経由する。
+    """
+    progress = ease_in_out(np.linspace(0.0, 1.0, keyframes))[:, None]
+    start = np.asarray(start_va, dtype=float)
+    points = start + (np.asarray(end_va, dtype=float) - start) * progress
+    params, _ = get_interpolated_expressions(points)
+    return params.astype(np.float32)
+
+
+def pack_expression_trajectory(frames, duration=TRAJECTORY_DURATION):
+    """軌跡をリトルエンディアンの float32 列にする: [秒数, キーフレーム数, パラメータ数, 値...]
+
+    値はキーフレームごとに PARAM_NAMES の順に並ぶ。
+    """
+    header = np.array([duration, frames.shape[0], frames.shape[1]], dtype="<f4")
+    return header.tobytes() + np.ascontiguousarray(frames, dtype="<f4").tobytes()
+
+
+# --- チャット処理 (同期/非同期サーバー共通) ---
+SYSTEM_INSTRUCTION = """You are an empathetic robot friend who understands user emotions and expresses your own emotions richly.
     You must interact with the user in natural, casual Japanese ("Tame-guchi").
 
     # GOAL
@@ -384,244 +869,1136 @@ def handle_message(data):
     </thought>
     <emotion v="0.81" a="-0.55">content</emotion>
     そうだね、のんびりした日も大切だよね。"""
-    
-    # 前回の感情情報をinstructionに追加
-    full_instruction = instruction + last_emotion_info
-    
-    # システムメッセージが既に存在する場合は置き換え、なければ先頭に追加
-    if messages and messages[0]["role"] == "system":
-        messages[0]["content"] = full_instruction
+
+# <emotion v=".." a=".."> の開始タグ (小数点表記に対応)
+EMOTION_OPEN_PATTERN = re.compile(r'<emotion\s+v="(-?\d*\.?\d+)"\s+a="(-?\d*\.?\d+)"\s*>', re.IGNORECASE)
+# 思考ブロックの開始/終了タグ (qwen3 自身の <think> も同じ扱いにする)
+THOUGHT_OPEN_PATTERN = re.compile(r'<\s*(thought|think)\s*>', re.IGNORECASE)
+THOUGHT_CLOSE_PATTERN = re.compile(r'</\s*(thought|think)\s*>', re.IGNORECASE)
+# 感情タグの前に許す地の文の文字数 (思考ブロックの中身は数えない)
+EMOTION_SEARCH_LIMIT = 300
+# True のとき、感情ラベルを待たずに開始タグの v, a が揃った時点で表情を送る
+EMOTION_EARLY_EMIT = False
+# 感情の出し方
+#   "thought": <thought> で考えてから <emotion> を出す (THOUGHT_TOKEN_BUDGET で思考の長さを制限できる)
+#   "fast"   : 思考を省き、感情だけを構造化出力 (JSON) で先に出させてから返答を生成する
+EMOTION_MODE = "thought"
+# 思考のトークン数 (チャンク数) の上限。超えたらストリームを打ち切り、思考を閉じて感情タグの続きから生成し直す (None なら無制限)
+THOUGHT_TOKEN_BUDGET = None
+# 高速モードで感情を出させる指示とJSONスキーマ
+FAST_EMOTION_INSTRUCTION = """Do not write a <thought> block. Output only the emotion you will express in your next reply, as JSON:
+{"v": valence from -1.0 to 1.0, "a": arousal from -1.0 to 1.0, "label": one English word}"""
+FAST_EMOTION_SCHEMA = {
+    "type": "object",
+    "properties": {"v": {"type": "number"}, "a": {"type": "number"}, "label": {"type": "string"}},
+    "required": ["v", "a", "label"],
+}
+FAST_EMOTION_MAX_TOKENS = 40
+# bot_stream の送信をまとめる: 返答の最初のチャンクはすぐに送り、以降は前回の送信から
+# BOT_STREAM_FLUSH_INTERVAL 秒経つか BOT_STREAM_FLUSH_BYTES バイト溜まった時点でまとめて送る (0 なら1トークンずつ)
+BOT_STREAM_FLUSH_INTERVAL = 0.1
+BOT_STREAM_FLUSH_BYTES = 120
+# 中断した返答をLLMに送るときに末尾に付ける注記
+INTERRUPTED_MARKER = "…(interrupted by the user)"
+# 思考 (<thought>) が閉じられないまま生成が終わり、返答がなかったときの返答 (表情は初期表情に戻す)
+UNTERMINATED_THOUGHT_REPLY = "ごめんね、うまく考えがまとまらなかったみたい。もう一度話しかけてくれる？"
+# 前回の感情がないときに戻す表情 (main.js の初期パラメータと同じ)
+NEUTRAL_EXPRESSION_PARAMS = {
+    "eyeOpenness": 1.0, "pupilSize": 0.7, "pupilAngle": 0.0, "upperEyelidAngle": 0.0,
+    "upperEyelidCoverage": 0.0, "lowerEyelidCoverage": 0.0, "mouthCurve": 0.0,
+    "mouthHeight": 0.0, "mouthWidth": 1.0,
+}
+
+
+def llm_chat_kwargs():
+    """llm_backend.chat に渡す共通の引数"""
+    kwargs = {}
+    if PROMPT_PREFIX_CACHE:
+        kwargs["keep_alive"] = LLM_KEEP_ALIVE
+    return kwargs
+
+
+def warm_up_model():
+    """モデルを読み込み、固定のsystem指示を評価させてプロンプトキャッシュに載せておく"""
+    try:
+        start_time = time.time()
+        llm_backend.warm_up([{"role": "system", "content": SYSTEM_INSTRUCTION}], **llm_chat_kwargs())
+        logger.info("モデルのウォームアップ完了: %.2f秒", time.time() - start_time)
+    except Exception as e:
+        logger.warning("モデルのウォームアップに失敗しました: %s", e)
+
+
+def previous_emotion_instruction(last_emotion):
+    """前回の感情と同じ座標を出させないための指示 (先頭は空行)"""
+    last_v = last_emotion.get("v", "不明")
+    last_a = last_emotion.get("a", "不明")
+    last_label = last_emotion.get("label", "不明")
+    return f"\n\n# CRITICAL INSTRUCTION: PREVIOUS EMOTION STATE\nYour PREVIOUS emotion was: v={last_v}, a={last_a} ({last_label})\n\n**MANDATORY RULES:**\n1. You MUST NOT output the same coordinates (v={last_v}, a={last_a})\n2. The difference between your new coordinates and previous ones MUST be at least 0.3 in total distance\n3. If the user's input doesn't warrant a major emotional change, still vary your coordinates significantly\n4. FORBIDDEN: Any output with v={last_v} OR a={last_a} (even if the other coordinate changes)\n\n**VERIFY BEFORE OUTPUT:** Check that your new v,a values are sufficiently different from v={last_v}, a={last_a}"
+
+
+def build_chat_messages(session):
+    """セッションの履歴からLLMに送るメッセージ列 (先頭にsystem) を組み立てる"""
+    history = [{"role": m["role"], "content": m["content"] + INTERRUPTED_MARKER} if m.get("interrupted") else m
+               for m in session["messages"]]
+    last_emotion = session["last_emotion"]
+    summary = session.get("summary", "")
+    if context_window is not None:
+        # 予算に収まらない古い発話は送らない (要約への畳み込みはターンの合間に行う)
+        history = context_window.fit(history, summary, prompt_reserved_tokens(session))
+    summary_messages = [{"role": "system", "content": SUMMARY_HEADER + summary}] if summary else []
+
+    # 前回の感情座標を取得
+    last_emotion_info = ""
+    if history and last_emotion is not None:
+        last_emotion_info = previous_emotion_instruction(last_emotion)
+
+    if PROMPT_PREFIX_CACHE:
+        # 先頭のsystem指示は固定し、前回の感情の制約は最後のユーザー発話の後ろに置く
+        # (前のターンのプロンプトとは最後のユーザー発話まで一致するので、その部分のキャッシュが効く)
+        messages = [{"role": "system", "content": SYSTEM_INSTRUCTION}] + summary_messages + history
+        if last_emotion_info:
+            messages.append({"role": "system", "content": last_emotion_info.strip()})
     else:
-        messages.insert(0, {"role": "system", "content": full_instruction})
-    
-    # デバッグ: LLMに送られるinstructionの内容を確認
-    print(f"\n--- LLMに送信されるInstruction ---")
-    print(f"前回の感情情報: {repr(last_emotion_info)}")
-    print(f"Full instruction末尾 (200文字): ...{full_instruction[-200:]}")
-    print("--- Instruction確認終了 ---")
+        # 前回の感情情報をinstructionに追加
+        full_instruction = SYSTEM_INSTRUCTION + last_emotion_info
+        messages = [{"role": "system", "content": full_instruction}] + summary_messages + history
 
-    print(f"[User] {messages[-1]['content']}")
-    
-    # デバッグ: 履歴の中身を確認
-    print(f"\n--- メッセージ履歴の確認 (件数: {len(messages)}) ---")
-    for i, msg in enumerate(messages):
-        if msg['role'] == 'system':
-            print(f"{i}: system - [インストラクション省略]")
+    logger.debug("前回の感情情報: %s / 履歴件数: %d", last_emotion, len(history))
+    if history:
+        logger.debug("[User] %s", history[-1]['content'])
+    return messages
+
+
+class EmotionStreamParser:
+    """<thought>/<emotion> プロトコルをチャンク単位で1パス解析するストリームパーサー
+
+    feed() / finish() は (種類, 値) のイベントのリストを返す。
+      ("thought", text)             : 思考テキスト (<thought> / <think> の中身)
+      ("emotion_start", (v, a))     : <emotion v=".." a=".."> の開始タグが閉じた時点
+      ("emotion_abort", None)       : emotion_start の後で感情タグが不正と分かった時点
+      ("emotion", (v, a, label, raw)): </emotion> が届いた時点で1回だけ
+      ("reply", text)               : ユーザーへの返答テキスト
+      ("neutral", None)             : 感情が分からないまま代わりの返答にした時点 (初期表情に戻す)
+    返答部分に入った後のチャンクは再走査せずにそのまま ("reply", chunk) として返す。
+    """
+
+    PREAMBLE, THOUGHT, EMOTION_LABEL, REPLY = range(4)
+    MAX_TAG_LENGTH = 200      # '<' から '>' までの最大長 (超えたらタグではないとみなす)
+    MAX_LABEL_LENGTH = 100    # 感情ラベルの最大長
+
+    def __init__(self, search_limit=EMOTION_SEARCH_LIMIT):
+        self.search_limit = search_limit
+        self.state = self.PREAMBLE
+        self.emotion = None           # 検出した (v, a, label, raw)
+        self.fallback_reason = None   # プロトコル違反で返答扱いに切り替えた理由
+        self._pending = ""            # 次のチャンクと合わせて判定する未確定の末尾
+        self._thought_close = None    # THOUGHT 中に探す閉じタグのパターン
+        self._preamble = []           # タグの外にあるテキスト
+        self._preamble_length = 0
+        self._emotion_open = None     # <emotion ...> の開始タグ
+        self._emotion_va = None
+        self._label = ""
+        self._reply_started = False
+        self._thought = []            # 閉じていない思考のテキスト (閉じタグが来ないまま終わったときに解析し直す)
+        self.thought_unterminated = False
+
+    def feed(self, chunk):
+        """ストリームのチャンクを1つ解析する"""
+        if self.state == self.REPLY and self._reply_started:
+            return [("reply", chunk)] if chunk else []
+
+        events = []
+        text = self._pending + chunk
+        self._pending = ""
+        pos = 0
+        while pos < len(text):
+            if self.state == self.PREAMBLE:
+                pos = self._feed_preamble(text, pos, events)
+            elif self.state == self.THOUGHT:
+                pos = self._feed_thought(text, pos, events)
+            elif self.state == self.EMOTION_LABEL:
+                pos = self._feed_label(text, pos, events)
+            else:
+                pos = self._feed_reply(text, pos, events)
+        return events
+
+    def finish(self, fallback_reply=UNTERMINATED_THOUGHT_REPLY):
+        """ストリーム終了時に未確定のテキストを処理する
+
+        思考が閉じられないまま終わり返答がなければ fallback_reply を返答にする (None なら何も返さない)。
+        """
+        events = []
+        if self.state == self.THOUGHT:
+            self._close_unterminated_thought(events)
+        pending, self._pending = self._pending, ""
+        if self.state == self.EMOTION_LABEL:
+            self._abandon_emotion(events)
+            self._add_preamble(pending, events)
+        elif self.state == self.PREAMBLE:
+            self._add_preamble(pending, events)
+
+        if self.state != self.REPLY:
+            # 感情タグが最後まで来なかった: タグの外のテキストを返答として扱う
+            if self.fallback_reason is None:
+                self.fallback_reason = "emotion タグが見つからないままストリームが終了しました"
+            reply = "".join(self._preamble).strip()
+            self.state = self.REPLY
+            if not reply and self.thought_unterminated and fallback_reply:
+                events.append(("neutral", None))
+                reply = fallback_reply
+            if reply:
+                events.append(("reply", reply))
+        return events
+
+    # --- 状態ごとの処理 (戻り値は次に読む位置) ---
+    def _feed_preamble(self, text, pos, events):
+        lt = text.find("<", pos)
+        if lt < 0:
+            self._add_preamble(text[pos:], events)
+            return len(text)
+        if lt > pos:
+            self._add_preamble(text[pos:lt], events)
+            if self.state != self.PREAMBLE:
+                return lt
+        gt = text.find(">", lt)
+        if gt < 0:
+            if len(text) - lt > self.MAX_TAG_LENGTH:
+                self._add_preamble("<", events)
+                return lt + 1
+            self._pending = text[lt:]
+            return len(text)
+        self._open_tag(text[lt:gt + 1], events)
+        return gt + 1
+
+    def _feed_thought(self, text, pos, events):
+        match = self._thought_close.search(text, pos)
+        if match:
+            if match.start() > pos:
+                events.append(("thought", text[pos:match.start()]))
+            self.state = self.PREAMBLE
+            self._thought = []
+            return match.end()
+        # 閉じタグが途中で切れている可能性のある末尾だけを保留する
+        tail = text.rfind("<", max(pos, len(text) - 16))
+        end = tail if tail >= 0 else len(text)
+        if end > pos:
+            events.append(("thought", text[pos:end]))
+            self._thought.append(text[pos:end])
+        self._pending = text[end:]
+        return len(text)
+
+    def _feed_label(self, text, pos, events):
+        lt = text.find("<", pos)
+        label_end = len(text) if lt < 0 else lt
+        self._label += text[pos:label_end]
+        if len(self._label) > self.MAX_LABEL_LENGTH:
+            self._abandon_emotion(events)
+            return label_end
+        if lt < 0:
+            return len(text)
+
+        rest = text[lt:lt + len("</emotion>")]
+        if rest.lower() == "</emotion>":
+            v, a = self._emotion_va
+            raw = self._emotion_open + self._label + rest
+            self.emotion = (v, a, self._label, raw)
+            events.append(("emotion", self.emotion))
+            self.state = self.REPLY
+            # タグより前に書かれていた地の文は返答の先頭として扱う
+            preamble = "".join(self._preamble).strip()
+            if preamble:
+                events.append(("reply", preamble))
+                self._reply_started = True
+            return lt + len(rest)
+        if len(rest) < len("</emotion>") and "</emotion>".startswith(rest.lower()):
+            self._pending = text[lt:]
+            return len(text)
+        # 閉じタグ以外のタグが来た: 感情タグとしては不正
+        self._abandon_emotion(events)
+        return lt
+
+    def _feed_reply(self, text, pos, events):
+        if not self._reply_started:
+            # 感情タグ直後の空白は表示しない
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+            if pos == len(text):
+                return pos
+            self._reply_started = True
+        events.append(("reply", text[pos:]))
+        return len(text)
+
+    # --- 補助 ---
+    def _open_tag(self, tag, events):
+        thought = THOUGHT_OPEN_PATTERN.fullmatch(tag)
+        if thought:
+            self.state = self.THOUGHT
+            self._thought_close = re.compile(rf"</\s*{thought.group(1)}\s*>", re.IGNORECASE)
+            return
+        emotion = EMOTION_OPEN_PATTERN.fullmatch(tag)
+        if emotion:
+            self.state = self.EMOTION_LABEL
+            self._emotion_open = tag
+            self._emotion_va = (float(emotion.group(1)), float(emotion.group(2)))
+            self._label = ""
+            events.append(("emotion_start", self._emotion_va))
+            return
+        if THOUGHT_CLOSE_PATTERN.fullmatch(tag):
+            return  # 対応のない閉じタグは捨てる
+        self._add_preamble(tag, events)
+
+    def _close_unterminated_thought(self, events):
+        """閉じタグが来ないまま終わった思考を閉じる。中に感情タグがあれば、そこから返答として解析し直す"""
+        pending, self._pending = self._pending, ""
+        if pending:
+            events.append(("thought", pending))
+            self._thought.append(pending)
+        self.thought_unterminated = True
+        self.fallback_reason = "<thought> が閉じられないままストリームが終了しました"
+        self.state = self.PREAMBLE
+        thought, self._thought = "".join(self._thought), []
+        start = thought.lower().find("<emotion")
+        if start >= 0:
+            # 思考を閉じ忘れたまま感情タグと返答を書いていた
+            events += self.feed(thought[start:])
+
+    def _abandon_emotion(self, events):
+        """不正な感情タグを地の文として扱い、タグ外の解析に戻る"""
+        events.append(("emotion_abort", None))
+        self.state = self.PREAMBLE
+        self._add_preamble(self._emotion_open + self._label, events)
+        self._emotion_open = None
+        self._emotion_va = None
+        self._label = ""
+
+    def _add_preamble(self, text, events):
+        if not text or self.state == self.REPLY:
+            return
+        self._preamble.append(text)
+        self._preamble_length += len(text)
+        if self._preamble_length > self.search_limit:
+            # プロンプト指示に従わず、EMOTION行が来ていない場合のフォールバック
+            self.fallback_reason = f"emotion タグの前に {self.search_limit} 文字を超える地の文がありました"
+            self.state = self.REPLY
+            self._reply_started = True
+            events.append(("reply", "".join(self._preamble)))
+
+
+# 表情を変えるイベント (最初に送った時刻を time_to_emotion の計測に使う)
+EXPRESSION_EVENTS = ("update_expression", "expression_trajectory")
+
+
+class StreamCoalescer:
+    """返答のチャンクを溜めて、まとめて送るテキストを返す
+
+    add() は次のチャンクが届いたときに判定する。LLMの出力が途切れても溜めた分が interval より長く
+    待たされないように、サーバー側のタイマー (StreamFlusher / asgi_app.StreamFlushTimer) が delay() を見て
+    flush() を呼ぶ。
+    """
+
+    def __init__(self, interval=BOT_STREAM_FLUSH_INTERVAL, max_bytes=BOT_STREAM_FLUSH_BYTES):
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.last_flush = None  # 最後に送った時刻 (None なら1回も送っていない)
+        self.frames = 0         # 送った回数
+        self._buffer = []
+        self._bytes = 0
+
+    def add(self, text, now=None):
+        """チャンクを1つ預ける。今送るべきテキストがあれば返す (なければ None)"""
+        now = time.monotonic() if now is None else now
+        self._buffer.append(text)
+        self._bytes += len(text.encode("utf-8"))
+        if self.last_flush is None or now - self.last_flush >= self.interval or self._bytes >= self.max_bytes:
+            return self.flush(now)
+        return None
+
+    def delay(self, now=None):
+        """溜まっているテキストを送るべき時刻までの秒数 (溜まっていなければ None)"""
+        if not self._buffer:
+            return None
+        if self.last_flush is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.last_flush + self.interval - now)
+
+    def flush(self, now=None):
+        """溜まっているテキストをすべて返す (なければ None)"""
+        if not self._buffer:
+            return None
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._bytes = 0
+        self.last_flush = time.monotonic() if now is None else now
+        self.frames += 1
+        return text
+
+
+class ChatTurn:
+    """1ターン分のストリーム処理の状態を保持し、クライアントへ送るイベントを返す
+
+    feed() / finish() は (イベント名, ペイロード) のリストを返すだけで送信はしないので、
+    Flask-SocketIO の同期ハンドラと ASGI の非同期ハンドラの両方から使える。
+    """
+
+    def __init__(self, previous_emotion=None, early_emit=None, trajectory=None):
+        self.parser = EmotionStreamParser()
+        self.llm_start_time = time.time()  # LLM処理開始時間
+        self.llm_end_time = None           # LLM処理終了時間
+        self.first_token_time = None       # 最初のトークンを受信した時間
+        self.thought_start_time = None     # 思考テキストの受信開始/終了時間
+        self.thought_end_time = None
+        self.expression_time = None        # 最初に表情パラメータを送った時間
+        self.emit_time = 0.0               # クライアントへの送信にかかった時間の合計
+        self.chunk_count = 0
+        self.prompt_eval_count = None      # Ollamaが評価したプロンプトのトークン数 (キャッシュ分は含まない)
+        self.prompt_eval_duration = None   # その評価時間 (秒)
+        self.eval_count = None             # 生成したトークン数
+        self.previous_emotion = previous_emotion  # 早期送信を取り消すときに戻す感情
+        self.early_emit = EMOTION_EARLY_EMIT if early_emit is None else early_emit
+        self.early_va = None        # 早期送信済みの (v, a)
+        self.trajectory = EXPRESSION_TRAJECTORY_MODE if trajectory is None else trajectory
+        self.shown_va = self._previous_va()  # クライアントが今表示している表情の (v, a) (不明なら None)
+        self.full_text = ""
+        self.thought_text = ""
+        self.emotion_line = None    # EMOTION行を保存する変数
+        self.v_val = None
+        self.a_val = None
+        self.emotion_label = None
+        self.param_start_time = None  # パラメータ計算開始時間
+        self.param_end_time = None    # パラメータ計算終了時間
+        self.cache_hit = None         # 応答キャッシュから再生したか (キャッシュが無効なら None)
+        self.interrupted = None       # 生成を中断した理由 ("barge_in" / "disconnect")
+        self.cancel_latency = None    # 中断の要求からストリームを閉じるまでの秒数
+        self.stream_coalescer = StreamCoalescer()
+        self.thought_chunks = 0       # 思考として受け取ったチャンクの数 (THOUGHT_TOKEN_BUDGET と比べる)
+        self.emotion_mode = None      # 感情の出し方 ("thought" / "thought_budget" / "fast", キャッシュ再生なら None)
+        self.thought_cut = False      # 思考を予算で打ち切ったか
+        self.provisional_va = None    # 先に送った仮の感情の (v, a)
+        self.provisional_time = None  # 仮の表情を送った時間
+        self.reply_chunks = 0         # 返答として受け取ったチャンクの数 (bot_stream の送信回数は stream_coalescer.frames)
+
+    def feed_chunk(self, chunk):
+        """Ollamaのストリームチャンクを1つ処理する (最後のチャンクの統計も記録する)"""
+        if chunk.get("done"):
+            self.prompt_eval_count = chunk.get("prompt_eval_count")
+            if chunk.get("prompt_eval_duration") is not None:
+                self.prompt_eval_duration = chunk.get("prompt_eval_duration") / 1e9
+            self.eval_count = chunk.get("eval_count")
+        if "message" in chunk and chunk["message"]["content"]:
+            return self.feed(chunk["message"]["content"])
+        return []
+
+    def feed(self, subtext):
+        """ストリームのチャンクを1つ処理する"""
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        self.chunk_count += 1
+        return self._handle(self.parser.feed(subtext))
+
+    def finish(self):
+        """ストリーム終了時の処理を行い、bot_stream_end までのイベントを返す"""
+        self.llm_end_time = time.time()
+        # 中断したターンには代わりの返答を出さない
+        fallback_reply = UNTERMINATED_THOUGHT_REPLY if self.interrupted is None else None
+        events = self._handle(self.parser.finish(fallback_reply))
+        events += self.flush_stream()
+        events.append(("bot_stream_end", {
+            "text": self.full_text.strip(),
+            "emotion": self.current_emotion(),
+            "interrupted": self.interrupted is not None,
+        }))
+        return events
+
+    def interrupt(self, reason, requested_at):
+        """ストリームを途中で閉じたことを記録する"""
+        self.interrupted = reason
+        self.cancel_latency = time.time() - requested_at
+
+    def _handle(self, parsed_events):
+        events = []
+        for kind, value in parsed_events:
+            if kind != "reply":
+                # 返答以外のイベントより前に、溜めていた返答を送っておく (順序を変えない)
+                events += self.flush_stream()
+            if kind == "reply":
+                if (self.parser.fallback_reason and self.emotion_line is None and not self.full_text
+                        and not self.parser.thought_unterminated):
+                    logger.warning("%s。テキストをそのまま流します。", self.parser.fallback_reason)
+                self.reply_chunks += 1
+                self.full_text += value
+                text = self.stream_coalescer.add(value)
+                if text is not None:
+                    events.append(("bot_stream", {"chunk": text}))
+            elif kind == "emotion_start" and self.early_emit:
+                # 開始タグの属性だけで先に表情を送る
+                self.early_va = value
+                logger.debug("座標を先行検出: V=%s, A=%s", value[0], value[1])
+                events.append(self._expression_event(*value))
+            elif kind == "emotion_abort" and self.early_va is not None:
+                # 感情タグが不正だった: 先行送信した表情を取り消す
+                logger.warning("感情タグが不正だったため、先行送信した表情を取り消します")
+                self.early_va = None
+                events.append(self._previous_expression_event())
+            elif kind == "emotion":
+                event = self._on_emotion(*value)
+                if event is not None:
+                    events.append(event)
+            elif kind == "neutral":
+                logger.warning("%s。代わりの返答を初期表情で送ります。", self.parser.fallback_reason)
+                self.early_va = None
+                self.shown_va = None
+                events.append(("update_expression", dict(NEUTRAL_EXPRESSION_PARAMS)))
+            elif kind == "thought":
+                self.thought_chunks += 1
+                self.thought_text += value
+                self.thought_end_time = time.time()
+                if self.thought_start_time is None:
+                    self.thought_start_time = self.thought_end_time
+        if self.expression_time is None and any(event in EXPRESSION_EVENTS for event, _ in events):
+            self.expression_time = time.time()
+        return events
+
+    def provisional(self, v_val, a_val):
+        """LLMの感情が届く前に、推定した仮の感情の表情を送るイベントを返す"""
+        if self.expression_time is not None:
+            return []  # LLMの感情が先に届いていた
+        self.provisional_va = (v_val, a_val)
+        events = [self._expression_event(v_val, a_val)]
+        self.provisional_time = time.time()
+        return events
+
+    def thought_over_budget(self, budget):
+        """思考の途中で、そのチャンク数が budget に達したか"""
+        return budget is not None and self.parser.state == self.parser.THOUGHT and self.thought_chunks >= budget
+
+    def flush_stream(self):
+        """溜めている返答を送るイベント (溜まっていなければ空)"""
+        text = self.stream_coalescer.flush()
+        return [("bot_stream", {"chunk": text})] if text is not None else []
+
+    def _on_emotion(self, v_val, a_val, emotion_label, raw):
+        """感情を検出したら表情のイベントを作る (先行送信済みなら None)"""
+        self.v_val = v_val
+        self.a_val = a_val
+        self.emotion_label = emotion_label
+        self.emotion_line = raw.strip()
+        logger.debug("座標を検出 (ストリーム中): V=%s, A=%s, 感情: %s", v_val, a_val, emotion_label)
+        if self.early_va == (v_val, a_val):
+            return None  # 先行送信済み
+        return self._expression_event(v_val, a_val)
+
+    def _expression_event(self, v_val, a_val):
+        """(v, a) の表情を送るイベント (軌跡モードなら今の表情からの軌跡)"""
+        self.param_start_time = time.time()  # パラメータ計算開始時間を記録
+        if self.trajectory:
+            # 今の表情の VA が分からなければ中心から始める (ずれはクライアントが補間で吸収する)
+            frames = build_expression_trajectory(self.shown_va or (0.0, 0.0), (v_val, a_val))
+            event = ("expression_trajectory", pack_expression_trajectory(frames))
         else:
-            content_display = msg['content'].replace('\n', '\\n')
-            print(f"{i}: {msg['role']} - {content_display}")
-    print("--- 履歴確認終了 ---\n")
+            event = ("update_expression", params_to_dict(compute_expression(v_val, a_val)))
+        self.param_end_time = time.time()    # パラメータ計算終了時間を記録
+        self.shown_va = (v_val, a_val)
+        return event
+
+    def _previous_va(self):
+        """前回の感情の (v, a) (なければ None)"""
+        try:
+            return float(self.previous_emotion["v"]), float(self.previous_emotion["a"])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def _previous_expression_event(self):
+        """先行送信の前の表情 (仮の感情、なければ前回の感情、どちらもなければ初期表情) に戻すイベント"""
+        previous_va = self.provisional_va or self._previous_va()
+        if previous_va is not None:
+            return self._expression_event(*previous_va)
+        self.shown_va = None
+        return ("update_expression", dict(NEUTRAL_EXPRESSION_PARAMS))
+
+    def current_emotion(self):
+        """今回の感情座標 (検出できなかった場合は None)"""
+        if self.v_val is not None and self.a_val is not None and self.emotion_label is not None:
+            return {"v": self.v_val, "a": self.a_val, "label": self.emotion_label}
+        return None
+
+    def start_llm(self):
+        """LLMの呼び出しを始めた時刻を記録する (生成枠を待った後に呼ぶ)"""
+        self.llm_start_time = time.time()
+
+    def time_to_first_token(self):
+        return self.first_token_time - self.llm_start_time if self.first_token_time else None
+
+    def metrics_record(self, session_id, turn_start_time, queue_wait=None):
+        """metrics.TurnMetrics に渡す1ターン分の記録を作る"""
+        def since_llm_start(t):
+            return t - self.llm_start_time if t is not None else None
+
+        thought = None
+        if self.thought_start_time is not None:
+            thought = self.thought_end_time - self.thought_start_time
+        return {
+            "session_id": session_id,
+            "timestamp": time.strftime('%Y-%m-%d %H:%M:%S'),
+            "stages": {
+                "queue_wait": queue_wait,
+                "time_to_first_token": self.time_to_first_token(),
+                "thought": thought,
+                # 仮の表情は生成枠を待つ前に送るので、ターンの開始から測る
+                "time_to_provisional": self.provisional_time - turn_start_time if self.provisional_time else None,
+                "time_to_emotion": since_llm_start(self.expression_time),
+                "param_compute": self.param_time() if self.param_start_time else None,
+                "emit": self.emit_time,
+                "cancel_latency": self.cancel_latency,
+                "llm_total": since_llm_start(self.llm_end_time),
+                "turn_total": time.time() - turn_start_time,
+            },
+            "prompt_tokens": self.prompt_eval_count,
+            "prompt_eval_seconds": self.prompt_eval_duration,
+            "completion_tokens": self.eval_count if self.eval_count is not None else self.chunk_count,
+            "thought_chars": len(self.thought_text),
+            "reply_chars": len(self.full_text),
+            "reply_chunks": self.reply_chunks,
+            "bot_stream_frames": self.stream_coalescer.frames,
+            "emotion": self.current_emotion(),
+            "cache_hit": self.cache_hit,
+            "emotion_mode": self.emotion_mode,
+            "thought_cut": self.thought_cut,
+            "interrupted": self.interrupted,
+        }
+
+    def param_time(self):
+        return self.param_end_time - self.param_start_time if self.param_start_time and self.param_end_time else 0
+
+    def log_result(self):
+        """EMOTION情報と応答を DEBUG ログに出力する"""
+        if self.emotion_line:
+            logger.debug("[Bot] %s", self.emotion_line)
+        logger.debug("[Bot] %s", self.full_text.strip())
+
+
+def log_turn(record):
+    """1ターンを1行の INFO ログにまとめて出力する"""
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    stages = record["stages"]
+
+    def seconds(value):
+        return f"{value:.3f}s" if value is not None else "-"
+
+    emotion = record["emotion"]
+    emotion_text = f"{emotion['label']}({emotion['v']},{emotion['a']})" if emotion else "-"
+    logger.info("turn session=%s emotion=%s ttft=%s to_emotion=%s total=%s prompt_eval=%s tokens=%s/%s",
+                record["session_id"], emotion_text, seconds(stages["time_to_first_token"]),
+                seconds(stages["time_to_emotion"]), seconds(stages["turn_total"]),
+                seconds(record["prompt_eval_seconds"]), record["prompt_tokens"], record["completion_tokens"])
+
+
+def save_turn_to_csv(session_id, messages, turn):
+    """1ターン分の会話 (最後のユーザー発話とボットの応答) を保存する"""
+    user_msg = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+    save_conversation_to_csv(session_id, user_msg, turn.full_text.strip(), turn.v_val, turn.a_val, turn.emotion_label)
+
+
+def send_turn_events(turn, events, send):
+    """ChatTurn が返したイベントを送信し、送信にかかった時間を記録する"""
+    for event, payload in events:
+        start = time.time()
+        send(event, payload)
+        turn.emit_time += time.time() - start
+
+
+class StreamFlusher:
+    """返答が途切れている間も、溜めた bot_stream を BOT_STREAM_FLUSH_INTERVAL 以内に送るバックグラウンドタスク
+
+    ChatTurn へのチャンクの投入とその送信は lock の中で行う (タイマー側の送信と順序が入れ替わらないようにする)。
+    """
+
+    def __init__(self, turn, send):
+        self.turn = turn
+        self.send = send
+        self.lock = threading.Lock()
+        self._stopped = False
+        if turn.stream_coalescer.interval > 0:
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        coalescer = self.turn.stream_coalescer
+        while not self._stopped:
+            with self.lock:
+                delay = coalescer.delay()
+                if delay == 0.0 and not self._stopped:
+                    send_turn_events(self.turn, self.turn.flush_stream(), self.send)
+                    delay = None
+            socketio.sleep(coalescer.interval if delay is None else delay)
+
+    def stop(self):
+        self._stopped = True
+
+
+def close_stream(response):
+    """中断したストリームを閉じる (Ollama への接続を切って生成を止めさせる)"""
+    close = getattr(response, "close", None)
+    if close is not None:
+        close()
+
+
+class CancellableStream:
+    """同期サーバー用: LLMのストリームを別スレッドで読み、中断されたらチャンクを待たずに反復を終える
+
+    プロンプトの評価中や高速モードの感情の取得中 (最初のチャンクが来る前) に中断されても、ターンはすぐに終わる。
+    読み手のスレッドは、呼び出し側が次のチャンクを要求したときだけ1つ読む (generate_reply の思考の予算の判定を
+    ずらさない)。中断後は、読みかけのチャンクが届いた時点でストリームを閉じて (Ollama への接続を切って) 終わる。
+    """
+
+    _END = object()
+    _CANCELLED = object()
+
+    def __init__(self, stream, generation):
+        self.stream = stream
+        self.cancelled = False  # 中断で反復を終えたか
+        self._items = queue.Queue()
+        self._wanted = threading.Semaphore(0)
+        self._closed = False
+        generation.add_cancel_callback(lambda: self._items.put(self._CANCELLED))
+        socketio.start_background_task(self._read)
+
+    def __iter__(self):
+        try:
+            while not self._closed:
+                self._wanted.release()
+                item = self._items.get()
+                if item is self._CANCELLED:
+                    self.cancelled = True
+                    break
+                if item is self._END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """読み手のスレッドを止める (読みかけのチャンクが届いたらストリームを閉じる)"""
+        self._closed = True
+        self._wanted.release()
+
+    def _read(self):
+        iterator = iter(self.stream)
+        try:
+            while True:
+                self._wanted.acquire()
+                if self._closed:
+                    break
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                if self._closed:
+                    break
+                self._items.put(chunk)
+        except Exception as e:
+            self._items.put(e)
+        finally:
+            close_stream(self.stream)
+            self._items.put(self._END)
+
+
+def provisional_expression_events(turn, session):
+    """ユーザー発話から推定した仮の表情のイベント (PROVISIONAL_EXPRESSION が無効なら空)"""
+    if emotion_preclassifier is None or not session["messages"]:
+        return []
+    start_time = time.time()
+    v_val, a_val = emotion_preclassifier.predict(session["messages"][-1]["content"], turn.shown_va)
+    logger.debug("仮の感情: V=%s, A=%s (%.1fms)", v_val, a_val, (time.time() - start_time) * 1000)
+    return turn.provisional(v_val, a_val)
+
+
+def text_chunk(text):
+    """自分で補うテキストを、LLMのストリームと同じ形のチャンクにする"""
+    return {"message": {"role": "assistant", "content": text}, "done": False}
+
 
+def continuation_messages(messages, prefix):
+    """assistant の書きかけ (prefix) の続きを生成させるメッセージ列"""
+    return messages + [{"role": "assistant", "content": prefix}]
+
+
+def fast_emotion_request(messages):
+    """高速モードで感情だけをJSONで出させる (メッセージ列, 引数)"""
+    kwargs = dict(llm_chat_kwargs(), format=FAST_EMOTION_SCHEMA, think=False,
+                  options={"num_predict": FAST_EMOTION_MAX_TOKENS})
+    return messages + [{"role": "system", "content": FAST_EMOTION_INSTRUCTION}], kwargs
+
+
+def emotion_tag_from_json(text):
+    """構造化出力の感情を <emotion> タグの行にする (読めなければ None)"""
     try:
-        llm_start_time = time.time()  # LLM処理開始時間を記録
-        response = client.chat(model=LLM_MODEL, messages=messages, stream=True)
-        
-        full_text = ""
-        
-        # --- ★ 修正点 2: ストリーム処理のロジック変更 ---
-        emotion_sent = False # 表情を送信済みかどうかのフラグ
-        buffer = "" # EMOTION行を検出するためのバッファ
+        data = json.loads(text)
+        v = min(max(float(data["v"]), -1.0), 1.0)
+        a = min(max(float(data["a"]), -1.0), 1.0)
+        label = re.sub(r'[<>\s]', '', str(data["label"]))[:EmotionStreamParser.MAX_LABEL_LENGTH] or "neutral"
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("感情のJSONを読めませんでした: %s (%r)", e, text[:100])
+        return None
+    return f'<emotion v="{v:.2f}" a="{a:.2f}">{label}</emotion>\n'
+
+
+def thought_closing(generated):
+    """思考を打ち切るときに補うテキスト (思考を閉じ、感情タグの書き出しまで)"""
+    match = THOUGHT_OPEN_PATTERN.search(generated)
+    name = match.group(1).lower() if match else "thought"
+    return f'\n</{name}>\n<emotion v="'
+
+
+def generate_reply(messages, turn):
+    """LLMのストリームを返す (EMOTION_MODE / THOUGHT_TOKEN_BUDGET に応じて思考を省く・打ち切る)
+
+    呼び出し側は各チャンクを turn に渡してから次を要求すること (思考の予算は turn の状態で判定する)。
+    """
+    kwargs = llm_chat_kwargs()
+    if EMOTION_MODE == "fast":
+        request, options = fast_emotion_request(messages)
+        tag = emotion_tag_from_json(llm_backend.complete(request, **options))
+        if tag is not None:
+            turn.emotion_mode = "fast"
+            yield text_chunk(tag)
+            yield from llm_backend.chat(continuation_messages(messages, tag), think=False, **kwargs)
+            return
+        logger.warning("高速モードで感情を取得できなかったため、通常の生成に切り替えます")
 
+    turn.emotion_mode = "thought" if THOUGHT_TOKEN_BUDGET is None else "thought_budget"
+    response = llm_backend.chat(messages, **kwargs)
+    generated = ""
+    try:
         for chunk in response:
+            yield chunk
             if "message" in chunk:
-                subtext = chunk["message"]["content"]
-                
-                if not emotion_sent:
-                    # EMOTION行が来るまでテキストをバッファに貯める
-                    buffer += subtext
-                    
-                    # XML形式の感情タグを探す (小数点表記に対応)
-                    emotion_match = re.search(r'<emotion\s+v="(-?\d*\.?\d+)"\s+a="(-?\d*\.?\d+)">([^<]*)</emotion>', buffer, re.IGNORECASE)
-                    
-                    if emotion_match:
-                        # --- 感情を検出 ---
-                        emotion_sent = True
-                        v_val = float(emotion_match.group(1))
-                        a_val = float(emotion_match.group(2))
-                        emotion_label = emotion_match.group(3)
-                        emotion_line = emotion_match.group(0).strip()
-                        print(f"--- 座標を検出 (ストリーム中): V={v_val}, A={a_val}, 感情: {emotion_label} ---")
-                        
-                        param_start_time = time.time()  # パラメータ計算開始時間を記録
-                        params = get_interpolated_expression(v_val, a_val)
-                        param_end_time = time.time()    # パラメータ計算終了時間を記録
-                        param_names = [
-                            "eyeOpenness", "pupilSize", "pupilAngle", "upperEyelidAngle", 
-                            "upperEyelidCoverage", "lowerEyelidCoverage", "mouthCurve", 
-                            "mouthHeight", "mouthWidth"
-                        ]
-                        param_dict = {name: val for name, val in zip(param_names, params)}
-                        
-                        print(f"--- 表情パラメータを送信 ---")
-                        
-                        # フロントエンドに表情パラメータを送信
-                        emit("update_expression", param_dict)
-
-                        # --- 履歴保存用にはXMLタグを除去したテキストのみ保存 ---
-                        clean_buffer = buffer
-                        # <thought>...</thought>を除去
-                        clean_buffer = re.sub(r'<thought>.*?</thought>\s*', '', clean_buffer, flags=re.DOTALL)
-                        # <emotion>...</emotion>を除去
-                        clean_buffer = re.sub(r'<emotion[^>]*>.*?</emotion>\s*', '', clean_buffer, flags=re.DOTALL)
-                        clean_buffer = clean_buffer.strip()
-                        full_text += clean_buffer
-                        
-                        # --- 画面表示用にはthoughtとemotionタグを除去したテキストを送信 ---
-                        display_text = buffer
-                        # <thought>...</thought>を除去
-                        display_text = re.sub(r'<thought>.*?</thought>\s*', '', display_text, flags=re.DOTALL)
-                        # <emotion>...</emotion>を除去
-                        display_text = re.sub(r'<emotion[^>]*>.*?</emotion>\s*', '', display_text, flags=re.DOTALL)
-                        # 先頭と末尾の空白を除去
-                        display_text = display_text.strip()
-                        
-                        if display_text:
-                            emit("bot_stream", {"chunk": display_text})
-                        
-                        # buffer = "" # バッファはもう使わない
-                    
-                    elif len(buffer) > 300: # 閾値 (EMOTION行は通常先頭に来るはず)
-                        # プロンプト指示に従わず、EMOTION行が来ていない場合のフォールバック
-                        print("--- 警告: EMOTION行が先頭で検出されませんでした。テキストをそのまま流します。 ---")
-                        emit("bot_stream", {"chunk": buffer})
-                        full_text += buffer
-                        emotion_sent = True # 再検索しない
-                        # buffer = ""
-                
-                else:
-                    # --- 感情送信後の通常のテキストストリーム ---
-                    emit("bot_stream", {"chunk": subtext})
-                    full_text += subtext
+                generated += chunk["message"]["content"] or ""
+            if turn.thought_over_budget(THOUGHT_TOKEN_BUDGET):
+                break
+        else:
+            return
+    finally:
+        close_stream(response)
+    # 思考の予算を使い切った: 思考を閉じて感情タグの書き出しまでを補い、その続きを生成させる
+    turn.thought_cut = True
+    closing = thought_closing(generated)
+    yield text_chunk(closing)
+    yield from llm_backend.chat(continuation_messages(messages, generated + closing), **kwargs)
+
+
+class Generation:
+    """実行中の1ターンの生成。中断の要求と、履歴への書き込みまで終わったことを伝える"""
+
+    def __init__(self, key, sid):
+        self.key = key
+        self.sid = sid
+        self.cancel_reason = None
+        self.cancel_time = None
+        self.done = threading.Event()
+        self._cancel_callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.cancel_reason is not None
+
+    def cancel(self, reason):
+        with self._lock:
+            if self.cancel_reason is not None:
+                return
+            self.cancel_time = time.time()
+            self.cancel_reason = reason
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_cancel_callback(self, callback):
+        """中断されたときに callback() を呼ぶ (既に中断されていればすぐに呼ぶ)"""
+        with self._lock:
+            if self.cancel_reason is None:
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+
+class GenerationRegistry:
+    """セッションごとに実行中の生成を管理する (ワーカープロセスごと)"""
+
+    def __init__(self):
+        self._generations = {}  # セッションID (なければ sid) -> Generation
+        self._lock = threading.Lock()
+
+    def start(self, key, sid):
+        """新しい生成を登録する。同じセッションの生成が実行中なら中断を要求し、(新しい生成, 前の生成) を返す"""
+        generation = Generation(key, sid)
+        with self._lock:
+            previous = self._generations.get(key)
+            self._generations[key] = generation
+        if previous is not None:
+            previous.cancel("barge_in")
+        return generation, previous
+
+    def finish(self, generation):
+        with self._lock:
+            if self._generations.get(generation.key) is generation:
+                del self._generations[generation.key]
+        generation.done.set()
+
+    def cancel_sid(self, sid, reason="disconnect"):
+        """切断したクライアントの生成をすべて中断させる"""
+        with self._lock:
+            generations = [g for g in self._generations.values() if g.sid == sid]
+        for generation in generations:
+            generation.cancel(reason)
+
+    def __len__(self):
+        return len(self._generations)
+
+
+generation_registry = GenerationRegistry()
+
+
+def start_generation(data, sid):
+    """このターンの生成を登録する。同じセッションの生成が実行中なら中断させ、履歴に書き終わるまで待つ"""
+    generation, previous = generation_registry.start(data.get("session_id") or sid, sid)
+    if previous is not None:
+        wait_for_previous_turn(previous)
+    return generation
+
+
+def wait_for_previous_turn(previous):
+    """中断させた前のターンが履歴に書き終わるまで待つ
+
+    先に進むと履歴が user, user, assistant の順になるので、時間切れでは進まない (中断はすぐに効くので通常は短い)。
+    """
+    while not previous.done.wait(CANCEL_WAIT_WARNING_INTERVAL):
+        logger.warning("中断したターンの終了を待っています (session=%s)", previous.key)
+
+
+# 形式が正しくない user_message に返すエラー ("error" イベント)
+INVALID_MESSAGE_ERROR = "メッセージの形式が正しくありません"
+
+
+def validate_user_message(data):
+    """受信した発話のデータを検証する。不正なデータは ValueError/KeyError/TypeError"""
+    if not isinstance(data, dict):
+        raise TypeError(f"dict ではありません: {type(data).__name__}")
+    if "messages" in data:
+        for message in data["messages"]:
+            if not isinstance(message["role"], str) or not isinstance(message["content"], str):
+                raise TypeError(f"messages の要素が不正です: {message!r}")
+    elif not isinstance(data["message"], str):
+        raise TypeError("message が文字列ではありません")
+    if not isinstance(data.get("session_id") or "", str):
+        raise TypeError("session_id が文字列ではありません")
+    if not isinstance(data.get("last_emotion") or {}, dict):
+        raise TypeError("last_emotion が dict ではありません")
+
+
+def parse_manual_expression(data):
+    """手動更新リクエストから (v, a) を取り出す。不正なデータは ValueError/KeyError/TypeError"""
+    return float(data['v']), float(data['a'])
+
+
+class LatestValueCoalescer:
+    """キーごとに最新の値だけを保持し、min_interval 秒に1回だけ取り出させる
+
+    スケジューリングは呼び出し側が行う: offer() が遅延秒数を返したら、その秒数後に take() を呼ぶ。
+    予約済みのキーに届いた値は前の値を置き換える (途中の値はキューに溜めずに捨てる)。
+    """
+
+    def __init__(self, max_rate):
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.received = 0
+        self.dropped = 0
+        self.taken = 0
+        self._pending = {}   # key -> まだ取り出されていない最新の値
+        self._last_take = {}  # key -> 最後に取り出した時刻
+        self._lock = threading.Lock()
+
+    def offer(self, key, value, now=None):
+        """値を預ける。取り出しを新しく予約すべきときは遅延秒数を、予約済みなら None を返す"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.received += 1
+            scheduled = key in self._pending
+            self._pending[key] = value
+            if scheduled:
+                self.dropped += 1
+                return None
+            last = self._last_take.get(key)
+            return 0.0 if last is None else max(0.0, last + self.min_interval - now)
+
+    def take(self, key, now=None):
+        """最新の値を取り出す (なければ None)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            value = self._pending.pop(key, None)
+            if value is not None:
+                self._last_take[key] = now
+                self.taken += 1
+            return value
+
+    def forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+            self._last_take.pop(key, None)
+
+
+manual_update_coalescer = LatestValueCoalescer(MANUAL_UPDATE_MAX_RATE)
+
+# --- Flaskルーティング ---
+@app.route("/", methods=["GET"])
+def index():
+    """ index.htmlをレンダリング """
+    return render_template("index.html")
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """ターンごとの処理時間のヒストグラム (Prometheus テキスト形式)"""
+    return Response(turn_metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+# --- Socket.IOイベントハンドラ ---
+@socketio.on("user_message")
+def handle_message(data):
+    """ ユーザーからのメッセージを処理し、LLM と表情パラメータを返す """
+    start_time = time.time()  # 全体処理開始時間を記録
+    try:
+        validate_user_message(data)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("無効なメッセージ: %s - %s", data, e)
+        emit("error", {"message": INVALID_MESSAGE_ERROR})
+        return
+    generation = start_generation(data, request.sid)
+    try:
+        run_chat_turn(data, generation, start_time)
+    finally:
+        generation_registry.finish(generation)
+
+
+def run_chat_turn(data, generation, start_time):
+    """1ターン分の処理 (generation が中断されたらストリームを閉じて途中までの返答で終える)"""
+    flusher = None
+    try:
+        session_id, session = start_session_turn(data)
+        messages = build_chat_messages(session)
+        cache_key, cached = lookup_cached_response(session)
+        turn = ChatTurn(previous_emotion=session["last_emotion"])
+        if cached is not None:
+            turn.cache_hit = True
+            response = response_cache.replay(cached)
+        else:
+            turn.cache_hit = False if cache_key is not None else None
+            send_turn_events(turn, provisional_expression_events(turn, session), emit)
+            response = generate_reply(messages, turn)
+
+        # タイマーからの送信はリクエストの外なので、送り先を明示する
+        flusher = StreamFlusher(turn, lambda event, payload: socketio.emit(event, payload, to=generation.sid))
+        stream = CancellableStream(response, generation)
+        for chunk in stream:
+            with flusher.lock:
+                send_turn_events(turn, turn.feed_chunk(chunk), emit)
+        if stream.cancelled:
+            # 新しい発話が届いた・切断された: 溜めていた返答を送り、残りは生成させない
+            with flusher.lock:
+                send_turn_events(turn, turn.flush_stream(), emit)
+            turn.interrupt(generation.cancel_reason, generation.cancel_time)
 
         # ストリーム終了処理
-        llm_end_time = time.time()  # LLM処理終了時間を記録
-        
-        # バッファにテキストが残っている (＝EMOTIONが見つからないまま終わった)
-        if not emotion_sent and buffer:
-            print("--- 警告: EMOTION行が見つからないままストリームが終了しました。 ---")
-            # EMOTION行がチャットに表示されるかもしれないが、テキストは送信する
-            emit("bot_stream", {"chunk": buffer})
-            full_text += buffer
-
-        # 今回の感情座標をフロントエンドに送信
-        current_emotion = None
-        if v_val is not None and a_val is not None and emotion_label is not None:
-            current_emotion = {"v": v_val, "a": a_val, "label": emotion_label}
-            
-        emit("bot_stream_end", {
-            "text": full_text.strip(),
-            "emotion": current_emotion
-        })
-        
+        flusher.stop()
+        with flusher.lock:
+            send_turn_events(turn, turn.finish(), emit)
+        finish_session_turn(session, turn)
+        if cached is None:
+            store_cached_response(cache_key, turn)
+
         # 会話データをCSVに保存
-        # if len(messages) > 1:  # systemメッセージを除いた最後のユーザーメッセージを取得
-        #     user_msg = messages[-1]['content'] if messages[-1]['role'] == 'user' else ''
-        #     # セッションIDを取得または生成
-        #     session_id = data.get('session_id')
-        #     if not session_id:
-        #         session_id = str(uuid.uuid4())
-        #         print(f"--- 新しいセッションID生成: {session_id[:8]} ---")
-        #     save_conversation_to_csv(session_id, user_msg, full_text.strip(), v_val, a_val, emotion_label)
-        
-        # 処理時間を表形式で出力
-        end_time = time.time()
-        total_time = end_time - start_time
-        llm_time = llm_end_time - llm_start_time if llm_start_time and llm_end_time else 0
-        param_time = param_end_time - param_start_time if param_start_time and param_end_time else 0
-        
-        # print_timing_table(total_time, llm_time, param_time)
-        
-        # EMOTION情報と応答を一緒に出力
-        if 'emotion_line' in locals() and emotion_line:
-            print(f"[Bot] {emotion_line}")
-        elif 'v_val' in locals() and 'a_val' in locals() and 'emotion_label' in locals():
-            print(f"[Bot] <emotion v=\"{v_val}\" a=\"{a_val}\">{emotion_label}</emotion>")
-        
-        # 画面表示用にクリーンアップしたテキストも出力
-        clean_text = full_text.strip()
-        # <thought>...</thought>を除去
-        clean_text = re.sub(r'<thought>.*?</thought>\s*', '', clean_text, flags=re.DOTALL)
-        # <emotion>...</emotion>を除去  
-        clean_text = re.sub(r'<emotion[^>]*>.*?</emotion>\s*', '', clean_text, flags=re.DOTALL)
-        clean_text = clean_text.strip()
-        
-        print(f"[Bot] {clean_text}")
+        if SAVE_CONVERSATION_LOG:
+            save_turn_to_csv(session_id, messages, turn)
 
-    except Exception as e:
-        print(f"エラーが発生しました: {e}")
+        turn.log_result()
+        record = turn.metrics_record(session_id, start_time)
+        turn_metrics.observe_turn(record)
+        log_turn(record)
+
+    except Exception:
+        logger.exception("エラーが発生しました")
+    finally:
+        if flusher is not None:
+            flusher.stop()
+
+def save_emotion_data(data):
+    """表情データを1行、書き込みキューに入れる (ヘッダーにない列があれば ValueError)"""
+    data_writer.write(data_targets["emotion"], CSV_HEADERS, data)
 
 @socketio.on('save_data')
 def handle_save_data(data):
     """ フロントエンドから受信したデータをCSVに保存 """
-    print("--- CSV保存リクエスト受信 ---")
-    print(data)
+    logger.debug("CSV保存リクエスト受信: %s", data)
     
-    # ファイルが存在しない場合はヘッダーを書き込む
-    file_exists = os.path.isfile(CSV_FILE_PATH)
     try:
-        with open(CSV_FILE_PATH, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(data)
-        print(f"--- データが {CSV_FILE_PATH} に保存されました ---")
+        save_emotion_data(data)
+        logger.debug("データを %s への書き込みキューに入れました", data_targets["emotion"])
         emit('save_success', {'message': 'データは正常に保存されました。'})
     except Exception as e:
-        print(f"--- CSV保存エラー: {e} ---")
+        logger.error("CSV保存エラー: %s", e)
         emit('save_error', {'message': str(e)})
 
 def save_conversation_to_csv(session_id, user_message, bot_response, v_val, a_val, emotion_label):
-    """会話データをCSVに保存する関数"""
+    """会話データを1行、書き込みキューに入れる"""
     try:
-        import time
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-        
-        # ファイルが存在しない場合はヘッダーを書き込む
-        file_exists = os.path.isfile(CONVERSATION_CSV_PATH)
-        
-        with open(CONVERSATION_CSV_PATH, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=CONVERSATION_CSV_HEADERS)
-            if not file_exists:
-                writer.writeheader()
-            
-            conversation_data = {
-                'session_id': session_id,
-                'timestamp': timestamp,
-                'user_message': user_message,
-                'bot_response': bot_response,
-                'emotion_v': v_val if v_val is not None else '',
-                'emotion_a': a_val if a_val is not None else '',
-                'emotion_label': emotion_label if emotion_label is not None else ''
-            }
-            writer.writerow(conversation_data)
-        
-        print(f"--- 会話データが {CONVERSATION_CSV_PATH} に保存されました (セッション: {session_id[:8]}) ---")
-        
+        conversation_data = {
+            'session_id': session_id,
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'user_message': user_message,
+            'bot_response': bot_response,
+            'emotion_v': v_val if v_val is not None else '',
+            'emotion_a': a_val if a_val is not None else '',
+            'emotion_label': emotion_label if emotion_label is not None else ''
+        }
+        data_writer.write(data_targets["conversation"], CONVERSATION_CSV_HEADERS, conversation_data)
     except Exception as e:
-        print(f"--- 会話CSV保存エラー: {e} ---")
+        logger.error("会話CSV保存エラー: %s", e)
 
 @socketio.on('manual_update_expression')
 def handle_manual_update(data):
-    """ コンソールからの手動での表情更新 """
+    """ コンソールからの手動での表情更新 (MANUAL_UPDATE_MAX_RATE 回/秒に間引く) """
     try:
-        v_val = float(data['v'])
-        a_val = float(data['a'])
-        print(f"--- 手動更新: V={v_val}, A={a_val} ---")
-
-        params = get_interpolated_expression(v_val, a_val)
-        param_names = [
-            "eyeOpenness", "pupilSize", "pupilAngle", "upperEyelidAngle",
-            "upperEyelidCoverage", "lowerEyelidCoverage", "mouthCurve",
-            "mouthHeight", "mouthWidth"
-        ]
-        param_dict = {name: val for name, val in zip(param_names, params)}
-
-        emit("update_expression", param_dict)
-        print(f"--- 表情パラメータを送信 (手動) ---")
-    except (ValueError, KeyError) as e:
-        print(f"--- 手動更新エラー: 無効なデータ {data} - {e} ---")
+        v_val, a_val = parse_manual_expression(data)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("手動更新エラー: 無効なデータ %s - %s", data, e)
+        return
+    logger.debug("手動更新: V=%s, A=%s", v_val, a_val)
+
+    sid = request.sid
+    delay = manual_update_coalescer.offer(sid, (v_val, a_val))
+    if delay == 0.0:
+        emit_manual_update(sid)
+    elif delay is not None:
+        socketio.start_background_task(emit_manual_update_later, sid, delay)
+
+def emit_manual_update(sid):
+    """溜まっている最新の手動更新を計算して送る"""
+    value = manual_update_coalescer.take(sid)
+    if value is None:
+        return
+    params = compute_expression(*value)
+    socketio.emit("update_expression", params_to_dict(params), to=sid)
+
+def emit_manual_update_later(sid, delay):
+    socketio.sleep(delay)
+    emit_manual_update(sid)
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    manual_update_coalescer.forget(request.sid)
+    generation_registry.cancel_sid(request.sid)
 
 # --- サーバー起動 ---
 if __name__ == "__main__":
-    print("サーバーを http://127.0.0.1:5000 で起動します")
+    prepare_server()
+    logger.info("サーバーを http://127.0.0.1:5000 で起動します")
     socketio.run(app, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
@@ -0,0 +1,392 @@
+"""ASGI版サーバー (asyncio + 非同期Ollamaクライアント)
+
+起動方法:
+    uvicorn asgi_app:asgi_app --host 127.0.0.1 --port 5000
+または:
+    python asgi_app.py
+
+チャット処理は app.py の ChatTurn / build_chat_messages / llm_backend を共有し、
+LLMの生成は MAX_CONCURRENT_GENERATIONS 件まで同時に実行する。
+上限を超えたリクエストには queue_position イベントで待ち順を通知する。
+"""
+import asyncio
+import time
+
+import socketio
+
+from app import (
+    EMOTION_MODE,
+    INVALID_MESSAGE_ERROR,
+    MANUAL_UPDATE_MAX_RATE,
+    SAVE_CONVERSATION_LOG,
+    SOCKETIO_CHANNEL,
+    SOCKETIO_MESSAGE_QUEUE,
+    THOUGHT_TOKEN_BUDGET,
+    ChatTurn,
+    LatestValueCoalescer,
+    build_chat_messages,
+    compute_expression,
+    continuation_messages,
+    data_targets,
+    emotion_tag_from_json,
+    fast_emotion_request,
+    finish_session_turn,
+    generation_registry,
+    llm_backend,
+    llm_chat_kwargs,
+    log_turn,
+    logger,
+    lookup_cached_response,
+    params_to_dict,
+    parse_manual_expression,
+    prepare_server,
+    provisional_expression_events,
+    response_cache,
+    save_emotion_data,
+    save_turn_to_csv,
+    start_session_turn,
+    store_cached_response,
+    text_chunk,
+    thought_closing,
+    turn_metrics,
+    validate_user_message,
+    wait_for_previous_turn,
+)
+from message_queue import create_client_manager
+
+# --- 定数 ---
+# 同時に実行するLLM生成の上限
+MAX_CONCURRENT_GENERATIONS = 4
+
+# --- Socket.IO (ASGI) の初期化 ---
+client_manager = None
+if SOCKETIO_MESSAGE_QUEUE:
+    # 複数ワーカー構成: 他のワーカーに接続しているクライアントへの送信はメッセージキューで中継する
+    client_manager = create_client_manager(SOCKETIO_MESSAGE_QUEUE, SOCKETIO_CHANNEL, async_mode=True)
+sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*", client_manager=client_manager)
+
+
+async def on_startup():
+    """lifespan の startup (uvicorn asgi_app:asgi_app や workers.py で起動したときも、待ち受け前に準備する)"""
+    await asyncio.to_thread(prepare_server)
+
+
+asgi_app = socketio.ASGIApp(sio, other_asgi_app=turn_metrics.asgi_app(), static_files={
+    "/": "index.html",
+    "/static": "static",
+}, on_startup=on_startup)
+
+# --- 生成枠の管理 ---
+_generation_slots = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+_waiting = []  # 生成枠を待っているリクエスト [(token, sid), ...] (先頭ほど先に実行される)
+
+
+async def notify_queue_positions():
+    """待機中の全リクエストに現在の待ち順を通知する"""
+    for position, (_, sid) in enumerate(_waiting, start=1):
+        await sio.emit("queue_position", {"position": position}, to=sid)
+
+
+async def send_turn_events(turn, events, sid):
+    """ChatTurn が返したイベントを送信し、送信にかかった時間を記録する"""
+    for event, payload in events:
+        start = time.time()
+        await sio.emit(event, payload, to=sid)
+        turn.emit_time += time.time() - start
+
+
+class StreamFlushTimer:
+    """app.StreamFlusher の非同期版: 溜めた bot_stream を送る時刻に loop.call_later で送信を予約する
+
+    チャンクを投入して送るたびに reschedule() で予約し直す。投入・送信は lock の中で行う。
+    """
+
+    def __init__(self, turn, sid):
+        self.turn = turn
+        self.sid = sid
+        self.lock = asyncio.Lock()
+        self._handle = None
+        self._task = None
+
+    def reschedule(self):
+        self.cancel()
+        delay = self.turn.stream_coalescer.delay()
+        if delay is not None and self.turn.stream_coalescer.interval > 0:
+            self._handle = asyncio.get_running_loop().call_later(delay, self._fire)
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _fire(self):
+        self._handle = None
+        self._task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        async with self.lock:
+            await send_turn_events(self.turn, self.turn.flush_stream(), self.sid)
+
+
+async def start_generation(data, sid):
+    """app.start_generation の非同期版 (中断させた前の生成が履歴に書き終わるのをスレッドで待つ)"""
+    generation, previous = generation_registry.start(data.get("session_id") or sid, sid)
+    if previous is not None:
+        await asyncio.to_thread(wait_for_previous_turn, previous)
+    return generation
+
+
+async def close_stream(response):
+    """中断したストリームを閉じる (Ollama への接続を切って生成を止めさせる)"""
+    aclose = getattr(response, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+async def empty_stream():
+    return
+    yield
+
+
+async def generate_reply(messages, turn):
+    """app.generate_reply の非同期版"""
+    kwargs = llm_chat_kwargs()
+    if EMOTION_MODE == "fast":
+        request, options = fast_emotion_request(messages)
+        tag = emotion_tag_from_json(await llm_backend.acomplete(request, **options))
+        if tag is not None:
+            turn.emotion_mode = "fast"
+            yield text_chunk(tag)
+            async for chunk in llm_backend.achat(continuation_messages(messages, tag), think=False, **kwargs):
+                yield chunk
+            return
+        logger.warning("高速モードで感情を取得できなかったため、通常の生成に切り替えます")
+
+    turn.emotion_mode = "thought" if THOUGHT_TOKEN_BUDGET is None else "thought_budget"
+    response = llm_backend.achat(messages, **kwargs)
+    generated = ""
+    cut = False
+    try:
+        async for chunk in response:
+            yield chunk
+            if "message" in chunk:
+                generated += chunk["message"]["content"] or ""
+            if turn.thought_over_budget(THOUGHT_TOKEN_BUDGET):
+                cut = True
+                break
+    finally:
+        await close_stream(response)
+    if not cut:
+        return
+    # 思考の予算を使い切った: 思考を閉じて感情タグの書き出しまでを補い、その続きを生成させる
+    turn.thought_cut = True
+    closing = thought_closing(generated)
+    yield text_chunk(closing)
+    async for chunk in llm_backend.achat(continuation_messages(messages, generated + closing), **kwargs):
+        yield chunk
+
+
+async def acquire_generation_slot(sid, generation):
+    """生成枠を1つ確保して True を返す。空きがなければ待ち順を通知しながら待つ
+
+    待っている間に generation が中断されたら (新しい発話・切断)、すぐに待ち行列から外れて False を返す。
+    """
+    if generation.cancelled:
+        return False
+    if not _waiting and not _generation_slots.locked():
+        await _generation_slots.acquire()
+        return True
+
+    entry = (object(), sid)
+    _waiting.append(entry)
+    loop = asyncio.get_running_loop()
+    cancelled = asyncio.Event()
+    generation.add_cancel_callback(lambda: loop.call_soon_threadsafe(cancelled.set))
+    acquire = asyncio.ensure_future(_generation_slots.acquire())
+    cancel_wait = asyncio.ensure_future(cancelled.wait())
+    acquired = False
+    try:
+        await sio.emit("queue_position", {"position": len(_waiting)}, to=sid)
+        await asyncio.wait((acquire, cancel_wait), return_when=asyncio.FIRST_COMPLETED)
+        acquired = acquire.done() and not acquire.cancelled()
+    finally:
+        cancel_wait.cancel()
+        if not acquired:
+            if acquire.done() and not acquire.cancelled():
+                _generation_slots.release()  # 確保と同時に例外・キャンセルになった
+            else:
+                acquire.cancel()
+        _waiting.remove(entry)
+
+    try:
+        await notify_queue_positions()
+        if acquired:
+            # 待ちが解消したことを通知 (0 = 生成開始)
+            await sio.emit("queue_position", {"position": 0}, to=sid)
+    except BaseException:
+        # 通知に失敗しても確保した枠は返す
+        if acquired:
+            _generation_slots.release()
+        raise
+    return acquired
+
+
+# --- Socket.IOイベントハンドラ ---
+@sio.on("user_message")
+async def handle_message(sid, data):
+    """ユーザーからのメッセージを非同期に処理し、LLM と表情パラメータを返す"""
+    start_time = time.time()
+    try:
+        validate_user_message(data)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("無効なメッセージ: %s - %s", data, e)
+        await sio.emit("error", {"message": INVALID_MESSAGE_ERROR}, to=sid)
+        return
+    generation = await start_generation(data, sid)
+    try:
+        await run_chat_turn(sid, data, generation, start_time)
+    finally:
+        generation_registry.finish(generation)
+
+
+async def run_chat_turn(sid, data, generation, start_time):
+    """1ターン分の処理 (generation が中断されたらストリームを閉じて途中までの返答で終える)
+
+    セッションの保存先 (SQLite / Redis) と保存済みの会話の読み出しは同期I/Oなので、スレッドで実行する。
+    """
+    acquired = False
+    flush_timer = None
+    streaming = None
+    try:
+        session_id, session = await asyncio.to_thread(start_session_turn, data)
+        messages = build_chat_messages(session)
+        cache_key, cached = lookup_cached_response(session)
+        turn = ChatTurn(previous_emotion=session["last_emotion"])
+        if cached is None:
+            # 仮の表情はLLMを待たずに出すものなので、生成枠を待つ前に送る
+            await send_turn_events(turn, provisional_expression_events(turn, session), sid)
+
+        # キャッシュから再生するターンはLLMを使わないので、生成枠を待たない
+        queue_wait = None
+        if cached is None:
+            queue_start_time = time.time()
+            acquired = await acquire_generation_slot(sid, generation)
+            queue_wait = time.time() - queue_start_time
+            turn.start_llm()
+
+        if cached is not None:
+            turn.cache_hit = True
+            response = response_cache.areplay(cached)
+        elif generation.cancelled:
+            # 生成枠を待っている間 (または確保した直後) に中断された: LLMは呼ばずに空の返答で終える
+            turn.interrupt(generation.cancel_reason, generation.cancel_time)
+            response = empty_stream()
+        else:
+            turn.cache_hit = False if cache_key is not None else None
+            response = generate_reply(messages, turn)
+        flush_timer = StreamFlushTimer(turn, sid)
+
+        async def stream_reply():
+            async for chunk in response:
+                async with flush_timer.lock:
+                    await send_turn_events(turn, turn.feed_chunk(chunk), sid)
+                    flush_timer.reschedule()
+
+        # 中断されたらストリームの読み出しをタスクごと取り消す (プロンプトの評価中や高速モードの感情の取得中でも
+        # Ollama へのリクエストがその場で切れる)
+        streaming = asyncio.ensure_future(stream_reply())
+        loop = asyncio.get_running_loop()
+        generation.add_cancel_callback(lambda: loop.call_soon_threadsafe(streaming.cancel))
+        await asyncio.wait((streaming,))
+        if streaming.cancelled():
+            # 新しい発話が届いた・切断された: 溜めていた返答を送り、残りは生成させない
+            flush_timer.cancel()
+            async with flush_timer.lock:
+                await send_turn_events(turn, turn.flush_stream(), sid)
+            await close_stream(response)
+            turn.interrupt(generation.cancel_reason, generation.cancel_time)
+        else:
+            streaming.result()
+
+        flush_timer.cancel()
+        async with flush_timer.lock:
+            await send_turn_events(turn, turn.finish(), sid)
+        await asyncio.to_thread(finish_session_turn, session, turn)
+        if cached is None:
+            store_cached_response(cache_key, turn)
+        if SAVE_CONVERSATION_LOG:
+            save_turn_to_csv(session_id, messages, turn)
+        turn.log_result()
+        record = turn.metrics_record(session_id, start_time, queue_wait)
+        turn_metrics.observe_turn(record)
+        log_turn(record)
+
+    except Exception:
+        logger.exception("エラーが発生しました")
+    finally:
+        if streaming is not None:
+            streaming.cancel()
+        if flush_timer is not None:
+            flush_timer.cancel()
+        if acquired:
+            _generation_slots.release()
+
+
+manual_update_coalescer = LatestValueCoalescer(MANUAL_UPDATE_MAX_RATE)
+
+
+@sio.on("manual_update_expression")
+async def handle_manual_update(sid, data):
+    """コンソールからの手動での表情更新 (MANUAL_UPDATE_MAX_RATE 回/秒に間引く)"""
+    try:
+        v_val, a_val = parse_manual_expression(data)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("手動更新エラー: 無効なデータ %s - %s", data, e)
+        return
+    logger.debug("手動更新: V=%s, A=%s", v_val, a_val)
+
+    delay = manual_update_coalescer.offer(sid, (v_val, a_val))
+    if delay == 0.0:
+        await emit_manual_update(sid)
+    elif delay is not None:
+        sio.start_background_task(emit_manual_update_later, sid, delay)
+
+
+async def emit_manual_update(sid):
+    """溜まっている最新の手動更新を計算して送る"""
+    value = manual_update_coalescer.take(sid)
+    if value is None:
+        return
+    params = compute_expression(*value)
+    await sio.emit("update_expression", params_to_dict(params), to=sid)
+
+
+async def emit_manual_update_later(sid, delay):
+    await asyncio.sleep(delay)
+    await emit_manual_update(sid)
+
+
+@sio.on("disconnect")
+async def handle_disconnect(sid, *args):
+    manual_update_coalescer.forget(sid)
+    generation_registry.cancel_sid(sid)
+
+
+@sio.on("save_data")
+async def handle_save_data(sid, data):
+    """フロントエンドから受信したデータをCSVに保存 (書き込みはバックグラウンドスレッドが行う)"""
+    try:
+        save_emotion_data(data)
+        logger.debug("データを %s への書き込みキューに入れました", data_targets["emotion"])
+        await sio.emit("save_success", {"message": "データは正常に保存されました。"}, to=sid)
+    except Exception as e:
+        logger.error("CSV保存エラー: %s", e)
+        await sio.emit("save_error", {"message": str(e)}, to=sid)
+
+
+# --- サーバー起動 ---
+if __name__ == "__main__":
+    import uvicorn
+
+    logger.info("ASGIサーバーを http://127.0.0.1:5000 で起動します")
+    uvicorn.run(asgi_app, host="127.0.0.1", port=5000)
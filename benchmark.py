@@ -0,0 +1,290 @@
+"""レイテンシ計測用ベンチマーク
+
+scripted バックエンド (録音済み応答の再生) を使ってサーバーをこのプロセス内で起動し、
+Socket.IO クライアントで user_message → update_expression → bot_stream → bot_stream_end の
+経路を同時セッション数を変えながら計測する。表情計算とタグ解析のマイクロベンチマークも行い、
+結果をJSONに保存する。--compare で以前の結果と比較できる。
+
+使い方:
+    python benchmark.py --concurrency 1,4,16 --turns 5 --output bench.json
+    python benchmark.py --server asgi --compare bench_before.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+# サーバー側は必ず scripted バックエンドで動かす
+os.environ["LLM_BACKEND"] = "scripted"
+
+import numpy as np
+import socketio
+
+import app
+
+PERCENTILES = (50, 95, 99)
+# E2E計測の指標名
+E2E_METRICS = ("time_to_expression", "time_to_first_chunk", "turn_time")
+
+
+# --- 集計 ---
+def summarize(samples):
+    """サンプル列から p50/p95/p99 などの統計値を求める"""
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples, dtype=float)
+    summary = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    summary.update({"mean": float(values.mean()), "max": float(values.max()), "count": int(len(values))})
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- マイクロベンチマーク ---
+def time_per_call(func, repeat):
+    """func を repeat 回呼んだときの1回あたりの秒数"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def run_micro_benchmarks(repeat):
+    """表情計算とタグ解析の1回あたりの処理時間を測る"""
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-1, 1, (repeat, 2))
+    batch = rng.uniform(-1, 1, (100_000, 2))
+    response = app.llm_backend.responses[0]
+    chunks = app.llm_backend.tokenize(response)
+
+    def parse_response():
+        parser = app.EmotionStreamParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.finish()
+
+    it = iter(points.tolist() * 2)
+    results = {
+        "get_interpolated_expression": time_per_call(lambda: app.get_interpolated_expression(*next(it)), repeat),
+        "compute_expression": time_per_call(lambda: app.compute_expression(*next(it)), repeat),
+        "get_interpolated_expressions_100k": time_per_call(lambda: app.get_interpolated_expressions(batch), 5),
+        "emotion_stream_parser_per_response": time_per_call(parse_response, max(1, repeat // 10)),
+    }
+    return {name: {"seconds": seconds} for name, seconds in results.items()}
+
+
+# --- サーバー起動 ---
+def start_server(kind, port):
+    """サーバーをデーモンスレッドで起動する"""
+    if kind == "asgi":
+        import uvicorn
+        import asgi_app
+
+        server = uvicorn.Server(uvicorn.Config(asgi_app.asgi_app, host="127.0.0.1", port=port, log_level="warning"))
+        target = server.run
+    else:
+        def target():
+            app.socketio.run(app.app, host="127.0.0.1", port=port, allow_unsafe_werkzeug=True,
+                             use_reloader=False, log_output=False)
+    threading.Thread(target=target, daemon=True).start()
+    wait_for_server(port)
+
+
+def wait_for_server(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        probe = socketio.Client()
+        try:
+            probe.connect(f"http://127.0.0.1:{port}", wait_timeout=1)
+            probe.disconnect()
+            return
+        except socketio.exceptions.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"サーバーが {timeout} 秒以内に起動しませんでした")
+
+
+# --- シミュレーションクライアント ---
+class SimulatedSession:
+    """1セッション分のクライアント。turns 回発話し、各ターンのイベント到着時刻を記録する"""
+
+    def __init__(self, url, session_id, user_messages, turns, timeout):
+        self.url = url
+        self.session_id = session_id
+        self.user_messages = user_messages
+        self.turns = turns
+        self.timeout = timeout
+        self.samples = {name: [] for name in E2E_METRICS}
+        self.errors = 0
+        self._sio = socketio.Client()
+        self._done = threading.Event()
+        self._sent_at = None
+        self._expression_at = None
+        self._first_chunk_at = None
+        self._sio.on("update_expression", self._on_expression)
+        self._sio.on("expression_trajectory", self._on_expression)
+        self._sio.on("bot_stream", self._on_stream)
+        self._sio.on("bot_stream_end", self._on_end)
+
+    def _on_expression(self, data):
+        if self._expression_at is None:
+            self._expression_at = time.perf_counter()
+
+    def _on_stream(self, data):
+        if self._first_chunk_at is None:
+            self._first_chunk_at = time.perf_counter()
+
+    def _on_end(self, data):
+        end = time.perf_counter()
+        if self._expression_at is not None:
+            self.samples["time_to_expression"].append(self._expression_at - self._sent_at)
+        if self._first_chunk_at is not None:
+            self.samples["time_to_first_chunk"].append(self._first_chunk_at - self._sent_at)
+        self.samples["turn_time"].append(end - self._sent_at)
+        self._done.set()
+
+    def run(self):
+        self._sio.connect(self.url, wait_timeout=10)
+        try:
+            for turn in range(self.turns):
+                self._done.clear()
+                self._expression_at = None
+                self._first_chunk_at = None
+                self._sent_at = time.perf_counter()
+                self._sio.emit("user_message", {
+                    "message": self.user_messages[turn % len(self.user_messages)],
+                    "session_id": self.session_id,
+                })
+                if not self._done.wait(self.timeout):
+                    self.errors += 1
+        finally:
+            self._sio.disconnect()
+
+
+def run_e2e(urls, concurrency, turns, user_messages, timeout):
+    """concurrency 個のセッションを同時に走らせて各指標を集計する
+
+    urls が複数ある場合 (複数ワーカー構成)、各セッションは1つのワーカーに固定して振り分ける。
+    """
+    rng = random.Random(concurrency)
+    sessions = [
+        SimulatedSession(urls[i % len(urls)], f"bench_{concurrency}_{i}", rng.sample(user_messages, len(user_messages)),
+                         turns, timeout)
+        for i in range(concurrency)
+    ]
+    threads = [threading.Thread(target=session.run) for session in sessions]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = {name: summarize([x for s in sessions for x in s.samples[name]]) for name in E2E_METRICS}
+    completed = result["turn_time"]["count"]
+    result["errors"] = sum(s.errors for s in sessions)
+    result["throughput_turns_per_sec"] = completed / elapsed if elapsed > 0 else 0.0
+    return result
+
+
+def load_user_messages(path):
+    """会話ログからユーザー発話を集める (なければ固定の発話を使う)"""
+    import csv
+
+    messages = []
+    with contextlib.suppress(OSError):
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            messages = [row[-5] for row in reader if len(row) >= 6 and row[-5]]
+    return messages or ["こんにちは", "今日は疲れたよ", "やった！合格したんだ！"]
+
+
+# --- 比較と表示 ---
+def print_report(results, baseline=None):
+    print("\n=== マイクロベンチマーク (1回あたり) ===")
+    for name, value in results["micro"].items():
+        line = f"{name:<40} {value['seconds'] * 1e6:>12.2f} us"
+        if baseline and name in baseline.get("micro", {}):
+            before = baseline["micro"][name]["seconds"]
+            line += f"   (前回 {before * 1e6:.2f} us, {value['seconds'] / before:.2f}x)" if before else ""
+        print(line)
+
+    print("\n=== E2E レイテンシ (秒) ===")
+    print(f"{'同時数':>6} | {'指標':<22} | {'p50':>8} | {'p95':>8} | {'p99':>8} | {'前回p95':>8}")
+    print("-" * 76)
+    for concurrency, metrics in results["e2e"].items():
+        for name in E2E_METRICS:
+            stats = metrics[name]
+            if not stats["count"]:
+                continue
+            before = baseline.get("e2e", {}).get(concurrency, {}).get(name, {}).get("p95") if baseline else None
+            before_text = f"{before:8.4f}" if before is not None else f"{'-':>8}"
+            print(f"{concurrency:>6} | {name:<22} | {stats['p50']:8.4f} | {stats['p95']:8.4f} | {stats['p99']:8.4f} | {before_text}")
+        print(f"{concurrency:>6} | {'throughput (turn/s)':<22} | {metrics['throughput_turns_per_sec']:8.2f} | errors: {metrics['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=("sync", "asgi"), default="sync", help="計測するサーバー")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--url", help="起動済みのサーバーの URL (カンマ区切りで複数ワーカー)。指定するとサーバーを起動しない")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="同時セッション数 (カンマ区切り)")
+    parser.add_argument("--turns", type=int, default=5, help="1セッションあたりのターン数")
+    parser.add_argument("--ttft", type=float, default=0.2, help="stand-in LLM の最初のトークンまでの秒数")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="stand-in LLM のトークン/秒")
+    parser.add_argument("--timeout", type=float, default=60.0, help="1ターンのタイムアウト秒数")
+    parser.add_argument("--micro-repeat", type=int, default=2000, help="マイクロベンチマークの繰り返し回数")
+    parser.add_argument("--skip-e2e", action="store_true", help="マイクロベンチマークだけを行う")
+    parser.add_argument("--output", default="benchmark_results.json", help="結果を保存するJSONファイル")
+    parser.add_argument("--compare", help="比較する以前の結果JSON")
+    parser.add_argument("--server-log", action="store_true", help="サーバーの INFO ログ (1ターン1行) を表示する")
+    args = parser.parse_args()
+
+    app.llm_backend.time_to_first_token = args.ttft
+    app.llm_backend.token_rate = args.token_rate
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": vars(args),
+        "micro": {},
+        "e2e": {},
+    }
+    if not args.server_log:
+        app.logger.setLevel(logging.WARNING)
+    results["micro"] = run_micro_benchmarks(args.micro_repeat)
+    if not args.skip_e2e:
+        if args.url:
+            urls = args.url.split(",")
+        else:
+            start_server(args.server, args.port)
+            urls = [f"http://127.0.0.1:{args.port}"]
+        user_messages = load_user_messages(app.CONVERSATION_CSV_PATH)
+        for concurrency in (int(c) for c in args.concurrency.split(",")):
+            results["e2e"][str(concurrency)] = run_e2e(urls, concurrency, args.turns, user_messages, args.timeout)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を {args.output} に保存しました")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,407 @@
+"""会話ログ・表情データの列指向エクスポート
+
+emotion_data.csv / conversation_data.csv を列ごとの型付き配列に変換し、オフライン分析で
+CSV を毎回解析しなくても読み込めるようにする。
+
+レイアウト (format="npy"):
+    <out_dir>/<table>/manifest.json                 取り込み済みのCSVのバイト位置とチャンク一覧
+    <out_dir>/<table>/chunk_000000/meta.json        行数とカテゴリ列の語彙
+    <out_dir>/<table>/chunk_000000/<列>.npy         float32 (数値列), datetime64[s] (timestamp),
+                                                    int32 (カテゴリ列のコード)
+    <out_dir>/<table>/chunk_000000/<列>.bytes       自由文の UTF-8 を連結したもの
+    <out_dir>/<table>/chunk_000000/<列>.offsets.npy 自由文の各行の開始位置 (int64, 行数+1)
+
+export は CSV のうち前回までに取り込んでいない部分だけを新しいチャンクとして追記し、
+compact は複数のチャンクを1つにまとめる。load は配列を memmap で開く (チャンクが1つならコピーしない)。
+pyarrow がある場合は format="parquet" でチャンクを Parquet ファイルとして書くこともできる。
+
+使い方:
+    python columnar_store.py export --out logs_columnar
+    python columnar_store.py compact --out logs_columnar
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import operator
+import os
+import shutil
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+
+from sqlite_store import TABLES, conversation_row_to_dict
+
+logger = logging.getLogger("emotion_chat.persistence")
+
+# --- スキーマ ---
+FLOAT32 = "float32"      # 数値列 (欠損は NaN)
+DATETIME = "datetime"    # 時刻 (datetime64[s], 解析できない値は NaT)
+CATEGORY = "category"    # 種類の少ない文字列 (コード + 語彙)
+TEXT = "text"            # 自由文
+
+TEXT_COLUMNS = ("user_message", "bot_response")
+
+
+def column_kind(name, sql_type):
+    if name == "timestamp":
+        return DATETIME
+    if name in TEXT_COLUMNS:
+        return TEXT
+    return FLOAT32 if sql_type == "REAL" else CATEGORY
+
+
+# 列名と種類は SQLite ストアのスキーマに合わせる
+SCHEMAS = {table: {name: column_kind(name, sql_type) for name, sql_type in columns}
+           for table, columns in TABLES.items()}
+DEFAULT_SOURCES = {"emotion_data": "emotion_data.csv", "conversations": "conversation_data.csv"}
+
+# export で1チャンクに入れる最大行数
+CHUNK_ROWS = 1_000_000
+FORMATS = ("npy", "parquet")
+
+
+class TextColumn:
+    """自由文の列 (UTF-8 を連結したバイト列と各行の開始位置)。要素は読むときにデコードする"""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, values):
+        encoded = [value.encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    @classmethod
+    def concatenate(cls, columns):
+        data = np.concatenate([c.data for c in columns]) if columns else np.zeros(0, dtype=np.uint8)
+        offsets = [np.zeros(1, dtype=np.int64)]
+        base = 0
+        for c in columns:
+            offsets.append(c.offsets[1:] - c.offsets[0] + base)
+            base += int(c.offsets[-1] - c.offsets[0])
+        return cls(data, np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        # list と同じく負の添字は末尾から数え、範囲外は IndexError にする
+        index = operator.index(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("TextColumn index out of range")
+        return bytes(self.data[self.offsets[index]:self.offsets[index + 1]]).decode("utf-8")
+
+    def tolist(self):
+        return [self[i] for i in range(len(self))]
+
+
+# --- CSVの読み込みと型変換 ---
+def read_new_rows(path, offset):
+    """CSV の offset バイト目以降の完全な行を読み、(ヘッダー, 行のリスト, 次回の offset) を返す
+
+    書きかけの最終行 (改行で終わっていない部分) は次回に回す。
+    """
+    with open(path, "rb") as f:
+        header = next(csv.reader([f.readline().decode("utf-8")]), [])
+        if offset == 0:
+            offset = f.tell()
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    rows = list(csv.reader(io.StringIO(data[:end].decode("utf-8"), newline="")))
+    return header, rows, offset + end
+
+
+def rows_to_records(table, header, rows):
+    """CSVの行を列名つきの dict にする (会話ログは新旧のスキーマを揃える)"""
+    if table == "conversations":
+        records = [conversation_row_to_dict(row) for row in rows]
+        skipped = sum(record is None for record in records)
+        if skipped:
+            logger.warning("列数が不正な %d 行を読み飛ばしました", skipped)
+        return [record for record in records if record is not None]
+    return [dict(zip(header, row)) for row in rows]
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parse_timestamp(value):
+    """'YYYY-MM-DD HH:MM:SS' や ISO 8601 (末尾 Z・ミリ秒つき) の時刻を datetime64[s] にする"""
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return np.datetime64("NaT", "s")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(parsed, "s")
+
+
+def build_columns(schema, records):
+    """dict の行リストを {列名: 配列} にする (カテゴリ列は文字列の object 配列)"""
+    columns = {}
+    for name, kind in schema.items():
+        values = [record.get(name) or "" for record in records]
+        if kind == FLOAT32:
+            columns[name] = np.array([parse_float(v) for v in values], dtype=np.float32)
+        elif kind == DATETIME:
+            columns[name] = np.array([parse_timestamp(v) for v in values], dtype="datetime64[s]")
+        elif kind == TEXT:
+            columns[name] = TextColumn.from_strings(values)
+        else:
+            columns[name] = np.array(values, dtype=object)
+    return columns
+
+
+def column_length(columns):
+    return len(next(iter(columns.values()))) if columns else 0
+
+
+# --- チャンクの書き込み・読み込み ---
+def write_npy_chunk(chunk_dir, schema, columns):
+    os.makedirs(chunk_dir)
+    meta = {"rows": column_length(columns), "categories": {}}
+    for name, kind in schema.items():
+        column = columns[name]
+        base = os.path.join(chunk_dir, name)
+        if kind == TEXT:
+            column.data.tofile(base + ".bytes")
+            np.save(base + ".offsets.npy", column.offsets)
+        elif kind == CATEGORY:
+            categories, codes = np.unique(column.astype(str), return_inverse=True)
+            meta["categories"][name] = categories.tolist()
+            np.save(base + ".npy", codes.astype(np.int32))
+        else:
+            np.save(base + ".npy", column)
+    # meta.json はチャンクの最後に書く (これがあるチャンクは書き込みが完了している)
+    with open(os.path.join(chunk_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+
+def read_npy_chunk(chunk_dir, schema, names, mmap):
+    mmap_mode = "r" if mmap else None
+    with open(os.path.join(chunk_dir, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    columns = {}
+    for name in names:
+        kind = schema[name]
+        base = os.path.join(chunk_dir, name)
+        if kind == TEXT:
+            data = (np.memmap(base + ".bytes", dtype=np.uint8, mode="r")
+                    if mmap and os.path.getsize(base + ".bytes") else np.fromfile(base + ".bytes", dtype=np.uint8))
+            columns[name] = TextColumn(data, np.load(base + ".offsets.npy", mmap_mode=mmap_mode))
+        elif kind == CATEGORY:
+            categories = np.array(meta["categories"][name], dtype=object)
+            codes = np.load(base + ".npy", mmap_mode=mmap_mode)
+            columns[name] = categories[codes] if len(categories) else np.array([], dtype=object)
+        else:
+            columns[name] = np.load(base + ".npy", mmap_mode=mmap_mode)
+    return columns
+
+
+def write_parquet_chunk(path, schema, columns):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrays = {}
+    for name, kind in schema.items():
+        column = columns[name]
+        if kind == TEXT:
+            arrays[name] = pa.array(column.tolist(), type=pa.string())
+        elif kind == CATEGORY:
+            arrays[name] = pa.array(column.astype(str).tolist(), type=pa.string()).dictionary_encode()
+        else:
+            arrays[name] = pa.array(column)
+    pq.write_table(pa.table(arrays), path)
+
+
+def read_parquet_chunk(path, schema, names, mmap):
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path, columns=list(names), memory_map=mmap)
+    columns = {}
+    for name in names:
+        kind = schema[name]
+        column = table.column(name)
+        if kind == TEXT:
+            columns[name] = TextColumn.from_strings(column.to_pylist())
+        elif kind == CATEGORY:
+            columns[name] = np.array(column.to_pylist(), dtype=object)
+        elif kind == DATETIME:
+            columns[name] = column.to_numpy().astype("datetime64[s]")
+        else:
+            columns[name] = column.to_numpy().astype(np.float32, copy=False)
+    return columns
+
+
+def concatenate_columns(schema, parts):
+    """チャンクごとの {列名: 配列} を結合する (チャンクが1つならそのまま返す)"""
+    if len(parts) == 1:
+        return parts[0]
+    columns = {}
+    for name in parts[0]:
+        if schema[name] == TEXT:
+            columns[name] = TextColumn.concatenate([part[name] for part in parts])
+        else:
+            columns[name] = np.concatenate([part[name] for part in parts])
+    return columns
+
+
+# --- マニフェスト ---
+def table_dir(out_dir, table):
+    return os.path.join(out_dir, table)
+
+
+def read_manifest(out_dir, table):
+    path = os.path.join(table_dir(out_dir, table), "manifest.json")
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(out_dir, table, manifest):
+    """manifest.json を置き換える (一時ファイルに書いてから rename するので途中の状態は見えない)"""
+    path = os.path.join(table_dir(out_dir, table), "manifest.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def chunk_path(out_dir, table, manifest, chunk):
+    path = os.path.join(table_dir(out_dir, table), chunk["name"])
+    return path + ".parquet" if manifest["format"] == "parquet" else path
+
+
+def write_chunk(out_dir, table, manifest, columns):
+    """新しいチャンクを書き、マニフェストに追加する"""
+    chunk = {"name": f"chunk_{manifest['next_chunk']:06d}", "rows": column_length(columns)}
+    path = chunk_path(out_dir, table, manifest, chunk)
+    if manifest["format"] == "parquet":
+        write_parquet_chunk(path, SCHEMAS[table], columns)
+    else:
+        write_npy_chunk(path, SCHEMAS[table], columns)
+    manifest["chunks"].append(chunk)
+    manifest["next_chunk"] += 1
+
+
+# --- エクスポート・コンパクション・読み込み ---
+def export_table(source, out_dir, table, fmt="npy", chunk_rows=CHUNK_ROWS):
+    """CSV のうちまだ取り込んでいない行をチャンクとして追記し、追加した行数を返す"""
+    if fmt not in FORMATS:
+        raise ValueError(f"未知の形式です: {fmt}")
+    os.makedirs(table_dir(out_dir, table), exist_ok=True)
+    manifest = read_manifest(out_dir, table) or {
+        "table": table, "format": fmt, "source": os.path.abspath(source),
+        "source_offset": 0, "chunks": [], "next_chunk": 0,
+    }
+    if manifest["format"] != fmt:
+        raise ValueError(f"{table} は {manifest['format']} 形式で書き出されています")
+    if os.path.getsize(source) < manifest["source_offset"]:
+        raise ValueError(f"{source} が前回のエクスポートより短くなっています (書き直された場合は --rebuild)")
+
+    header, rows, next_offset = read_new_rows(source, manifest["source_offset"])
+    records = rows_to_records(table, header, rows)
+    for start in range(0, len(records), chunk_rows):
+        write_chunk(out_dir, table, manifest, build_columns(SCHEMAS[table], records[start:start + chunk_rows]))
+    manifest["source_offset"] = next_offset
+    write_manifest(out_dir, table, manifest)
+    return len(records)
+
+
+def load_table(out_dir, table, columns=None, mmap=True):
+    """テーブルを {列名: 配列} で返す
+
+    数値列は float32、timestamp は datetime64[s]、カテゴリ列は文字列の object 配列、
+    自由文は TextColumn。mmap=True ならファイルを memmap で開く (チャンクが1つならコピーしない)。
+    """
+    manifest = read_manifest(out_dir, table)
+    if manifest is None:
+        raise FileNotFoundError(f"{table_dir(out_dir, table)} にエクスポート済みのデータがありません")
+    schema = SCHEMAS[table]
+    names = list(columns) if columns is not None else list(schema)
+    empty = build_columns({name: schema[name] for name in names}, [])
+    parts = []
+    for chunk in manifest["chunks"]:
+        if not chunk["rows"]:
+            continue
+        path = chunk_path(out_dir, table, manifest, chunk)
+        read = read_parquet_chunk if manifest["format"] == "parquet" else read_npy_chunk
+        parts.append(read(path, schema, names, mmap))
+    return concatenate_columns(schema, parts) if parts else empty
+
+
+def compact_table(out_dir, table):
+    """すべてのチャンクを1つにまとめ、まとめた後のチャンク数を返す"""
+    manifest = read_manifest(out_dir, table)
+    if manifest is None or len(manifest["chunks"]) <= 1:
+        return len(manifest["chunks"]) if manifest else 0
+    old_chunks = list(manifest["chunks"])
+    columns = load_table(out_dir, table)
+    manifest["chunks"] = []
+    write_chunk(out_dir, table, manifest, columns)
+    write_manifest(out_dir, table, manifest)
+    # 新しいマニフェストに切り替えてから古いチャンクを消す
+    for chunk in old_chunks:
+        path = chunk_path(out_dir, table, manifest, chunk)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    return 1
+
+
+def default_format():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return "npy"
+    return "parquet"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="CSVの未取り込み部分をチャンクとして追記する")
+    export_parser.add_argument("--out", default="logs_columnar")
+    export_parser.add_argument("--emotions", default=DEFAULT_SOURCES["emotion_data"])
+    export_parser.add_argument("--conversations", default=DEFAULT_SOURCES["conversations"])
+    export_parser.add_argument("--format", choices=FORMATS, help="既定は pyarrow があれば parquet、なければ npy")
+    export_parser.add_argument("--rebuild", action="store_true", help="既存の書き出しを消して最初から作り直す")
+    compact_parser = commands.add_parser("compact", help="チャンクを1つにまとめる")
+    compact_parser.add_argument("--out", default="logs_columnar")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    if args.command == "export":
+        sources = {"emotion_data": args.emotions, "conversations": args.conversations}
+        for table, source in sources.items():
+            if not os.path.isfile(source):
+                continue
+            if args.rebuild:
+                shutil.rmtree(table_dir(args.out, table), ignore_errors=True)
+            manifest = read_manifest(args.out, table)
+            fmt = args.format or (manifest["format"] if manifest else default_format())
+            count = export_table(source, args.out, table, fmt)
+            print(f"{table}: {count} 行を追加しました ({fmt})")
+    else:
+        for table in SCHEMAS:
+            if read_manifest(args.out, table) is not None:
+                compact_table(args.out, table)
+                print(f"{table}: チャンクを1つにまとめました")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
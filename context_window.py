@@ -0,0 +1,113 @@
+"""会話履歴のコンテキスト管理
+
+長いセッションでも毎ターンのプロンプトが一定の大きさに収まるように、
+  - 直近の発話はそのまま送り、プロンプト全体 (system 指示などの固定部分 reserved + 要約 + 履歴) を
+    トークン数の見積もりで token_budget までに抑える
+  - 予算を超えた古いターンは、ターンの合間にバックグラウンドで要約に畳み込む (RollingSummarizer)
+要約が追いついていない間は、予算に収まらない古い発話をプロンプトから外すだけで、応答は待たせない。
+畳むときは履歴を履歴の予算 (token_budget - reserved) の fold_target 倍まで一度に減らすので、
+要約 (プロンプトの先頭側) が変わるのは数ターンに1回で済む。
+"""
+import logging
+import queue
+import threading
+
+logger = logging.getLogger("emotion_chat.context")
+
+# 1メッセージあたりの役割・区切りの分のトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    """トークン数の見積もり (UTF-8 で3バイト ≒ 1トークン: 日本語は1文字、英語は3文字ほど)"""
+    return len(text.encode("utf-8")) // 3 + 1 if text else 0
+
+
+def message_tokens(message):
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextWindow:
+    """履歴のうちプロンプトにそのまま載せる範囲と、要約に畳む範囲を決める"""
+
+    def __init__(self, token_budget, fold_target=0.5, min_recent_messages=4):
+        self.token_budget = token_budget                # プロンプト全体の予算
+        self.fold_target = fold_target                  # 畳んだ後の履歴を履歴の予算のこの割合まで減らす
+        self.min_recent_messages = min_recent_messages  # 予算を超えても必ずそのまま送る直近の発話の数
+
+    def history_budget(self, reserved=0):
+        """プロンプトの固定部分 (reserved トークン) を除いた、要約と履歴に使える予算"""
+        return max(self.token_budget - reserved, 0)
+
+    def fit(self, history, summary="", reserved=0):
+        """固定部分・要約と合わせて予算に収まる直近の履歴を返す (先頭は user の発話にそろえる)"""
+        budget = self.history_budget(reserved) - estimate_tokens(summary)
+        kept = []
+        total = 0
+        for message in reversed(history):
+            cost = message_tokens(message)
+            if len(kept) >= self.min_recent_messages and total + cost > budget:
+                break
+            kept.append(message)
+            total += cost
+        kept.reverse()
+        while len(kept) > 1 and kept[0]["role"] != "user":
+            kept.pop(0)
+        return kept
+
+    def fold_count(self, history, summary="", reserved=0):
+        """要約に畳み込むべき古い発話の数 (予算内なら 0)。畳んだ後の履歴は user の発話から始まる"""
+        budget = self.history_budget(reserved)
+        tokens = [message_tokens(m) for m in history]
+        if sum(tokens) + estimate_tokens(summary) <= budget:
+            return 0
+        limit = len(history) - self.min_recent_messages
+        remaining = sum(tokens)
+        count = 0
+        while count < limit and remaining > budget * self.fold_target:
+            remaining -= tokens[count]
+            count += 1
+        while 0 < count < len(history) and history[count]["role"] != "user":
+            count -= 1
+        return max(count, 0)
+
+
+class RollingSummarizer:
+    """セッションの要約の更新を1本のバックグラウンドスレッドで順に実行する
+
+    schedule(session_id) はすぐに戻る。同じセッションの依頼が実行待ちなら1回にまとめる。
+    """
+
+    def __init__(self, run):
+        self.run = run  # run(session_id): 1セッション分の要約の更新
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, session_id):
+        with self._lock:
+            if session_id in self._pending:
+                return False
+            self._pending.add(session_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="context-summarizer", daemon=True)
+                self._thread.start()
+        self._queue.put(session_id)
+        return True
+
+    def join(self):
+        """依頼済みの要約がすべて終わるまで待つ"""
+        self._queue.join()
+
+    def _worker(self):
+        while True:
+            session_id = self._queue.get()
+            with self._lock:
+                self._pending.discard(session_id)
+            try:
+                self.run(session_id)
+            except Exception:
+                logger.exception("履歴の要約に失敗しました (session=%s)", session_id)
+            finally:
+                self._queue.task_done()
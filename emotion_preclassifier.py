@@ -0,0 +1,136 @@
+"""ユーザー発話からの仮の感情推定 (LLMの感情タグが届くまでの表情用)
+
+LLMを待たずに数ミリ秒で (v, a) を見積もる。
+  - 会話ログ (conversation_data.csv の user_message と emotion_v / emotion_a) の文字 n-gram による近傍法
+  - 感情語の小さな辞書
+の2つを、どちらも当てにならないときは前回の感情 (なければ中心) に寄せて混ぜる。
+表情は LLM の感情が届いた時点で置き換わるので、外れても控えめな表情になるようにしている。
+
+単体で試す:
+    python emotion_preclassifier.py "今日はすごく楽しかった！"
+"""
+import math
+import sys
+import time
+from collections import defaultdict
+
+from response_cache import normalize_utterance
+from sqlite_store import read_conversation_csv
+
+# 感情語の辞書: 語の一部 (正規化後の表記) -> (v, a)
+LEXICON = {
+    (0.75, 0.45): ("嬉し", "うれし", "楽し", "たのし", "最高", "やった", "すごい", "すご", "わーい", "好き", "ありがと", "おめでと"),
+    (0.65, -0.45): ("のんびり", "ゆっくり", "落ち着", "ほっと", "安心", "穏やか", "癒"),
+    (-0.65, -0.4): ("悲し", "かなし", "寂し", "さみし", "つら", "辛い", "泣", "残念", "落ち込"),
+    (-0.5, 0.75): ("怒", "むかつ", "ムカつ", "イライラ", "いらいら", "腹立", "うざ"),
+    (-0.45, 0.5): ("怖", "こわ", "不安", "心配", "やばい"),
+    (0.05, 0.85): ("びっくり", "驚", "えっ", "まじ", "マジ", "本当に", "ほんとに"),
+    (-0.1, -0.75): ("疲れ", "つかれ", "眠", "ねむ", "だる", "おやすみ"),
+}
+
+
+def char_ngrams(text, sizes=(1, 2, 3)):
+    """正規化した発話の文字 n-gram の出現数"""
+    text = normalize_utterance(text)
+    grams = defaultdict(int)
+    for n in sizes:
+        for i in range(len(text) - n + 1):
+            grams[text[i:i + n]] += 1
+    return grams
+
+
+class EmotionPreclassifier:
+    """文字 n-gram の近傍法と感情語の辞書で、発話から仮の (v, a) を推定する"""
+
+    def __init__(self, k=5, prior_weight=0.5, lexicon=LEXICON):
+        self.k = k                        # 近傍法で平均する事例の数
+        self.prior_weight = prior_weight  # 前回の感情 (なければ中心) に寄せる強さ
+        self.lexicon = [(normalize_utterance(cue), va) for va, cues in lexicon.items() for cue in cues]
+        self.targets = []                 # 事例ごとの (v, a)
+        self._postings = defaultdict(list)  # n-gram -> [(事例番号, 重み), ...]
+        self._idf = {}
+
+    def fit(self, examples):
+        """(発話, v, a) の列から近傍法の索引を作る (TF-IDF の重みで、事例ごとに長さを1に正規化する)"""
+        documents = []
+        for text, v, a in examples:
+            grams = char_ngrams(text)
+            if grams:
+                documents.append(grams)
+                self.targets.append((float(v), float(a)))
+        document_frequency = defaultdict(int)
+        for grams in documents:
+            for gram in grams:
+                document_frequency[gram] += 1
+        self._idf = {gram: math.log((1 + len(documents)) / (1 + count)) + 1.0
+                     for gram, count in document_frequency.items()}
+        for index, grams in enumerate(documents):
+            weights = self._weights(grams)
+            for gram, weight in weights.items():
+                self._postings[gram].append((index, weight))
+        return self
+
+    @classmethod
+    def from_conversation_csv(cls, path, **kwargs):
+        """会話ログのユーザー発話と、そのときのボットの感情 (emotion_v / emotion_a) で学習する"""
+        examples = []
+        for row in read_conversation_csv(path):
+            try:
+                examples.append((row["user_message"], float(row["emotion_v"]), float(row["emotion_a"])))
+            except (TypeError, ValueError):
+                continue
+        return cls(**kwargs).fit(examples)
+
+    def _weights(self, grams):
+        weights = {gram: count * self._idf.get(gram, 0.0) for gram, count in grams.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        return {gram: w / norm for gram, w in weights.items() if w}
+
+    def _neighbors(self, text):
+        """(近傍の平均の (v, a), 最も近い事例との類似度) を返す (似た事例がなければ (None, 0.0))"""
+        scores = defaultdict(float)
+        for gram, weight in self._weights(char_ngrams(text)).items():
+            for index, doc_weight in self._postings.get(gram, ()):
+                scores[index] += weight * doc_weight
+        if not scores:
+            return None, 0.0
+        nearest = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:self.k]
+        total = sum(score for _, score in nearest)
+        v = sum(self.targets[i][0] * score for i, score in nearest) / total
+        a = sum(self.targets[i][1] * score for i, score in nearest) / total
+        return (v, a), nearest[0][1]
+
+    def _lexicon(self, text):
+        """辞書に載っている感情語の (v, a) の平均 (なければ None)"""
+        text = normalize_utterance(text)
+        hits = [va for cue, va in self.lexicon if cue in text]
+        if not hits:
+            return None
+        return sum(v for v, _ in hits) / len(hits), sum(a for _, a in hits) / len(hits)
+
+    def predict(self, text, prior=None):
+        """発話から仮の (v, a) を推定する。prior は当てにならないときに寄せる (v, a) (既定は中心)"""
+        prior = prior or (0.0, 0.0)
+        estimates = [(prior, self.prior_weight)]
+        neighbor, similarity = self._neighbors(text)
+        if neighbor is not None:
+            estimates.append((neighbor, similarity))
+        lexicon = self._lexicon(text)
+        if lexicon is not None:
+            estimates.append((lexicon, 1.0))
+        total = sum(weight for _, weight in estimates)
+        v = sum(va[0] * weight for va, weight in estimates) / total
+        a = sum(va[1] * weight for va, weight in estimates) / total
+        return round(min(max(v, -1.0), 1.0), 2), round(min(max(a, -1.0), 1.0), 2)
+
+
+def main():
+    classifier = EmotionPreclassifier.from_conversation_csv("conversation_data.csv")
+    for text in sys.argv[1:]:
+        start = time.perf_counter()
+        v, a = classifier.predict(text)
+        print(f"{text}\tv={v} a={a}\t{(time.perf_counter() - start) * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""LLMバックエンド
+
+チャット処理は LLMBackend.chat / achat だけを呼び出す。
+  - OllamaBackend   : ローカルの Ollama デーモンを使う本番用
+  - ScriptedBackend : 録音済みの <thought>/<emotion> 形式の応答を、指定した
+                      TTFT とトークン速度で再生する負荷試験用 (GPU・モデル不要)
+どちらもチャンクは Ollama のストリームと同じ形 ({"message": {"content": ...}, "done": ...}) で返す。
+最後のメッセージが assistant なら、その続きを生成する (Ollama と同じ)。
+"""
+import asyncio
+import csv
+import hashlib
+import json
+import re
+import time
+
+
+class LLMBackend:
+    """LLMバックエンドの共通インターフェース"""
+
+    def chat(self, messages, **kwargs):
+        """ストリームのチャンクを順に返すイテレータ"""
+        raise NotImplementedError
+
+    async def achat(self, messages, **kwargs):
+        """chat の非同期版 (非同期イテレータ)"""
+        raise NotImplementedError
+        yield  # pragma: no cover
+
+    def complete(self, messages, **kwargs):
+        """ストリームをつなげた全文を返す (履歴の要約などの裏方の処理用)"""
+        return "".join(chunk["message"]["content"] for chunk in self.chat(messages, **kwargs) if "message" in chunk)
+
+    async def acomplete(self, messages, **kwargs):
+        """complete の非同期版"""
+        parts = []
+        async for chunk in self.achat(messages, **kwargs):
+            if "message" in chunk:
+                parts.append(chunk["message"]["content"])
+        return "".join(parts)
+
+    def warm_up(self, messages, **kwargs):
+        """モデルを読み込んでおく (必要なバックエンドのみ)"""
+
+
+class OllamaBackend(LLMBackend):
+    """Ollama デーモンを使うバックエンド"""
+
+    def __init__(self, model, host=None):
+        import ollama
+
+        self.model = model
+        self.client = ollama.Client(host=host)
+        self.async_client = ollama.AsyncClient(host=host)
+
+    def chat(self, messages, **kwargs):
+        return self.client.chat(model=self.model, messages=messages, stream=True, **kwargs)
+
+    async def achat(self, messages, **kwargs):
+        response = await self.async_client.chat(model=self.model, messages=messages, stream=True, **kwargs)
+        try:
+            async for chunk in response:
+                yield chunk
+        finally:
+            # 途中で閉じられたら Ollama への接続も閉じる
+            await response.aclose()
+
+    def warm_up(self, messages, **kwargs):
+        self.client.chat(model=self.model, messages=messages, options={"num_predict": 1}, **kwargs)
+
+
+def format_scripted_response(user_message, bot_response, v, a, label):
+    """会話ログの1行を <thought>/<emotion> 形式の応答に組み立てる"""
+    return (
+        f"<thought>\nThe user said: {user_message}. I react with a {label} feeling.\n</thought>\n"
+        f"<emotion v=\"{v}\" a=\"{a}\">{label}</emotion>\n"
+        f"{bot_response}"
+    )
+
+
+SCRIPTED_EMOTION_PATTERN = re.compile(r'<emotion\s+v="([^"]*)"\s+a="([^"]*)"\s*>(.*?)</emotion>')
+
+
+class ScriptedBackend(LLMBackend):
+    """録音済みの応答を決まった速度で再生する負荷試験用のバックエンド
+
+    応答は最後のユーザー発話のハッシュで選ぶので、同じ入力には常に同じ応答を返す。
+    format (構造化出力) を指定されたら、応答の感情タグを {"v", "a", "label"} のJSONにして返す。
+    最後のメッセージが assistant なら、その末尾のタグの断片 (例: '<emotion v="') の続きから再生する。
+    """
+
+    def __init__(self, responses, time_to_first_token=0.5, token_rate=30.0, chars_per_token=2):
+        if not responses:
+            raise ValueError("ScriptedBackend には少なくとも1つの応答が必要です")
+        self.responses = list(responses)
+        self.time_to_first_token = time_to_first_token  # 最初のトークンまでの秒数
+        self.token_rate = token_rate                    # 1秒あたりのトークン数 (0以下なら待たない)
+        self.chars_per_token = chars_per_token
+
+    @classmethod
+    def from_conversation_csv(cls, path, **kwargs):
+        """conversation_data.csv の bot_response / emotion_* 列から応答を作る
+
+        ヘッダーに session_id がない古い行と、session_id を含む新しい行が混在しているため、
+        列は末尾から数えて読む (user_message, bot_response, emotion_v, emotion_a, emotion_label)。
+        """
+        responses = []
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if len(row) < 6:
+                    continue
+                user_message, bot_response, v, a, label = row[-5:]
+                if bot_response and v and a and label:
+                    responses.append(format_scripted_response(user_message, bot_response, v, a, label))
+        return cls(responses, **kwargs)
+
+    def pick_response(self, messages):
+        """最後のユーザー発話から応答を決定的に選ぶ"""
+        user_message = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        digest = hashlib.sha1(user_message.encode("utf-8")).digest()
+        return self.responses[int.from_bytes(digest[:4], "big") % len(self.responses)]
+
+    def tokenize(self, text):
+        return [text[i:i + self.chars_per_token] for i in range(0, len(text), self.chars_per_token)]
+
+    def continue_response(self, response, prefix):
+        """assistant の書きかけ (prefix) の続きを返す (末尾のタグの断片が応答になければ応答全体)"""
+        fragment = prefix[prefix.rfind("<"):] if "<" in prefix else ""
+        index = response.find(fragment) if fragment else -1
+        return response[index + len(fragment):] if index >= 0 else response
+
+    def _chunks(self, messages, format=None):
+        response = self.pick_response(messages)
+        if format:
+            match = SCRIPTED_EMOTION_PATTERN.search(response)
+            v, a, label = match.groups() if match else ("0.0", "0.0", "neutral")
+            response = json.dumps({"v": float(v), "a": float(a), "label": label})
+        elif messages and messages[-1]["role"] == "assistant":
+            response = self.continue_response(response, messages[-1]["content"])
+        tokens = self.tokenize(response)
+        for token in tokens:
+            yield {"message": {"role": "assistant", "content": token}, "done": False}
+        prompt_chars = sum(len(m["content"]) for m in messages)
+        yield {
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "prompt_eval_count": prompt_chars // self.chars_per_token,
+            "eval_count": len(tokens),
+        }
+
+    def _delays(self):
+        """各チャンクを返す前に待つ秒数"""
+        yield self.time_to_first_token
+        interval = 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+        while True:
+            yield interval
+
+    def chat(self, messages, format=None, **kwargs):
+        for chunk, delay in zip(self._chunks(messages, format), self._delays()):
+            if delay > 0:
+                time.sleep(delay)
+            yield chunk
+
+    async def achat(self, messages, format=None, **kwargs):
+        for chunk, delay in zip(self._chunks(messages, format), self._delays()):
+            await asyncio.sleep(delay)
+            yield chunk
@@ -0,0 +1,197 @@
+"""Socket.IO のメッセージキュー (複数ワーカー構成用)
+
+複数のワーカープロセスで Socket.IO を動かすとき、あるワーカーから別のワーカーに接続している
+クライアントへの送信はメッセージキューを経由して届ける。
+  - local://host:port          : このモジュールの簡易ブローカー (テスト・1台構成用)
+  - redis://, kafka://, amqp:// : python-socketio 付属のマネージャー (本番用、各クライアントライブラリが必要)
+
+簡易ブローカーの起動:
+    python message_queue.py --address 127.0.0.1:6100
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from urllib.parse import urlparse
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+logger = logging.getLogger("emotion_chat.message_queue")
+
+LOCAL_QUEUE_AUTHKEY = b"emotion-chat-local-queue"
+# ブローカーに接続できなかったときに再接続するまでの秒数
+RECONNECT_INTERVAL = 1.0
+
+
+def parse_local_url(url):
+    """local://host:port を (host, port) にする"""
+    parsed = urlparse(url)
+    if parsed.scheme != "local" or not parsed.hostname or not parsed.port:
+        raise ValueError(f"local://host:port の形式ではありません: {url}")
+    return parsed.hostname, parsed.port
+
+
+# --- 簡易ブローカー ---
+class LocalQueueBroker:
+    """publish されたメッセージを、subscribe しているすべての接続に配る
+
+    接続は最初に ("publish",) か ("subscribe",) を送って役割を決める。
+    publish 側には何も送り返さないので、送るだけの接続の受信バッファが溜まることはない。
+    """
+
+    def __init__(self, address):
+        self.listener = Listener(address, authkey=LOCAL_QUEUE_AUTHKEY)
+        self.address = self.listener.address
+        self._subscribers = []  # [(conn, lock), ...]
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        logger.info("メッセージキューのブローカーを %s:%s で起動しました", *self.address)
+        while True:
+            conn = self.listener.accept()
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="local-queue-broker", daemon=True).start()
+        return self
+
+    def _handle(self, conn):
+        try:
+            role = conn.recv()
+            if role == ("subscribe",):
+                with self._lock:
+                    self._subscribers.append((conn, threading.Lock()))
+                return  # 以降は _broadcast からの送信だけ
+            while True:
+                self._broadcast(conn.recv())
+        except (EOFError, OSError):
+            conn.close()
+
+    def _broadcast(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for conn, lock in subscribers:
+            try:
+                with lock:
+                    conn.send(message)
+            except (EOFError, OSError):
+                with self._lock:
+                    if (conn, lock) in self._subscribers:
+                        self._subscribers.remove((conn, lock))
+
+
+class _LocalQueueClient:
+    """LocalQueueBroker への publish / subscribe (同期・非同期マネージャー共通)"""
+
+    def _init_local_queue(self, url):
+        self.address = parse_local_url(url)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _publish_sync(self, data):
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = Client(self.address, authkey=LOCAL_QUEUE_AUTHKEY)
+                        self._publisher.send(("publish",))
+                    self._publisher.send((self.channel, data))
+                    return
+                except (EOFError, OSError):
+                    # ブローカーが再起動した場合は1回だけつなぎ直す
+                    self._publisher = None
+                    if attempt:
+                        raise
+
+    def _subscribe(self):
+        while True:
+            try:
+                conn = Client(self.address, authkey=LOCAL_QUEUE_AUTHKEY)
+                conn.send(("subscribe",))
+                return conn
+            except OSError as e:
+                logger.warning("メッセージキューに接続できません (%s:%s): %s", *self.address, e)
+                time.sleep(RECONNECT_INTERVAL)
+
+
+class LocalQueueManager(_LocalQueueClient, socketio.PubSubManager):
+    """Flask-SocketIO (同期サーバー) 用の簡易ブローカーのマネージャー"""
+    name = "local"
+
+    def __init__(self, url, channel="socketio", write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self._init_local_queue(url)
+
+    def _publish(self, data):
+        self._publish_sync(data)
+
+    def _listen(self):
+        while True:
+            conn = self._subscribe()
+            try:
+                while True:
+                    channel, data = conn.recv()
+                    if channel == self.channel:
+                        yield data
+            except (EOFError, OSError):
+                logger.warning("メッセージキューとの接続が切れました。再接続します")
+                conn.close()
+
+
+class AsyncLocalQueueManager(_LocalQueueClient, AsyncPubSubManager):
+    """ASGI (非同期サーバー) 用の簡易ブローカーのマネージャー。送受信はスレッドで行う"""
+    name = "local"
+
+    def __init__(self, url, channel="socketio", write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self._init_local_queue(url)
+
+    async def _publish(self, data):
+        await asyncio.to_thread(self._publish_sync, data)
+
+    async def _listen(self):
+        while True:
+            conn = await asyncio.to_thread(self._subscribe)
+            try:
+                while True:
+                    channel, data = await asyncio.to_thread(conn.recv)
+                    if channel == self.channel:
+                        yield data
+            except (EOFError, OSError):
+                logger.warning("メッセージキューとの接続が切れました。再接続します")
+                conn.close()
+
+
+def create_client_manager(url, channel, async_mode=False):
+    """メッセージキューの URL から Socket.IO のクライアントマネージャーを作る"""
+    if url.startswith("local://"):
+        manager_class = AsyncLocalQueueManager if async_mode else LocalQueueManager
+    elif url.startswith(("redis://", "rediss://")):
+        manager_class = socketio.AsyncRedisManager if async_mode else socketio.RedisManager
+    elif async_mode:
+        manager_class = socketio.AsyncAioPikaManager
+    elif url.startswith("kafka://"):
+        manager_class = socketio.KafkaManager
+    else:
+        manager_class = socketio.KombuManager
+    return manager_class(url, channel=channel)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--address", default="127.0.0.1:6100", help="待ち受けるアドレス (host:port)")
+    args = parser.parse_args()
+    host, port = args.address.rsplit(":", 1)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        LocalQueueBroker((host, int(port))).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""ターンごとの処理時間の計測とトレース
+
+各ターンの段階別の処理時間 (キュー待ち, 最初のトークンまで, 思考, 感情検出, パラメータ計算, 送信)
+をヒストグラムに集計し、Prometheus のテキスト形式で /metrics から返す。
+METRICS_TRACE_PATH (app.py) を設定すると、1ターン1行のJSONL (セッションID・トークン数つき) も書き出す
+(書き込みは persistence.BatchedJsonlWriter のバックグラウンドスレッドが行う)。
+"""
+import threading
+
+from persistence import BatchedJsonlWriter
+
+# ヒストグラムのバケット上限 (秒)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 計測する段階
+STAGES = (
+    "queue_wait",           # 生成枠の待ち時間
+    "time_to_first_token",  # LLM呼び出しから最初のトークンまで
+    "thought",              # <thought> ブロックの受信にかかった時間
+    "time_to_provisional",  # ターンの開始から仮の表情 (発話からの推定) を送るまで
+    "time_to_emotion",      # LLM呼び出しから感情タグを検出するまで
+    "param_compute",        # 表情パラメータの計算
+    "emit",                 # クライアントへの送信
+    "cancel_latency",       # 生成の中断を要求してからストリームを閉じるまで
+    "llm_total",            # LLMのストリーム全体
+    "turn_total",           # ターン全体
+)
+
+
+class Histogram:
+    """累積バケット方式のヒストグラム (スレッドセーフ)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最後は +Inf
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.total, self.count
+
+
+def histogram_lines(name, label, histogram):
+    """1つのヒストグラムの Prometheus 形式の行 (label は 'stage="..."' の形)"""
+    counts, total, count = histogram.snapshot()
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(histogram.buckets, counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {count}')
+    lines.append(f'{name}_sum{{{label}}} {total}')
+    lines.append(f'{name}_count{{{label}}} {count}')
+    return lines
+
+
+class TurnMetrics:
+    """ターンの計測値を集計し、/metrics 用のテキストとJSONLトレースを出力する"""
+
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.trace_writer = BatchedJsonlWriter() if trace_path else None
+        self.stage_histograms = {stage: Histogram() for stage in STAGES}
+        self.expression_histograms = {}  # 感情の出し方 (app.EMOTION_MODE) -> 表情を送るまでの時間
+        self.turns = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.interrupted_turns = 0
+        self.wasted_tokens = 0  # 中断したターンで生成したトークン数
+        self.reply_chunks = 0   # 返答として受け取ったチャンクの数と、bot_stream として送った回数
+        self.bot_stream_frames = 0
+        self._lock = threading.Lock()
+        self._sources = []  # /metrics に追加で載せる行を返す関数 (応答キャッシュのカウンターなど)
+
+    def add_source(self, render):
+        """render() が返す Prometheus 形式の行を /metrics の末尾に追加する"""
+        self._sources.append(render)
+
+    def observe_turn(self, record):
+        """1ターン分の記録を集計する
+
+        record は {"session_id", "stages": {段階: 秒 or None}, "prompt_tokens", "completion_tokens", ...}
+        """
+        for stage, seconds in record["stages"].items():
+            if seconds is not None and stage in self.stage_histograms:
+                self.stage_histograms[stage].observe(seconds)
+        mode = record.get("emotion_mode")
+        time_to_emotion = record["stages"].get("time_to_emotion")
+        if mode and time_to_emotion is not None:
+            with self._lock:
+                histogram = self.expression_histograms.setdefault(mode, Histogram())
+            histogram.observe(time_to_emotion)
+        with self._lock:
+            self.turns += 1
+            self.prompt_tokens += record.get("prompt_tokens") or 0
+            self.completion_tokens += record.get("completion_tokens") or 0
+            self.reply_chunks += record.get("reply_chunks") or 0
+            self.bot_stream_frames += record.get("bot_stream_frames") or 0
+            if record.get("interrupted"):
+                self.interrupted_turns += 1
+                self.wasted_tokens += record.get("completion_tokens") or 0
+        if self.trace_path:
+            self.write_trace(record)
+
+    def write_trace(self, record):
+        """トレースの1行を書き込みキューに入れる (ファイルへの追記はバックグラウンドスレッドが行う)"""
+        self.trace_writer.write(self.trace_path, tuple(record), record)
+
+    def close(self):
+        """書き込みキューに残っているトレースを書き出す"""
+        if self.trace_writer is not None:
+            self.trace_writer.close()
+
+    def render_prometheus(self):
+        """Prometheus のテキスト形式で全指標を返す"""
+        lines = [
+            "# HELP chat_stage_seconds Per-turn latency of each chat pipeline stage.",
+            "# TYPE chat_stage_seconds histogram",
+        ]
+        for stage, histogram in self.stage_histograms.items():
+            lines += histogram_lines("chat_stage_seconds", f'stage="{stage}"', histogram)
+        with self._lock:
+            expression_histograms = list(self.expression_histograms.items())
+        lines += [
+            "# HELP chat_time_to_expression_seconds Time from the LLM call to the first expression, per emotion mode.",
+            "# TYPE chat_time_to_expression_seconds histogram",
+        ]
+        for mode, histogram in expression_histograms:
+            lines += histogram_lines("chat_time_to_expression_seconds", f'mode="{mode}"', histogram)
+        with self._lock:
+            lines += [
+                "# HELP chat_turns_total Completed chat turns.",
+                "# TYPE chat_turns_total counter",
+                f"chat_turns_total {self.turns}",
+                "# HELP chat_prompt_tokens_total Prompt tokens evaluated by the LLM.",
+                "# TYPE chat_prompt_tokens_total counter",
+                f"chat_prompt_tokens_total {self.prompt_tokens}",
+                "# HELP chat_completion_tokens_total Tokens generated by the LLM.",
+                "# TYPE chat_completion_tokens_total counter",
+                f"chat_completion_tokens_total {self.completion_tokens}",
+                "# HELP chat_interrupted_turns_total Turns cancelled by a new message or a disconnect.",
+                "# TYPE chat_interrupted_turns_total counter",
+                f"chat_interrupted_turns_total {self.interrupted_turns}",
+                "# HELP chat_wasted_tokens_total Tokens generated by turns that were cancelled.",
+                "# TYPE chat_wasted_tokens_total counter",
+                f"chat_wasted_tokens_total {self.wasted_tokens}",
+                "# HELP chat_reply_chunks_total Reply chunks received from the LLM stream.",
+                "# TYPE chat_reply_chunks_total counter",
+                f"chat_reply_chunks_total {self.reply_chunks}",
+                "# HELP chat_bot_stream_frames_total bot_stream events sent after coalescing.",
+                "# TYPE chat_bot_stream_frames_total counter",
+                f"chat_bot_stream_frames_total {self.bot_stream_frames}",
+            ]
+        for render in self._sources:
+            lines += render()
+        return "\n".join(lines) + "\n"
+
+    def asgi_app(self):
+        """/metrics だけを返す ASGI アプリ (socketio.ASGIApp の other_asgi_app 用)"""
+        async def metrics_app(scope, receive, send):
+            if scope["type"] != "http":
+                return
+            if scope["path"] == "/metrics":
+                status, body = 200, self.render_prometheus().encode("utf-8")
+            else:
+                status, body = 404, b"Not Found"
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")]})
+            await send({"type": "http.response.body", "body": body})
+        return metrics_app
@@ -0,0 +1,130 @@
+"""会話ログ・表情データの永続化
+
+Socket.IO のハンドラは write() で行をキューに入れるだけにし、
+実際の書き込みは1本のバックグラウンドスレッドがまとめて行う。
+書き込みは件数 (batch_size) か経過時間 (flush_interval) のどちらかでまとめて行い、
+終了時には close() で残りを書き出す。
+  - BatchedCsvWriter : CSVファイルに追記する (書き込むたびに fsync)
+  - BatchedJsonlWriter : 1行1レコードのJSONLファイルに追記する (metrics のターンのトレース)
+  - sqlite_store.BatchedSqliteWriter : SQLite (WALモード) のテーブルに挿入する
+"""
+import csv
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger("emotion_chat.persistence")
+
+_STOP = object()
+
+
+class BatchedWriter:
+    """行をキューに貯め、バックグラウンドスレッドでまとめて書き込む
+
+    書き込み先 (target) ごとの書き込み方はサブクラスの _write_batch で実装する。
+    """
+
+    def __init__(self, batch_size=100, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="persistence-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, target, fieldnames, row):
+        """1行をキューに入れる。ヘッダーにない列を含む行は ValueError"""
+        if self._closed:
+            raise RuntimeError(f"{type(self).__name__} は既に閉じられています")
+        extra = set(row) - set(fieldnames)
+        if extra:
+            raise ValueError(f"ヘッダーにない列があります: {sorted(extra)}")
+        self._queue.put((target, tuple(fieldnames), dict(row)))
+
+    def flush(self, timeout=None):
+        """キューに入っている行をすべて書き出すまで待つ"""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=10.0):
+        """残りの行を書き出してスレッドを止める"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        pending = {}  # (target, fieldnames) -> [row, ...]
+        count = 0
+        deadline = None
+        while True:
+            timeout = None if count == 0 else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None  # flush_interval が経過した
+
+            if isinstance(item, tuple):
+                target, fieldnames, row = item
+                pending.setdefault((target, fieldnames), []).append(row)
+                count += 1
+                if count == 1:
+                    deadline = time.monotonic() + self.flush_interval
+                if count < self.batch_size:
+                    continue
+
+            self._write_pending(pending)
+            count = 0
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is _STOP:
+                self._on_stop()
+                return
+
+    def _write_pending(self, pending):
+        for (target, fieldnames), rows in pending.items():
+            try:
+                self._write_batch(target, fieldnames, rows)
+                logger.debug("%d 行を %s に保存しました", len(rows), target)
+            except Exception as e:
+                logger.error("%s への保存に失敗しました (%d 行): %s", target, len(rows), e)
+        pending.clear()
+
+    def _write_batch(self, target, fieldnames, rows):
+        raise NotImplementedError
+
+    def _on_stop(self):
+        """書き込みスレッドが止まる直前に呼ばれる (接続の後始末など)"""
+
+
+class BatchedCsvWriter(BatchedWriter):
+    """CSVファイルへの追記をまとめて行う (target はファイルパス)"""
+
+    def __init__(self, batch_size=100, flush_interval=1.0, fsync=True):
+        self.fsync = fsync
+        super().__init__(batch_size, flush_interval)
+
+    def _write_batch(self, path, fieldnames, rows):
+        # ファイルが存在しない (または空の) 場合はヘッダーを書き込む
+        new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+        with open(path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+
+class BatchedJsonlWriter(BatchedWriter):
+    """JSONLファイルへの追記をまとめて行う (target はファイルパス、行は dict をそのまま1行のJSONにする)"""
+
+    def _write_batch(self, path, fieldnames, rows):
+        with open(path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
@@ -0,0 +1,152 @@
+"""応答キャッシュ
+
+「こんにちは」のような短い発話は何度も繰り返されるので、直近の履歴 (正規化したもの) と
+前回の感情の区画が同じなら、前回の応答 (感情と返答文) を再利用してLLMの生成を省く。
+  - キーは直近 context_messages 件の発話を正規化したものと、前回の (v, a) を emotion_bucket 刻みで
+    区切った区画のハッシュ。正規化すると空になる発話 (「！！」「…」など) はキャッシュしない
+  - LRU + TTL で破棄し、保持する返答文の合計バイト数を max_bytes までに抑える
+  - ヒットしたときは <emotion> タグつきの応答を組み立て直し、LLMのストリームと同じ形のチャンクを
+    replay_rate トークン/秒で返す (ChatTurn にそのまま流せば update_expression / bot_stream が出る)
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+# normalize_utterance で取り除く文字の種類。絵文字 (So) は感情を表すので残す
+STRIPPED_CATEGORIES = ("P", "Sm", "Sc", "Sk", "Z", "C")
+
+
+def normalize_utterance(text):
+    """表記ゆれを吸収する: NFKC・小文字化し、空白・句読点・記号 (！？～ など、絵文字以外) を取り除く"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if not unicodedata.category(ch).startswith(STRIPPED_CATEGORIES))
+
+
+def emotion_bucket(emotion, size):
+    """前回の感情を size 刻みの区画にする (感情がなければ None)"""
+    try:
+        v, a = float(emotion["v"]), float(emotion["a"])
+    except (TypeError, KeyError, ValueError):
+        return None
+    return int((v + 1.0) // size), int((a + 1.0) // size)
+
+
+class ResponseCache:
+    """直近の履歴と前回の感情の区画をキーにした応答のキャッシュ (LRU + TTL + バイト数の上限)"""
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, ttl=3600.0, context_messages=1, bucket_size=0.5,
+                 replay_rate=40.0, chars_per_token=2):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.context_messages = context_messages  # キーに含める直近の発話の数 (user / assistant を問わない)
+        self.bucket_size = bucket_size
+        self.replay_rate = replay_rate            # 再生速度 (トークン/秒, 0以下なら待たない)
+        self.chars_per_token = chars_per_token
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> {"emotion", "reply", "bytes", "expires"}
+        self._lock = threading.Lock()
+
+    def key(self, messages, last_emotion):
+        """会話履歴 (最後がユーザーの発話) と前回の感情からキャッシュのキーを作る
+
+        最後の発話が正規化すると空になる場合は None (別々の発話が1つの応答を共有しないようにする)。
+        """
+        recent = [(m["role"], normalize_utterance(m["content"]))
+                  for m in messages[-self.context_messages:] if m["role"] != "system"]
+        if not recent or not recent[-1][1]:
+            return None
+        payload = json.dumps([recent, emotion_bucket(last_emotion, self.bucket_size)], ensure_ascii=False)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key, now=None):
+        """キャッシュされた応答を返す (なければ None)。ヒット・ミスを数える"""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] <= now:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, emotion, reply, now=None):
+        """応答を保存する。上限を超えたら最も古く使われたものから捨てる"""
+        now = time.time() if now is None else now
+        size = len(reply.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {"emotion": dict(emotion), "reply": reply, "bytes": size, "expires": now + self.ttl}
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.bytes -= self._entries.pop(key)["bytes"]
+
+    def __len__(self):
+        return len(self._entries)
+
+    # --- 再生 ---
+    def response_text(self, entry):
+        """キャッシュした応答を <emotion> タグつきの形に組み立て直す (思考ブロックは省く)
+
+        v / a は固定小数点で書く (1e-05 のような指数表記はタグの解析で読めない)。
+        """
+        emotion = entry["emotion"]
+        v, a = float(emotion["v"]), float(emotion["a"])
+        return f'<emotion v="{v:.3f}" a="{a:.3f}">{emotion["label"]}</emotion>\n{entry["reply"]}'
+
+    def _chunks(self, entry):
+        text = self.response_text(entry)
+        for i in range(0, len(text), self.chars_per_token):
+            yield {"message": {"role": "assistant", "content": text[i:i + self.chars_per_token]}, "done": False}
+        yield {"message": {"role": "assistant", "content": ""}, "done": True, "prompt_eval_count": 0, "eval_count": 0}
+
+    def replay(self, entry):
+        """LLMのストリームと同じ形のチャンクを replay_rate で返す"""
+        interval = 1.0 / self.replay_rate if self.replay_rate > 0 else 0.0
+        for i, chunk in enumerate(self._chunks(entry)):
+            if i and interval:
+                time.sleep(interval)
+            yield chunk
+
+    async def areplay(self, entry):
+        interval = 1.0 / self.replay_rate if self.replay_rate > 0 else 0.0
+        for i, chunk in enumerate(self._chunks(entry)):
+            if i and interval:
+                await asyncio.sleep(interval)
+            yield chunk
+
+    def prometheus_lines(self):
+        """/metrics に載せるカウンター"""
+        with self._lock:
+            return [
+                "# HELP chat_response_cache_hits_total Turns answered from the response cache.",
+                "# TYPE chat_response_cache_hits_total counter",
+                f"chat_response_cache_hits_total {self.hits}",
+                "# HELP chat_response_cache_misses_total Turns that missed the response cache.",
+                "# TYPE chat_response_cache_misses_total counter",
+                f"chat_response_cache_misses_total {self.misses}",
+                "# HELP chat_response_cache_evictions_total Entries evicted to stay under the byte cap.",
+                "# TYPE chat_response_cache_evictions_total counter",
+                f"chat_response_cache_evictions_total {self.evictions}",
+                "# HELP chat_response_cache_bytes Reply bytes held in the response cache.",
+                "# TYPE chat_response_cache_bytes gauge",
+                f"chat_response_cache_bytes {self.bytes}",
+            ]
@@ -0,0 +1,229 @@
+"""会話セッションの保存先
+
+app.py のセッション管理は SessionStore の get / update / expire だけを使う。
+  - MemorySessionStore : プロセス内の LRU 辞書 (1プロセス構成の既定)
+  - SqliteSessionStore : 同じマシンの複数ワーカーで共有する SQLite (WALモード) ファイル
+  - RedisSessionStore  : 複数マシンのワーカーで共有する Redis (redis パッケージが必要)
+
+セッションは {"messages": [...], "last_emotion": {...} or None, "summary": 畳み込んだ古い履歴の要約} の dict。
+get / update が返すのは保存先とは別のコピー。変更は update(session_id, mutate) で行い、
+読み出し・変更・書き込みを1つの操作にする (同じセッションのターンが別のワーカーで重なっても、
+片方の書き込みが失われない)。update(..., create=False) は、セッションがなければ (破棄済みなど) 何もせず None を返す。
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionStore:
+    """セッションの保存先の共通インターフェース"""
+
+    def get(self, session_id):
+        """セッションのコピーを返す (なければ None)"""
+        raise NotImplementedError
+
+    def put(self, session_id, session):
+        """セッションを保存し、最終アクセス時刻を更新する"""
+        raise NotImplementedError
+
+    def update(self, session_id, mutate, create=None):
+        """保存されているセッション (なければ create() の結果) に mutate(session) を適用して保存し、コピーを返す
+
+        create=False ならセッションを作らず、なければ None を返す。
+        """
+        session = self.get(session_id)
+        if session is None:
+            if create is False:
+                return None
+            session = (create or new_session)()
+        mutate(session)
+        self.put(session_id, session)
+        return copy_session(session)
+
+    def expire(self, now=None):
+        """アイドル時間を過ぎたセッションと、上限を超えた古いセッションを破棄する"""
+
+
+def new_session():
+    return {"messages": [], "last_emotion": None, "summary": ""}
+
+
+def copy_session(session):
+    return {"messages": list(session["messages"]), "last_emotion": session.get("last_emotion"),
+            "summary": session.get("summary", "")}
+
+
+class MemorySessionStore(SessionStore):
+    """プロセス内の LRU 辞書 (OrderedDict の先頭ほど最後のアクセスが古い)"""
+
+    def __init__(self, idle_timeout, max_count):
+        self.idle_timeout = idle_timeout
+        self.max_count = max_count
+        self._sessions = OrderedDict()  # session_id -> (セッション, 最終アクセス時刻)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (entry[0], time.time())
+            self._sessions.move_to_end(session_id)
+            return copy_session(entry[0])
+
+    def put(self, session_id, session):
+        with self._lock:
+            self._sessions[session_id] = (copy_session(session), time.time())
+            self._sessions.move_to_end(session_id)
+
+    def update(self, session_id, mutate, create=None):
+        with self._lock:
+            exists = session_id in self._sessions
+        # 新しいセッションの初期値 (保存済みの会話の読み出しなど) はロックの外で作る
+        created = None if exists or create is False else (create or new_session)()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None and create is False:
+                return None
+            session = entry[0] if entry is not None else (created or new_session())
+            mutate(session)
+            self._sessions[session_id] = (session, time.time())
+            self._sessions.move_to_end(session_id)
+            return copy_session(session)
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._sessions:
+                session_id, (_, last_access) = next(iter(self._sessions.items()))
+                if now - last_access > self.idle_timeout or len(self._sessions) > self.max_count:
+                    del self._sessions[session_id]
+                else:
+                    break
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+class SqliteSessionStore(SessionStore):
+    """複数のワーカープロセスで共有する SQLite のセッション表 (接続はスレッドごとに1つ)"""
+
+    # expire で全体を掃除する間隔 (秒)。毎ターン DELETE を走らせないようにする
+    EXPIRE_INTERVAL = 10.0
+
+    def __init__(self, db_path, idle_timeout, max_count):
+        self.db_path = db_path
+        self.idle_timeout = idle_timeout
+        self.max_count = max_count
+        self._local = threading.local()
+        self._last_expire = 0.0
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # トランザクションは update で明示的に張る (BEGIN IMMEDIATE で他のワーカーの書き込みと直列化する)
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=10.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions "
+                         "(id TEXT PRIMARY KEY, data TEXT NOT NULL, last_access REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions (last_access)")
+        return conn
+
+    def get(self, session_id):
+        conn = self._connection()
+        row = conn.execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE sessions SET last_access = ? WHERE id = ?", (time.time(), session_id))
+        return json.loads(row[0])
+
+    def put(self, session_id, session):
+        data = json.dumps(copy_session(session), ensure_ascii=False)
+        self._connection().execute("INSERT OR REPLACE INTO sessions (id, data, last_access) VALUES (?, ?, ?)",
+                                   (session_id, data, time.time()))
+
+    def update(self, session_id, mutate, create=None):
+        conn = self._connection()
+        exists = conn.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+        created = None if exists or create is False else (create or new_session)()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None and create is False:
+                conn.execute("COMMIT")
+                return None
+            session = json.loads(row[0]) if row is not None else (created or new_session())
+            mutate(session)
+            conn.execute("INSERT OR REPLACE INTO sessions (id, data, last_access) VALUES (?, ?, ?)",
+                         (session_id, json.dumps(copy_session(session), ensure_ascii=False), time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return copy_session(session)
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        if now - self._last_expire < self.EXPIRE_INTERVAL:
+            return
+        self._last_expire = now
+        conn = self._connection()
+        conn.execute("DELETE FROM sessions WHERE last_access < ?", (now - self.idle_timeout,))
+        conn.execute("DELETE FROM sessions WHERE id IN "
+                     "(SELECT id FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                     (self.max_count,))
+
+
+class RedisSessionStore(SessionStore):
+    """Redis に JSON で保存する。アイドル時間は Redis のキーの有効期限で管理する"""
+
+    KEY_PREFIX = "emotion_chat:session:"
+
+    def __init__(self, url, idle_timeout):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.watch_error = redis.WatchError
+        self.idle_timeout = idle_timeout
+
+    def get(self, session_id):
+        key = self.KEY_PREFIX + session_id
+        data = self.client.get(key)
+        if data is None:
+            return None
+        self.client.expire(key, int(self.idle_timeout))
+        return json.loads(data)
+
+    def put(self, session_id, session):
+        data = json.dumps(copy_session(session), ensure_ascii=False)
+        self.client.set(self.KEY_PREFIX + session_id, data, ex=int(self.idle_timeout))
+
+    def update(self, session_id, mutate, create=None):
+        key = self.KEY_PREFIX + session_id
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    # 読み出してから書き込むまでに他のワーカーが書き換えたらやり直す
+                    pipe.watch(key)
+                    data = pipe.get(key)
+                    if data is None and create is False:
+                        pipe.reset()
+                        return None
+                    session = json.loads(data) if data is not None else (create or new_session)()
+                    mutate(session)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(copy_session(session), ensure_ascii=False), ex=int(self.idle_timeout))
+                    pipe.execute()
+                    return copy_session(session)
+                except self.watch_error:
+                    continue
@@ -0,0 +1,281 @@
+"""会話ログ・表情データの SQLite (WALモード) ストア
+
+STORAGE_BACKEND=sqlite のとき、app.py は CSV の代わりにこのモジュールで保存する。
+  - BatchedSqliteWriter : persistence.BatchedWriter と同じくキューに貯めてまとめて INSERT する
+  - SqliteReader        : session_id / timestamp のインデックスを使った読み出し
+                          (セッション履歴の復元、期間・感情ごとの集計)
+  - import_csv          : 既存の conversation_data.csv / emotion_data.csv を取り込む (1回限り)
+
+conversation_data.csv には session_id のない古いヘッダーの行と、session_id を含む新しい行が
+混在しているため、読み込み時に列数で見分けて揃える (古い行の session_id は NULL)。
+repair_conversation_csv で CSV 自体を現在のヘッダーに書き直すこともできる。
+
+使い方:
+    python sqlite_store.py import --db chat_data.db
+    python sqlite_store.py repair-csv conversation_data.csv
+"""
+import argparse
+import csv
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from persistence import BatchedWriter
+
+logger = logging.getLogger("emotion_chat.persistence")
+
+# --- スキーマ ---
+CONVERSATION_COLUMNS = (
+    ("session_id", "TEXT"),
+    ("timestamp", "TEXT"),
+    ("user_message", "TEXT"),
+    ("bot_response", "TEXT"),
+    ("emotion_v", "REAL"),
+    ("emotion_a", "REAL"),
+    ("emotion_label", "TEXT"),
+)
+EMOTION_DATA_COLUMNS = (
+    ("subject_id", "TEXT"),
+    ("timestamp", "TEXT"),
+    ("emotion_label", "TEXT"),
+    ("animationDuration", "REAL"),
+    ("eyeOpenness", "REAL"),
+    ("pupilSize", "REAL"),
+    ("pupilAngle", "REAL"),
+    ("upperEyelidAngle", "REAL"),
+    ("upperEyelidCoverage", "REAL"),
+    ("lowerEyelidCoverage", "REAL"),
+    ("mouthCurve", "REAL"),
+    ("mouthHeight", "REAL"),
+    ("mouthWidth", "REAL"),
+)
+TABLES = {
+    "conversations": CONVERSATION_COLUMNS,
+    "emotion_data": EMOTION_DATA_COLUMNS,
+}
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_conversations_session ON conversations (session_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations (timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_emotion_data_subject ON emotion_data (subject_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_emotion_data_timestamp ON emotion_data (timestamp)",
+)
+# conversation_data.csv の古いヘッダー (session_id なし)
+LEGACY_CONVERSATION_COLUMNS = tuple(name for name, _ in CONVERSATION_COLUMNS[1:])
+
+
+def connect(db_path):
+    """WALモードで接続し、テーブルとインデックスがなければ作る"""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL では NORMAL でもコミット済みのデータは壊れない (電源断時に直近のコミットが失われうるだけ)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with conn:
+        for table, columns in TABLES.items():
+            column_defs = ", ".join(f'"{name}" {kind}' for name, kind in columns)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, {column_defs})")
+        for statement in INDEXES:
+            conn.execute(statement)
+    return conn
+
+
+def coerce_row(table, fieldnames, row):
+    """CSV向けの行 (空文字あり) を列の型に合わせた値のタプルにする"""
+    kinds = dict(TABLES[table])
+    values = []
+    for name in fieldnames:
+        value = row.get(name)
+        if value == "":
+            value = None
+        elif value is not None and kinds.get(name) == "REAL":
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                pass  # 数値でない値はそのまま保存する (SQLite は列ごとの型を強制しない)
+        values.append(value)
+    return tuple(values)
+
+
+def insert_rows(conn, table, fieldnames, rows):
+    if table not in TABLES:
+        raise ValueError(f"未知のテーブルです: {table}")
+    columns = ", ".join(f'"{name}"' for name in fieldnames)
+    placeholders = ", ".join("?" for _ in fieldnames)
+    conn.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})",
+                     (coerce_row(table, fieldnames, row) for row in rows))
+
+
+# --- 書き込み ---
+class BatchedSqliteWriter(BatchedWriter):
+    """SQLite への INSERT をまとめて行う (target はテーブル名)
+
+    接続は書き込みスレッドの中で開き、1バッチを1トランザクションで書き込む。
+    """
+
+    def __init__(self, db_path, batch_size=100, flush_interval=1.0):
+        self.db_path = db_path
+        self._conn = None
+        super().__init__(batch_size, flush_interval)
+
+    def _write_batch(self, table, fieldnames, rows):
+        if self._conn is None:
+            self._conn = connect(self.db_path)
+        with self._conn:
+            insert_rows(self._conn, table, fieldnames, rows)
+
+    def _on_stop(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# --- 読み出し ---
+class SqliteReader:
+    """インデックスを使った読み出し (接続はスレッドごとに1つ)"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect(self.db_path)
+        return conn
+
+    def session_history(self, session_id, limit=20):
+        """セッションの直近 limit ターンを古い順に返す"""
+        rows = self._connection().execute(
+            "SELECT * FROM conversations WHERE session_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (session_id, limit),
+        ).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def conversations_between(self, start, end):
+        """start <= timestamp < end の会話を時刻順に返す (timestamp は 'YYYY-MM-DD HH:MM:SS')"""
+        rows = self._connection().execute(
+            "SELECT * FROM conversations WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp, id",
+            (start, end),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def emotion_label_counts(self, start=None, end=None):
+        """期間内の感情ラベルごとのターン数と V/A の平均"""
+        conditions, params = [], []
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            params.append(end)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        rows = self._connection().execute(
+            "SELECT emotion_label, COUNT(*) AS turns, AVG(emotion_v) AS mean_v, AVG(emotion_a) AS mean_a "
+            f"FROM conversations {where}GROUP BY emotion_label ORDER BY turns DESC",
+            params,
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+
+# --- CSVからの移行 ---
+def conversation_row_to_dict(row):
+    """conversation_data.csv の1行を現在のスキーマの dict にする
+
+    6列の行は session_id のない古い形式、7列の行は現在の形式として扱う。それ以外は None。
+    """
+    names = [name for name, _ in CONVERSATION_COLUMNS]
+    if len(row) == len(LEGACY_CONVERSATION_COLUMNS):
+        row = [""] + row
+    if len(row) != len(names):
+        return None
+    return dict(zip(names, row))
+
+
+def read_conversation_csv(path):
+    """conversation_data.csv を読み、列を現在のスキーマに揃えた dict を順に返す (不正な行は読み飛ばす)"""
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for line_number, row in enumerate(reader, start=2):
+            record = conversation_row_to_dict(row)
+            if record is None:
+                logger.warning("%s:%d の列数が不正なため読み飛ばします (%d 列)", path, line_number, len(row))
+                continue
+            yield record
+
+
+def read_emotion_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        yield from csv.DictReader(f)
+
+
+def import_csv(db_path, conversation_csv=None, emotion_csv=None, force=False):
+    """既存のCSVをSQLiteに取り込み、テーブルごとの取り込み件数を返す
+
+    二重取り込みを防ぐため、取り込み先のテーブルに既に行がある場合は force=True が必要。
+    """
+    sources = {"conversations": (conversation_csv, read_conversation_csv),
+               "emotion_data": (emotion_csv, read_emotion_csv)}
+    counts = {}
+    conn = connect(db_path)
+    try:
+        with conn:
+            for table, (path, read) in sources.items():
+                if not path or not os.path.isfile(path):
+                    continue
+                existing = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                if existing and not force:
+                    raise RuntimeError(f"{table} には既に {existing} 行あります (取り込み直す場合は force=True)")
+                fieldnames = [name for name, _ in TABLES[table]]
+                rows = [{name: row.get(name) for name in fieldnames} for row in read(path)]
+                insert_rows(conn, table, fieldnames, rows)
+                counts[table] = len(rows)
+    finally:
+        conn.close()
+    return counts
+
+
+def repair_conversation_csv(path, backup=True):
+    """conversation_data.csv を現在のヘッダー (session_id あり) に書き直し、行数を返す"""
+    names = [name for name, _ in CONVERSATION_COLUMNS]
+    rows = list(read_conversation_csv(path))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=names)
+        writer.writeheader()
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    if backup:
+        os.replace(path, path + ".bak")
+    os.replace(tmp_path, path)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="CSVをSQLiteに取り込む")
+    import_parser.add_argument("--db", default="chat_data.db")
+    import_parser.add_argument("--conversations", default="conversation_data.csv")
+    import_parser.add_argument("--emotions", default="emotion_data.csv")
+    import_parser.add_argument("--force", action="store_true", help="既に行があるテーブルにも追加する")
+    repair_parser = commands.add_parser("repair-csv", help="conversation_data.csv を現在のヘッダーに書き直す")
+    repair_parser.add_argument("path", nargs="?", default="conversation_data.csv")
+    repair_parser.add_argument("--no-backup", action="store_true", help="元のファイルを .bak に残さない")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    if args.command == "import":
+        counts = import_csv(args.db, args.conversations, args.emotions, force=args.force)
+        for table, count in counts.items():
+            print(f"{table}: {count} 行を {args.db} に取り込みました")
+    else:
+        count = repair_conversation_csv(args.path, backup=not args.no_backup)
+        print(f"{args.path} を {count} 行で書き直しました")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
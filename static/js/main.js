@@ -1,6 +1,8 @@
 // --- グローバル変数 ---
 let staticCanvas;
+let faceBaseLayer; // 表情によらない背景と白目をキャッシュしたオフスクリーン画像
 let canvasCreated = false;
+let lastDrawnParamsKey = null; // 最後に描いたパラメータ (同じなら描き直さない)
 let rightCurrentParams = {}; // 右側の顔の現在のパラメータ
 let rightTargetParams = {}; // 右側の顔の目標パラメータ
 let rightStartParams = {}; // アニメーション開始時のパラメータ
@@ -9,12 +11,36 @@ let savedEmotions = new Set();
 let rightAnimationActive = false;
 let rightAnimationStartTime = null;
 let rightAnimationDuration = 1000;
+let rightTrajectory = null; // サーバーから届いた表情の軌跡 (再生中のみ)
 let lastEmotion = null; // 前回の感情座標を保存
 let sessionId = null; // セッションIDを保存
 
+// 軌跡のパラメータの並び順 (app.py の PARAM_NAMES と同じ)
+const TRAJECTORY_PARAM_NAMES = [
+  "eyeOpenness",
+  "pupilSize",
+  "pupilAngle",
+  "upperEyelidAngle",
+  "upperEyelidCoverage",
+  "lowerEyelidCoverage",
+  "mouthCurve",
+  "mouthHeight",
+  "mouthWidth",
+];
+
+// --- 描画モード ---
+// 既定では表情の遷移中かパラメータが変わったときだけ描き、止まっている間は描画ループを止める。
+// URL に ?continuous を付けると毎フレーム描き直す (比較用)、?fps を付けるとFPS・描画時間を表示する
+const urlOptions = new URLSearchParams(window.location.search);
+const RENDER_ON_DEMAND = !urlOptions.has("continuous");
+const SHOW_FPS_OVERLAY = urlOptions.has("fps");
+const FACE_BACKGROUND = [255, 235, 250];
+
+let fpsOverlay = null;
+let frameStats = { frames: 0, drawn: 0, drawTime: 0, since: 0 };
+
 // --- Socket.IO関連 ---
 const socket = io("http://127.0.0.1:5000");
-let messages = []; // チャット履歴を保持
 
 // --- p5.js setup ---
 function setup() {
@@ -22,6 +48,8 @@ function setup() {
   mainCanvas.hide();
 
   staticCanvas = createGraphics(540, 360);
+  faceBaseLayer = createGraphics(540, 360);
+  drawFaceBase();
 
   setupUIListeners();
   setupSocketListeners(); // Socket.IOリスナーを設定
@@ -42,7 +70,15 @@ function setup() {
   setTimeout(() => {
     let staticHolder = document.getElementById("static-canvas-holder");
     staticHolder.appendChild(staticCanvas.canvas);
+    if (SHOW_FPS_OVERLAY) {
+      fpsOverlay = document.createElement("div");
+      fpsOverlay.className = "fps-overlay";
+      staticHolder.appendChild(fpsOverlay);
+      // 描画ループが止まっている間も表示を更新する
+      setInterval(updateFpsOverlay, 500);
+    }
     canvasCreated = true;
+    if (!RENDER_ON_DEMAND) loop();
     redraw();
   }, 100);
 }
@@ -50,7 +86,29 @@ function setup() {
 // --- p5.js draw loop ---
 function draw() {
   if (!canvasCreated) return;
-  drawStaticFace();
+  frameStats.frames++;
+  const start = performance.now();
+  if (drawStaticFace()) {
+    frameStats.drawn++;
+  }
+  frameStats.drawTime += performance.now() - start;
+  if (RENDER_ON_DEMAND && !rightAnimationActive) {
+    noLoop(); // 遷移が終わったら描画ループを止める
+  }
+}
+
+// 1秒あたりのフレーム数・実際に描き直した数・1フレームの平均描画時間を表示する
+function updateFpsOverlay() {
+  const now = performance.now();
+  const seconds = (now - frameStats.since) / 1000;
+  if (frameStats.since && seconds > 0) {
+    const fps = frameStats.frames / seconds;
+    const avg = frameStats.frames ? frameStats.drawTime / frameStats.frames : 0;
+    fpsOverlay.textContent = frameStats.frames
+      ? `${fps.toFixed(1)} fps / 描画 ${(frameStats.drawn / seconds).toFixed(1)} 回/秒 / ${avg.toFixed(2)} ms`
+      : "停止中 (0 fps)";
+  }
+  frameStats = { frames: 0, drawn: 0, drawTime: 0, since: now };
 }
 
 // --- UIイベントリスナー設定 ---
@@ -73,22 +131,31 @@ function setupSocketListeners() {
 
   socket.on("connect", () => {
     console.log("サーバーに接続しました。");
-    // 新しい接続時にセッションIDを生成
-    sessionId = generateSessionId();
-    console.log("セッションID生成:", sessionId);
+    // 会話履歴はサーバー側でセッションIDごとに保持するので、再接続時も同じIDを使う
+    if (!sessionId) {
+      sessionId = generateSessionId();
+      console.log("セッションID生成:", sessionId);
+    }
   });
 
   socket.on("bot_stream", (data) => {
     if (!botMessageDiv) {
       botMessageDiv = addMessageToHistory("", "bot-message");
     }
-    botMessageDiv.innerHTML += data.chunk.replace(/\n/g, "<br>");
+    // innerHTML を作り直さずに末尾へ追加する (改行は <br>)
+    data.chunk.split("\n").forEach((line, i) => {
+      if (i > 0) botMessageDiv.appendChild(document.createElement("br"));
+      if (line) botMessageDiv.appendChild(document.createTextNode(line));
+    });
     const chatHistory = document.getElementById("chat-history");
     chatHistory.scrollTop = chatHistory.scrollHeight;
   });
 
   socket.on("bot_stream_end", (data) => {
-    messages.push({ role: "assistant", content: data.text });
+    if (data.interrupted && botMessageDiv) {
+      // 新しい発話で打ち切られた返答
+      botMessageDiv.classList.add("interrupted");
+    }
     if (data.emotion) {
       lastEmotion = data.emotion; // 感情座標を保存
       console.log("Saved emotion:", lastEmotion);
@@ -97,19 +164,42 @@ function setupSocketListeners() {
   });
 
   socket.on("update_expression", (params) => {
-    console.log("Received update_expression event:", params);
     // 目標パラメータを更新
     rightTargetParams = params;
-    console.log(
-      "rightTargetParams after update_expression:",
-      rightTargetParams
-    ); // ADDED LOG
     // アニメーションを実行
-    rightAnimationDuration = 1000;
-    rightStartParams = { ...rightCurrentParams };
-    rightAnimationStartTime = millis();
-    rightAnimationActive = true;
-    loop(); // drawループを再開
+    rightTrajectory = null;
+    startRightAnimation(1000);
+  });
+
+  // サーバーで計算した表情の軌跡 (float32: [秒数, キーフレーム数, パラメータ数, 値...])
+  socket.on("expression_trajectory", (buffer) => {
+    const data = new Float32Array(buffer);
+    rightTrajectory = {
+      keyframes: data[1],
+      stride: data[2],
+      frames: data.subarray(3),
+    };
+    // 最後のキーフレームを目標パラメータにしておく (途中で update_expression が来たときの起点)
+    const last = (rightTrajectory.keyframes - 1) * rightTrajectory.stride;
+    rightTargetParams = {};
+    TRAJECTORY_PARAM_NAMES.forEach((key, i) => {
+      rightTargetParams[key] = rightTrajectory.frames[last + i];
+    });
+    startRightAnimation(data[0] * 1000);
+  });
+
+  // 生成待ちの順番表示 (ASGI版サーバーで同時生成数の上限を超えた場合)
+  let queueMessageDiv = null;
+  socket.on("queue_position", (data) => {
+    if (data.position > 0) {
+      if (!queueMessageDiv) {
+        queueMessageDiv = addMessageToHistory("", "bot-message queue");
+      }
+      queueMessageDiv.innerText = `順番待ち中です (${data.position}番目)...`;
+    } else if (queueMessageDiv) {
+      queueMessageDiv.remove();
+      queueMessageDiv = null;
+    }
   });
 
   socket.on("save_success", (data) => {
@@ -133,10 +223,10 @@ function sendMessage() {
   if (text === "") return;
 
   addMessageToHistory(text, "user-message");
-  messages.push({ role: "user", content: text });
 
-  socket.emit("user_message", { 
-    messages: messages, 
+  // 履歴はサーバー側にあるので、新しい発話だけを送る
+  socket.emit("user_message", {
+    message: text,
     last_emotion: lastEmotion,
     session_id: sessionId
   });
@@ -155,27 +245,49 @@ function addMessageToHistory(text, className) {
 }
 
 // --- 表情アニメーション関連 ---
-function drawStaticFace() {
-  staticCanvas.background(255, 235, 250);
-  staticCanvas.push();
-  staticCanvas.translate(staticCanvas.width / 2, staticCanvas.height / 2);
+function startRightAnimation(duration) {
+  rightAnimationDuration = duration;
+  rightStartParams = { ...rightCurrentParams };
+  rightAnimationStartTime = millis();
+  rightAnimationActive = true;
+  loop(); // drawループを再開
+}
+
+// 表情によらない部分 (背景と白目) を一度だけオフスクリーンに描いておく
+function drawFaceBase() {
+  faceBaseLayer.background(...FACE_BACKGROUND);
+  faceBaseLayer.push();
+  faceBaseLayer.translate(faceBaseLayer.width / 2, faceBaseLayer.height / 2);
+  let originalCtx = setupContext(faceBaseLayer);
+  drawEyeBases();
+  restoreContext(originalCtx);
+  faceBaseLayer.pop();
+}
 
+// 顔を描く。パラメータが前回描いたときと同じなら何もしない (描いたら true)
+function drawStaticFace() {
   if (rightAnimationActive) {
     updateRightAnimation();
   }
 
-  // faceParamsを直接変更せず、rightCurrentParamsを直接描画関数に渡す
-  console.log(
-    "drawStaticFace - drawing with rightCurrentParams:",
-    rightCurrentParams
-  ); // ADDED LOG
+  const paramsKey = TRAJECTORY_PARAM_NAMES.map((key) => rightCurrentParams[key]).join(",");
+  if (RENDER_ON_DEMAND && paramsKey === lastDrawnParamsKey) {
+    return false;
+  }
+  lastDrawnParamsKey = paramsKey;
+
+  staticCanvas.image(faceBaseLayer, 0, 0);
+  staticCanvas.push();
+  staticCanvas.translate(staticCanvas.width / 2, staticCanvas.height / 2);
 
+  // faceParamsを直接変更せず、rightCurrentParamsを直接描画関数に渡す
   let originalCtx = setupContext(staticCanvas);
-  drawEyes(rightCurrentParams);
+  drawEyes(rightCurrentParams, true);
   drawMouth(rightCurrentParams);
   restoreContext(originalCtx);
 
   staticCanvas.pop();
+  return true;
 }
 
 function updateRightAnimation() {
@@ -187,96 +299,90 @@ function updateRightAnimation() {
       ? 2 * progress * progress
       : 1 - Math.pow(-2 * progress + 2, 2) / 2;
 
-  for (let key in rightTargetParams) {
-    if (rightStartParams[key] !== undefined) {
-      rightCurrentParams[key] = lerp(
-        rightStartParams[key],
-        rightTargetParams[key],
-        easeProgress
-      );
+  if (rightTrajectory) {
+    sampleRightTrajectory(progress, easeProgress);
+  } else {
+    for (let key in rightTargetParams) {
+      if (rightStartParams[key] !== undefined) {
+        rightCurrentParams[key] = lerp(
+          rightStartParams[key],
+          rightTargetParams[key],
+          easeProgress
+        );
+      }
     }
   }
 
-  // ADDED LOG (only if animation is active to avoid spamming console)
-  if (rightAnimationActive) {
-    console.log(
-      "updateRightAnimation - progress:",
-      progress.toFixed(2),
-      "rightCurrentParams:",
-      rightCurrentParams
-    );
-  }
-
   if (progress >= 1) {
     rightAnimationActive = false;
-    console.log(
-      "Animation finished. Final rightCurrentParams:",
-      rightCurrentParams
-    );
-    noLoop(); // アニメーション終了後にdrawループを停止
+    rightTrajectory = null;
+  }
+}
+
+// 軌跡のキーフレーム間を線形補間する。開始時の表示と軌跡の始点のずれは、
+// イージングに合わせて徐々に消す (アニメーション途中で次の軌跡が来ても表情が飛ばない)
+function sampleRightTrajectory(progress, easeProgress) {
+  const { keyframes, stride, frames } = rightTrajectory;
+  const position = progress * (keyframes - 1);
+  const index = Math.min(Math.floor(position), keyframes - 2);
+  const fraction = position - index;
+  TRAJECTORY_PARAM_NAMES.forEach((key, i) => {
+    const a = frames[index * stride + i];
+    const b = frames[(index + 1) * stride + i];
+    const offset =
+      rightStartParams[key] !== undefined ? rightStartParams[key] - frames[i] : 0;
+    rightCurrentParams[key] = lerp(a, b, fraction) + offset * (1 - easeProgress);
+  });
+}
+
+// レンダラー (eye-renderer.js / mouth-renderer.js) が呼ぶ p5 のグローバル関数を canvas に向ける。
+// 差し替える関数は canvas ごとに1回だけ作り、毎フレームは付け替えるだけにする
+const contextOverrides = new Map();
+
+function canvasOverrides(canvas) {
+  let overrides = contextOverrides.get(canvas);
+  if (!overrides) {
+    overrides = {
+      push: () => canvas.push(),
+      pop: () => canvas.pop(),
+      translate: (x, y) => canvas.translate(x, y),
+      fill: (...args) => canvas.fill(...args),
+      stroke: (...args) => canvas.stroke(...args),
+      strokeWeight: (w) => canvas.strokeWeight(w),
+      ellipse: (x, y, w, h) => canvas.ellipse(x, y, w, h),
+      arc: (x, y, w, h, start, stop, mode) => canvas.arc(x, y, w, h, start, stop, mode),
+      rotate: (angle) => canvas.rotate(angle),
+      radians: (degrees) => canvas.radians(degrees),
+      rect: (x, y, w, h) => canvas.rect(x, y, w, h),
+      line: (x1, y1, x2, y2) => canvas.line(x1, y1, x2, y2),
+      noFill: () => canvas.noFill(),
+      noStroke: () => canvas.noStroke(),
+      beginShape: () => canvas.beginShape(),
+      vertex: (x, y) => canvas.vertex(x, y),
+      bezierVertex: (...args) => canvas.bezierVertex(...args),
+      endShape: (mode) => canvas.endShape(mode),
+      curveVertex: (x, y) => canvas.curveVertex(x, y),
+      width: canvas.width,
+      height: canvas.height,
+      drawingContext: canvas.canvas.getContext("2d"),
+    };
+    contextOverrides.set(canvas, overrides);
   }
+  return overrides;
 }
 
 function setupContext(canvas) {
-  const original = {
-    push: window.push,
-    pop: window.pop,
-    translate: window.translate,
-    fill: window.fill,
-    stroke: window.stroke,
-    strokeWeight: window.strokeWeight,
-    ellipse: window.ellipse,
-    arc: window.arc,
-    rotate: window.rotate,
-    radians: window.radians,
-    rect: window.rect,
-    line: window.line,
-    noFill: window.noFill,
-    noStroke: window.noStroke,
-    beginShape: window.beginShape,
-    vertex: window.vertex,
-    endShape: window.endShape,
-    curveVertex: window.curveVertex,
-    width: window.width,
-    height: window.height,
-    drawingContext: window.drawingContext,
-    abs: window.abs,
-    asin: window.asin,
-    cos: window.cos,
-    sin: window.sin,
-    PI: window.PI,
-    TWO_PI: window.TWO_PI,
-    CLOSE: window.CLOSE,
-  };
-  window.push = () => canvas.push();
-  window.pop = () => canvas.pop();
-  window.translate = (x, y) => canvas.translate(x, y);
-  window.fill = (...args) => canvas.fill(...args);
-  window.stroke = (...args) => canvas.stroke(...args);
-  window.strokeWeight = (w) => canvas.strokeWeight(w);
-  window.ellipse = (x, y, w, h) => canvas.ellipse(x, y, w, h);
-  window.arc = (x, y, w, h, start, stop, mode) =>
-    canvas.arc(x, y, w, h, start, stop, mode);
-  window.rotate = (angle) => canvas.rotate(angle);
-  window.radians = (degrees) => canvas.radians(degrees);
-  window.rect = (x, y, w, h) => canvas.rect(x, y, w, h);
-  window.line = (x1, y1, x2, y2) => canvas.line(x1, y1, x2, y2);
-  window.noFill = () => canvas.noFill();
-  window.noStroke = () => canvas.noStroke();
-  window.beginShape = () => canvas.beginShape();
-  window.vertex = (x, y) => canvas.vertex(x, y);
-  window.endShape = (mode) => canvas.endShape(mode);
-  window.curveVertex = (x, y) => canvas.curveVertex(x, y);
-  window.width = canvas.width;
-  window.height = canvas.height;
-  window.drawingContext = canvas.canvas.getContext("2d");
+  const overrides = canvasOverrides(canvas);
+  const original = {};
+  Object.keys(overrides).forEach((key) => {
+    original[key] = window[key];
+  });
+  Object.assign(window, overrides);
   return original;
 }
 
 function restoreContext(original) {
-  Object.keys(original).forEach((key) => {
-    window[key] = original[key];
-  });
+  Object.assign(window, original);
 }
 
 // --- For Debugging ---
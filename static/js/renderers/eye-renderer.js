@@ -1,6 +1,7 @@
 // 目の描画関数
 
-function drawEyes(params) {
+// baseCached が true のときは白目を描かない (main.js がキャッシュした土台の画像に描いてある)
+function drawEyes(params, baseCached = false) {
   let eyeSpacing = width * 0.42; // 画面の横幅の40%
   let eyeSize = 120;
 
@@ -10,24 +11,42 @@ function drawEyes(params) {
   // 左目
   push();
   translate(-eyeSpacing / 2, eyeY);
-  drawEye(eyeSize, true, params); // 左目
+  drawEye(eyeSize, true, params, baseCached); // 左目
   pop();
 
   // 右目
   push();
   translate(eyeSpacing / 2, eyeY);
-  drawEye(eyeSize, false, params); // 右目
+  drawEye(eyeSize, false, params, baseCached); // 右目
   pop();
 }
 
-function drawEye(size, isLeft, params) {
-  push();
+// 表情によらない白目だけを描く (main.js の土台の画像用)
+function drawEyeBases() {
+  let eyeSpacing = width * 0.42;
+  let eyeSize = 120;
+  [-1, 1].forEach((side) => {
+    push();
+    translate((side * eyeSpacing) / 2, 0);
+    drawEyeBase(eyeSize);
+    pop();
+  });
+}
 
+function drawEyeBase(size) {
   // 白目部分
   fill(240, 255, 240);
   stroke(0);
   strokeWeight(2);
   ellipse(0, 0, size, size);
+}
+
+function drawEye(size, isLeft, params, baseCached = false) {
+  push();
+
+  if (!baseCached) {
+    drawEyeBase(size);
+  }
 
   // 目の開き具合に応じて描画を変更
   if (params.eyeOpenness <= 0.1) {
@@ -0,0 +1,73 @@
+"""生成中の中断 (新しい発話・切断) のテスト
+
+    python -m pytest test_cancellation.py
+"""
+import asyncio
+import threading
+import time
+
+import app
+import asgi_app
+from app import CancellableStream, Generation, wait_for_previous_turn
+from llm_backend import ScriptedBackend
+
+REPLY = '<thought>考え中</thought>\n<emotion v="0.5" a="0.2">joy</emotion>\nこんにちは'
+SLOW_FIRST_TOKEN = 30.0  # 最初のチャンクまでの秒数 (プロンプトの評価中を模す)
+
+
+def slow_stream(first_delay):
+    time.sleep(first_delay)
+    yield {"message": {"role": "assistant", "content": "遅い"}, "done": False}
+
+
+def test_sync_stream_ends_promptly_when_cancelled_before_first_chunk():
+    generation = Generation("cancel-sync", "sid")
+    stream = CancellableStream(slow_stream(1.0), generation)
+    chunks = []
+    started = time.monotonic()
+    threading.Timer(0.1, generation.cancel, args=("barge_in",)).start()
+    for chunk in stream:
+        chunks.append(chunk)
+    assert time.monotonic() - started < 0.5
+    assert stream.cancelled
+    assert chunks == []
+
+
+def test_sync_stream_passes_chunks_through_when_not_cancelled():
+    stream = CancellableStream(ScriptedBackend([REPLY], time_to_first_token=0, token_rate=0).chat([]),
+                               Generation("cancel-sync-done", "sid"))
+    text = "".join(chunk["message"]["content"] for chunk in stream)
+    assert text == REPLY
+    assert not stream.cancelled
+
+
+def test_asgi_turn_ends_promptly_when_cancelled_before_first_chunk(monkeypatch):
+    events = []
+
+    async def emit(event, payload=None, to=None, **kwargs):
+        events.append((event, payload))
+
+    monkeypatch.setattr(asgi_app.sio, "emit", emit)
+    monkeypatch.setattr(asgi_app, "llm_backend", ScriptedBackend([REPLY], time_to_first_token=SLOW_FIRST_TOKEN))
+
+    async def scenario():
+        generation = Generation("cancel-asgi", "sid")
+        data = {"session_id": "cancel-asgi", "message": "こんにちは"}
+        task = asyncio.ensure_future(asgi_app.run_chat_turn("sid", data, generation, time.time()))
+        await asyncio.sleep(0.1)
+        started = time.monotonic()
+        generation.cancel("barge_in")
+        await asyncio.wait_for(task, 5)
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 1.0
+    end = [payload for event, payload in events if event == "bot_stream_end"]
+    assert end and end[-1]["interrupted"]
+
+
+def test_new_turn_waits_for_previous_turn_past_the_warning_interval(monkeypatch):
+    monkeypatch.setattr(app, "CANCEL_WAIT_WARNING_INTERVAL", 0.05)
+    previous = Generation("cancel-order", "sid")
+    threading.Timer(0.3, previous.done.set).start()
+    wait_for_previous_turn(previous)
+    assert previous.done.is_set()
@@ -0,0 +1,107 @@
+"""会話履歴のコンテキスト管理 (ContextWindow / 要約への畳み込み) のテスト
+
+    python -m pytest test_context_window.py
+"""
+import uuid
+
+import pytest
+
+import app
+from context_window import ContextWindow, estimate_tokens, message_tokens
+from llm_backend import LLMBackend
+from session_store import MemorySessionStore
+
+BUDGET = app.CONTEXT_TOKEN_BUDGET
+
+
+class FakeSummaryBackend(LLMBackend):
+    """要約の依頼を記録し、短い要約を返すバックエンド"""
+
+    def __init__(self):
+        self.requests = []
+
+    def complete(self, messages, **kwargs):
+        self.requests.append(messages)
+        return f"要約{len(self.requests)}"
+
+
+def prompt_tokens(messages):
+    return sum(message_tokens(m) for m in messages)
+
+
+@pytest.fixture
+def context(monkeypatch):
+    backend = FakeSummaryBackend()
+    monkeypatch.setattr(app, "llm_backend", backend)
+    monkeypatch.setattr(app, "session_store", MemorySessionStore(idle_timeout=3600, max_count=100))
+    monkeypatch.setattr(app, "context_window", ContextWindow(BUDGET, fold_target=0.5, min_recent_messages=4))
+    monkeypatch.setattr(app, "history_summarizer", None)
+    monkeypatch.setattr(app, "PROMPT_PREFIX_CACHE", False)
+    return backend
+
+
+def run_turns(session_id, count, fold):
+    """count ターン分の発話と返答を履歴に積み、送ったプロンプトのトークン数と全発話を返す"""
+    sent = []
+    sizes = []
+    for i in range(count):
+        message = f"{i}番目の話題について、最近あったことを少し長めに話してみます。"
+        reply = f"{i}番目の話、聞かせてくれてありがとう。もう少し詳しく教えてくれる？"
+        _, session = app.start_session_turn({"session_id": session_id, "message": message})
+        sizes.append(prompt_tokens(app.build_chat_messages(session)))
+        app.update_session(session_id, lambda s: app.append_session_message(s, "assistant", reply))
+        app.update_session(session_id, lambda s: s.__setitem__("last_emotion", {"v": 0.1, "a": 0.2, "label": "calm"}))
+        sent += [message, reply]
+        if fold:
+            app.fold_session_history(session_id)
+    return sizes, sent
+
+
+def folded_contents(backend):
+    """要約に畳み込まれた発話の本文 (依頼した順)"""
+    contents = []
+    for request in backend.requests:
+        transcript = request[1]["content"].split("# New conversation\n", 1)[1]
+        contents += [line.split(": ", 1)[1] for line in transcript.split("\n")]
+    return contents
+
+
+def test_fit_keeps_recent_messages_within_budget_starting_with_user():
+    window = ContextWindow(200, min_recent_messages=2)
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": "あ" * 30} for i in range(10)]  # 1件 35
+    kept = window.fit(history, summary="", reserved=40)
+    assert kept == history[-4:]
+    assert prompt_tokens(kept) <= 160
+    # 要約の分も予算から引き、収まった3件の先頭 (assistant) は外す
+    assert window.fit(history, summary="い" * 30, reserved=40) == history[-2:]
+    # 予算を超えても直近 min_recent_messages 件は送る
+    assert window.fit(history, reserved=200) == history[-2:]
+
+
+def test_fold_count_folds_whole_turns_down_to_target():
+    window = ContextWindow(200, fold_target=0.5, min_recent_messages=2)
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": "あ" * 30} for i in range(10)]
+    assert window.fold_count(history[:4]) == 0
+    count = window.fold_count(history, reserved=50)
+    assert count % 2 == 0 and history[count]["role"] == "user"
+    assert prompt_tokens(history[count:]) <= window.history_budget(50) * 0.5
+
+
+def test_prompt_stays_within_budget_and_folded_turns_are_summarised(context):
+    session_id = f"context-{uuid.uuid4()}"
+    sizes, sent = run_turns(session_id, 40, fold=True)
+    assert max(sizes) <= BUDGET
+    session = app.session_store.get(session_id)
+    assert session["summary"] == f"要約{len(context.requests)}"
+    # 要約に畳んだ発話と残っている発話を合わせると、すべての発話が順に1回ずつ現れる
+    assert folded_contents(context) + [m["content"] for m in session["messages"]] == sent
+
+
+def test_unsummarised_turns_are_kept_while_summary_lags(context):
+    session_id = f"context-lag-{uuid.uuid4()}"
+    sizes, sent = run_turns(session_id, 40, fold=False)
+    assert max(sizes) <= BUDGET
+    session = app.session_store.get(session_id)
+    assert [m["content"] for m in session["messages"]] == sent
+    assert len(sent) > app.SESSION_MAX_MESSAGES
+    assert estimate_tokens("".join(sent)) > BUDGET
@@ -0,0 +1,57 @@
+"""EmotionStreamParser / ChatTurn のストリーム終了時の処理のテスト
+
+    python -m pytest test_emotion_stream_parser.py
+"""
+from app import NEUTRAL_EXPRESSION_PARAMS, UNTERMINATED_THOUGHT_REPLY, ChatTurn, EmotionStreamParser
+
+
+def feed_all(parser, chunks):
+    events = []
+    for chunk in chunks:
+        events += parser.feed(chunk)
+    return events + parser.finish()
+
+
+def replies(events):
+    return "".join(value for kind, value in events if kind == "reply")
+
+
+def test_closed_thought_then_emotion():
+    events = feed_all(EmotionStreamParser(), ['<thought>考え中</thought><emotion v="0.5" a="0.2">joy</emotion>\nはい'])
+    assert ("emotion", (0.5, 0.2, "joy", '<emotion v="0.5" a="0.2">joy</emotion>')) in events
+    assert replies(events) == "はい"
+    assert not EmotionStreamParser().thought_unterminated
+
+
+def test_unterminated_thought_falls_back_to_fixed_reply():
+    parser = EmotionStreamParser()
+    events = feed_all(parser, ["<thought>ユーザーは", "落ち込んでいるので"])
+    assert parser.thought_unterminated
+    assert parser.fallback_reason
+    assert ("neutral", None) in events
+    assert replies(events) == UNTERMINATED_THOUGHT_REPLY
+
+
+def test_unterminated_thought_recovers_emotion_and_reply():
+    parser = EmotionStreamParser()
+    events = feed_all(parser, ["<thought>考え", '中<emotion v="-0.3" a="0.1">sad</emo', "tion>\nそれはつらいね"])
+    assert parser.emotion[:3] == (-0.3, 0.1, "sad")
+    assert ("neutral", None) not in events
+    assert replies(events) == "それはつらいね"
+
+
+def test_chat_turn_sends_fallback_reply_with_neutral_expression():
+    turn = ChatTurn(previous_emotion={"v": 0.8, "a": 0.5, "label": "joy"})
+    events = turn.feed("<thought>考え中") + turn.finish()
+    assert ("update_expression", NEUTRAL_EXPRESSION_PARAMS) in events
+    assert events[-1] == ("bot_stream_end", {"text": UNTERMINATED_THOUGHT_REPLY, "emotion": None,
+                                             "interrupted": False})
+
+
+def test_interrupted_turn_gets_no_fallback_reply():
+    turn = ChatTurn()
+    turn.feed("<thought>考え中")
+    turn.interrupt("barge_in", 0.0)
+    events = turn.finish()
+    assert all(event != "update_expression" for event, _ in events)
+    assert turn.full_text == ""
@@ -0,0 +1,33 @@
+"""表情LUTのキャッシュのテスト
+
+    python -m pytest test_expression_lut.py
+"""
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def lut_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "EXPRESSION_LUT_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "EXPRESSION_LUT_RESOLUTION", 41)
+    monkeypatch.setattr(app, "EXPRESSION_LUT_MAX_ERROR", 10.0)
+    monkeypatch.setattr(app, "_expression_lut", None)
+    monkeypatch.setattr(app, "_expression_lut_step", None)
+    return tmp_path
+
+
+@pytest.mark.parametrize("contents", [b"", b"PK\x03\x04", b"not a cache"])
+def test_broken_cache_is_rebuilt(lut_cache_dir, contents):
+    assert app.load_or_build_expression_lut()
+    [name] = os.listdir(lut_cache_dir)
+    path = lut_cache_dir / name
+    table = app._expression_lut.copy()
+    path.write_bytes(contents)
+
+    assert app.load_or_build_expression_lut()
+    assert (app._expression_lut == table).all()
+    assert app.read_expression_lut_cache(str(path)) is not None
+    assert os.listdir(lut_cache_dir) == [name]  # 一時ファイルは残らない
@@ -0,0 +1,93 @@
+"""ASGI版サーバーの生成枠 (MAX_CONCURRENT_GENERATIONS) と待ち行列のテスト
+
+    python -m pytest test_generation_queue.py
+"""
+import asyncio
+import time
+
+import pytest
+
+import asgi_app
+from app import Generation
+from llm_backend import LLMBackend
+
+SLOTS = 2
+REPLY = '<thought>考え中</thought>\n<emotion v="0.5" a="0.2">joy</emotion>\nはい'
+
+
+class CountingBackend(LLMBackend):
+    """同時に生成しているリクエストの数を数えるバックエンド"""
+
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+
+    async def achat(self, messages, **kwargs):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.05)
+            yield {"message": {"role": "assistant", "content": REPLY}, "done": False}
+        finally:
+            self.running -= 1
+
+
+@pytest.fixture
+def events(monkeypatch):
+    sent = []
+
+    async def emit(event, payload=None, to=None, **kwargs):
+        sent.append((to, event, payload))
+
+    monkeypatch.setattr(asgi_app.sio, "emit", emit)
+    monkeypatch.setattr(asgi_app, "_generation_slots", asyncio.Semaphore(SLOTS))
+    monkeypatch.setattr(asgi_app, "_waiting", [])
+    return sent
+
+
+def test_at_most_max_concurrent_turns_generate_at_once(events, monkeypatch):
+    backend = CountingBackend()
+    monkeypatch.setattr(asgi_app, "llm_backend", backend)
+
+    async def scenario():
+        turns = [
+            asgi_app.run_chat_turn(f"sid-{i}", {"session_id": f"queue-{i}-{time.monotonic()}", "message": f"発話{i}"},
+                                   Generation(f"queue-{i}", f"sid-{i}"), time.time())
+            for i in range(6)
+        ]
+        await asyncio.wait_for(asyncio.gather(*turns), 5)
+
+    asyncio.run(scenario())
+    assert backend.max_running == SLOTS
+    assert sum(1 for _, event, _ in events if event == "bot_stream_end") == 6
+    assert max(payload["position"] for _, event, payload in events if event == "queue_position") == 4
+    assert asgi_app._waiting == []
+    assert not asgi_app._generation_slots.locked()
+
+
+def test_cancelled_waiter_leaves_queue_without_taking_a_slot(events):
+    async def scenario():
+        for _ in range(SLOTS):
+            await asgi_app._generation_slots.acquire()
+        first = Generation("waiter-1", "sid-1")
+        second = Generation("waiter-2", "sid-2")
+        first_wait = asyncio.ensure_future(asgi_app.acquire_generation_slot("sid-1", first))
+        second_wait = asyncio.ensure_future(asgi_app.acquire_generation_slot("sid-2", second))
+        await asyncio.sleep(0.05)
+        assert [sid for _, sid in asgi_app._waiting] == ["sid-1", "sid-2"]
+
+        first.cancel("disconnect")
+        assert await asyncio.wait_for(first_wait, 1) is False
+        assert [sid for _, sid in asgi_app._waiting] == ["sid-2"]
+        assert ("sid-2", "queue_position", {"position": 1}) in events
+
+        # 空いた枠は中断した待ち手ではなく、次の待ち手に渡る
+        asgi_app._generation_slots.release()
+        assert await asyncio.wait_for(second_wait, 1) is True
+        assert asgi_app._generation_slots.locked()
+        for _ in range(SLOTS):
+            asgi_app._generation_slots.release()
+
+    asyncio.run(scenario())
+    assert asgi_app._waiting == []
+    assert asgi_app._generation_slots._value == SLOTS
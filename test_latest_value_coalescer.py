@@ -0,0 +1,43 @@
+"""手動の表情更新を間引く LatestValueCoalescer のテスト
+
+    python -m pytest test_latest_value_coalescer.py
+"""
+from app import LatestValueCoalescer
+
+
+def test_first_offer_is_taken_immediately():
+    coalescer = LatestValueCoalescer(max_rate=4)
+    assert coalescer.offer("sid", (0.1, 0.2), now=0.0) == 0.0
+    assert coalescer.take("sid", now=0.0) == (0.1, 0.2)
+    assert coalescer.take("sid", now=0.0) is None
+
+
+def test_offer_within_interval_returns_remaining_delay():
+    coalescer = LatestValueCoalescer(max_rate=4)  # 0.25秒に1回
+    coalescer.offer("sid", (0.1, 0.2), now=10.0)
+    coalescer.take("sid", now=10.0)
+    assert coalescer.offer("sid", (0.3, 0.4), now=10.125) == 0.125
+    assert coalescer.offer("other", (0.5, 0.5), now=10.125) == 0.0  # キーごとに独立
+    assert coalescer.offer("sid", (0.6, 0.6), now=11.0) is None  # 予約済み
+
+
+def test_later_value_replaces_earlier_and_take_returns_only_latest():
+    coalescer = LatestValueCoalescer(max_rate=4)
+    coalescer.offer("sid", (0.0, 0.0), now=0.0)
+    coalescer.take("sid", now=0.0)
+    assert coalescer.offer("sid", (0.1, 0.1), now=0.05) is not None
+    assert coalescer.offer("sid", (0.2, 0.2), now=0.1) is None
+    assert coalescer.offer("sid", (0.3, 0.3), now=0.15) is None
+    assert coalescer.take("sid", now=0.25) == (0.3, 0.3)
+    assert coalescer.take("sid", now=0.25) is None
+    assert (coalescer.received, coalescer.dropped, coalescer.taken) == (4, 2, 2)
+
+
+def test_forget_drops_pending_value_and_rate_limit():
+    coalescer = LatestValueCoalescer(max_rate=4)
+    coalescer.offer("sid", (0.1, 0.1), now=0.0)
+    coalescer.take("sid", now=0.0)
+    coalescer.offer("sid", (0.2, 0.2), now=0.1)
+    coalescer.forget("sid")
+    assert coalescer.take("sid", now=0.1) is None
+    assert coalescer.offer("sid", (0.3, 0.3), now=0.1) == 0.0
@@ -0,0 +1,61 @@
+"""不正な user_message とセッションの準備に失敗したターンのテスト
+
+    python -m pytest test_message_validation.py
+"""
+import asyncio
+import time
+
+import pytest
+
+import asgi_app
+from app import INVALID_MESSAGE_ERROR, Generation, generation_registry, validate_user_message
+
+
+@pytest.mark.parametrize("data", [
+    None,
+    "こんにちは",
+    {},
+    {"message": 123},
+    {"messages": "こんにちは"},
+    {"messages": [{"role": "user"}]},
+    {"message": "こんにちは", "session_id": 1},
+    {"message": "こんにちは", "last_emotion": "joy"},
+])
+def test_malformed_messages_are_rejected(data):
+    with pytest.raises((ValueError, KeyError, TypeError)):
+        validate_user_message(data)
+
+
+def test_well_formed_messages_are_accepted():
+    validate_user_message({"message": "こんにちは", "session_id": "s1", "last_emotion": None})
+    validate_user_message({"messages": [{"role": "user", "content": "こんにちは"}], "last_emotion": {"v": 0.1}})
+
+
+@pytest.fixture
+def events(monkeypatch):
+    sent = []
+
+    async def emit(event, payload=None, to=None, **kwargs):
+        sent.append((event, payload))
+
+    monkeypatch.setattr(asgi_app.sio, "emit", emit)
+    monkeypatch.setattr(asgi_app, "_generation_slots", asyncio.Semaphore(1))
+    monkeypatch.setattr(asgi_app, "_waiting", [])
+    return sent
+
+
+def test_malformed_message_gets_error_event_without_starting_a_turn(events):
+    asyncio.run(asgi_app.handle_message("sid", {"message": None, "session_id": "invalid"}))
+    assert events == [("error", {"message": INVALID_MESSAGE_ERROR})]
+    assert len(generation_registry) == 0
+
+
+def test_failed_session_start_ends_the_turn_and_frees_the_slot(events, monkeypatch):
+    def broken_store(data):
+        raise OSError("セッションの保存先に接続できません")
+
+    monkeypatch.setattr(asgi_app, "start_session_turn", broken_store)
+    generation = Generation("broken-store", "sid")
+    asyncio.run(asgi_app.run_chat_turn("sid", {"message": "こんにちは"}, generation, time.time()))
+    assert not asgi_app._generation_slots.locked()
+    assert asgi_app._waiting == []
@@ -0,0 +1,79 @@
+"""応答キャッシュ (ResponseCache) のテスト
+
+    python -m pytest test_response_cache.py
+"""
+import asyncio
+
+from app import ChatTurn, EmotionStreamParser
+from response_cache import ResponseCache, normalize_utterance
+
+JOY = {"v": 0.5, "a": 0.2, "label": "joy"}
+
+
+def user(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_normalize_strips_spacing_punctuation_and_width_but_keeps_emoji():
+    assert normalize_utterance("こんにちは！！") == normalize_utterance(" こんにちは ")
+    assert normalize_utterance("ＨＥＬＬＯ〜？") == "hello"
+    assert normalize_utterance("やったー😊") != normalize_utterance("やったー😢")
+
+
+def test_empty_normalised_utterance_has_no_key():
+    cache = ResponseCache()
+    assert cache.key(user("！！"), JOY) is None
+    assert cache.key(user("…"), JOY) is None
+    assert cache.key([], JOY) is None
+
+
+def test_hit_and_miss():
+    cache = ResponseCache()
+    key = cache.key(user("こんにちは"), JOY)
+    assert cache.get(key) is None
+    cache.put(key, JOY, "こんにちは！")
+    assert cache.key(user("こんにちは。"), JOY) == key
+    assert cache.get(key)["reply"] == "こんにちは！"
+    assert cache.key(user("こんにちは"), {"v": -0.8, "a": -0.8, "label": "sad"}) != key  # 感情の区画が違う
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_and_evicted_entries_miss():
+    cache = ResponseCache(max_bytes=12, ttl=10.0)
+    cache.put("a", JOY, "ああ", now=0.0)    # 6 バイト
+    cache.put("b", JOY, "いい", now=0.0)
+    assert cache.get("a", now=5.0) is not None
+    cache.put("c", JOY, "うう", now=0.0)      # 最も古く使われた b を捨てる
+    assert cache.get("b", now=5.0) is None
+    assert cache.evictions == 1 and cache.bytes == 12
+    assert cache.get("a", now=20.0) is None  # 期限切れ
+    assert len(cache) == 1
+
+
+def test_response_text_uses_fixed_point_and_round_trips_through_parser():
+    cache = ResponseCache()
+    entry = {"emotion": {"v": 1e-05, "a": -0.25, "label": "calm"}, "reply": "そうだね"}
+    text = cache.response_text(entry)
+    assert text.startswith('<emotion v="0.000" a="-0.250">calm</emotion>')
+    parser = EmotionStreamParser()
+    events = parser.feed(text) + parser.finish()
+    assert parser.emotion[:3] == (0.0, -0.25, "calm")
+    assert "".join(value for kind, value in events if kind == "reply") == "そうだね"
+
+
+def test_replay_drives_chat_turn_like_a_generated_reply():
+    cache = ResponseCache(replay_rate=0)
+    entry = {"emotion": JOY, "reply": "こんにちは！元気？"}
+    for chunks in (list(cache.replay(entry)), asyncio.run(collect(cache.areplay(entry)))):
+        turn = ChatTurn()
+        events = []
+        for chunk in chunks:
+            events += turn.feed_chunk(chunk)
+        events += turn.finish()
+        assert [event for event, _ in events].count("update_expression") == 1
+        assert events[-1][1]["text"] == "こんにちは！元気？"
+        assert events[-1][1]["emotion"]["label"] == "joy"
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
@@ -0,0 +1,89 @@
+"""セッションの保存先 (MemorySessionStore / SqliteSessionStore) のテスト
+
+    python -m pytest test_session_store.py
+"""
+import threading
+
+import pytest
+
+import app
+from session_store import MemorySessionStore, SqliteSessionStore
+
+THREADS = 8
+TURNS_PER_THREAD = 10
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemorySessionStore(idle_timeout=60, max_count=2)
+    return SqliteSessionStore(str(tmp_path / "sessions.db"), idle_timeout=60, max_count=2)
+
+
+def test_round_trip_returns_independent_copies(store):
+    def apply(session):
+        session["messages"].append({"role": "user", "content": "こんにちは😊"})
+        session["last_emotion"] = {"v": 0.5, "a": 0.2, "label": "joy"}
+        session["summary"] = "前回は天気の話をした"
+
+    saved = store.update("s1", apply)
+    saved["messages"].append({"role": "assistant", "content": "書き換え"})
+    loaded = store.get("s1")
+    assert loaded == {"messages": [{"role": "user", "content": "こんにちは😊"}],
+                      "last_emotion": {"v": 0.5, "a": 0.2, "label": "joy"},
+                      "summary": "前回は天気の話をした"}
+    loaded["messages"].clear()
+    assert len(store.get("s1")["messages"]) == 1
+
+
+def test_update_uses_create_for_new_sessions_only(store):
+    restored = {"messages": [{"role": "user", "content": "復元"}], "last_emotion": None, "summary": ""}
+    store.update("s1", lambda s: None, create=lambda: restored)
+    store.update("s1", lambda s: s["messages"].append({"role": "assistant", "content": "返答"}),
+                 create=lambda: pytest.fail("既存のセッションを作り直した"))
+    assert [m["content"] for m in store.get("s1")["messages"]] == ["復元", "返答"]
+
+
+def test_update_without_create_skips_missing_session(store):
+    assert store.update("missing", lambda s: s.__setitem__("summary", "x"), create=False) is None
+    assert store.get("missing") is None
+
+
+def test_expire_drops_idle_and_oldest_sessions(store):
+    for session_id in ("a", "b", "c"):
+        store.put(session_id, {"messages": [], "last_emotion": None, "summary": ""})
+    store.expire()
+    assert store.get("a") is None  # max_count を超えた最も古いセッション
+    assert store.get("c") is not None
+    store.expire(now=10 ** 10)
+    assert store.get("b") is None and store.get("c") is None
+
+
+def test_concurrent_turns_on_one_session_lose_no_messages(store, monkeypatch):
+    monkeypatch.setattr(app, "session_store", store)
+    monkeypatch.setattr(app, "SESSION_MAX_MESSAGES", 1000)
+    store.max_count = 100
+    session_id = "concurrent"
+    errors = []
+
+    def run(worker):
+        try:
+            for i in range(TURNS_PER_THREAD):
+                _, session = app.start_session_turn({"session_id": session_id, "message": f"u{worker}-{i}"})
+                turn = app.ChatTurn()
+                turn.feed(f'<emotion v="0.1" a="0.2">calm</emotion>\nr{worker}-{i}')
+                turn.finish()
+                app.finish_session_turn(session, turn)
+        except Exception as e:  # pragma: no cover - 失敗時にスレッドの例外を表に出す
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    contents = [m["content"] for m in store.get(session_id)["messages"]]
+    expected = [f"{kind}{worker}-{i}" for kind in "ur" for worker in range(THREADS) for i in range(TURNS_PER_THREAD)]
+    assert sorted(contents) == sorted(expected)
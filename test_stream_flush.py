@@ -0,0 +1,171 @@
+"""bot_stream をまとめて送る処理 (StreamCoalescer / StreamFlusher / StreamFlushTimer) のテスト
+
+    python -m pytest test_stream_flush.py
+"""
+import asyncio
+import random
+import threading
+import time
+
+import asgi_app
+from app import ChatTurn, Generation, StreamCoalescer, StreamFlusher
+from llm_backend import LLMBackend
+
+TAG = '<thought>考え中</thought>\n<emotion v="0.5" a="0.2">joy</emotion>\n'
+REPLY = "こんにちは、今日はいい天気ですね。散歩に行きたくなります。"
+
+
+def text_chunk(text, done=False):
+    return {"message": {"role": "assistant", "content": text}, "done": done}
+
+
+def streamed_text(events):
+    return "".join(payload["chunk"] for event, payload in events if event == "bot_stream")
+
+
+def stream_end(events):
+    return [payload for event, payload in events if event == "bot_stream_end"][-1]
+
+
+def test_first_chunk_is_sent_immediately_and_later_chunks_wait_for_interval():
+    coalescer = StreamCoalescer(interval=0.25, max_bytes=1000)
+    assert coalescer.add("あ", now=10.0) == "あ"
+    assert coalescer.add("い", now=10.1) is None
+    assert coalescer.add("う", now=10.2) is None
+    assert coalescer.add("え", now=10.25) == "いうえ"
+    assert coalescer.frames == 2
+
+
+def test_byte_threshold_flushes_before_interval():
+    coalescer = StreamCoalescer(interval=10.0, max_bytes=9)
+    assert coalescer.add("a", now=0.0) == "a"
+    assert coalescer.add("あい", now=0.01) is None    # 6 バイト
+    assert coalescer.add("う", now=0.02) == "あいう"  # 9 バイト
+    assert coalescer.delay(now=0.03) is None
+
+
+def test_delay_counts_down_from_last_flush():
+    coalescer = StreamCoalescer(interval=0.1, max_bytes=1000)
+    assert coalescer.delay(now=0.0) is None
+    coalescer.add("a", now=0.0)
+    coalescer.add("b", now=0.03)
+    assert abs(coalescer.delay(now=0.03) - 0.07) < 1e-9
+    assert coalescer.delay(now=0.5) == 0.0
+    assert coalescer.flush(now=0.5) == "b"
+    assert coalescer.flush(now=0.5) is None
+
+
+def test_no_text_lost_or_duplicated_across_feed_flush_and_finish():
+    rng = random.Random(0)
+    for _ in range(50):
+        text = TAG + REPLY
+        turn = ChatTurn()
+        turn.stream_coalescer = StreamCoalescer(interval=rng.choice([0.0, 0.001, 10.0]),
+                                                max_bytes=rng.randint(1, 40))
+        events = []
+        position = 0
+        while position < len(text):
+            size = rng.randint(1, 6)
+            events += turn.feed_chunk(text_chunk(text[position:position + size]))
+            position += size
+            if rng.random() < 0.3:
+                events += turn.flush_stream()
+        events += turn.finish()
+        assert streamed_text(events) == REPLY
+        assert stream_end(events)["text"] == REPLY
+
+
+def test_sync_flusher_sends_buffered_text_while_stream_is_stalled():
+    turn = ChatTurn()
+    turn.stream_coalescer = StreamCoalescer(interval=0.05, max_bytes=1000)
+    sent = []
+    arrived = threading.Event()
+
+    def send(event, payload):
+        sent.append((event, payload))
+        if streamed_text(sent) == REPLY:
+            arrived.set()
+
+    flusher = StreamFlusher(turn, send)
+    try:
+        with flusher.lock:
+            for event, payload in turn.feed_chunk(text_chunk(TAG + REPLY[:3])) + turn.feed_chunk(text_chunk(REPLY[3:])):
+                send(event, payload)
+        assert streamed_text(sent) == REPLY[:3]
+        assert arrived.wait(1.0)
+    finally:
+        flusher.stop()
+
+
+class StallingBackend(LLMBackend):
+    """返答を少し流したあと、最後まで止まったままのバックエンド"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def achat(self, messages, **kwargs):
+        for chunk in self.chunks:
+            yield text_chunk(chunk)
+        await asyncio.sleep(30)
+        yield text_chunk("届かない")
+
+
+def run_asgi_turn(monkeypatch, chunks, cancel_after):
+    events = []
+
+    async def emit(event, payload=None, to=None, **kwargs):
+        events.append((event, payload))
+
+    monkeypatch.setattr(asgi_app.sio, "emit", emit)
+    monkeypatch.setattr(asgi_app, "llm_backend", StallingBackend(chunks))
+    monkeypatch.setattr(asgi_app, "StreamFlushTimer", NoTimerFlushTimer)
+
+    async def scenario():
+        generation = Generation("flush-asgi", "sid")
+        data = {"session_id": f"flush-asgi-{time.monotonic()}", "message": "こんにちは"}
+        task = asyncio.ensure_future(asgi_app.run_chat_turn("sid", data, generation, time.time()))
+        await asyncio.sleep(cancel_after)
+        generation.cancel("barge_in")
+        await asyncio.wait_for(task, 5)
+
+    asyncio.run(scenario())
+    return events
+
+
+class NoTimerFlushTimer(asgi_app.StreamFlushTimer):
+    """タイマーでは送らない (中断時の送信だけを見るため)"""
+
+    def reschedule(self):
+        self.cancel()
+
+
+def test_asgi_timer_flushes_buffered_text_while_stream_is_stalled(monkeypatch):
+    events = []
+
+    async def emit(event, payload=None, to=None, **kwargs):
+        events.append((event, payload))
+
+    monkeypatch.setattr(asgi_app.sio, "emit", emit)
+
+    async def scenario():
+        turn = ChatTurn()
+        turn.stream_coalescer = StreamCoalescer(interval=0.05, max_bytes=1000)
+        timer = asgi_app.StreamFlushTimer(turn, "sid")
+        async with timer.lock:
+            await asgi_app.send_turn_events(turn, turn.feed_chunk(text_chunk(TAG + REPLY[:3])), "sid")
+            await asgi_app.send_turn_events(turn, turn.feed_chunk(text_chunk(REPLY[3:])), "sid")
+            timer.reschedule()
+        assert streamed_text(events) == REPLY[:3]
+        await asyncio.sleep(0.3)
+        timer.cancel()
+
+    asyncio.run(scenario())
+    assert streamed_text(events) == REPLY
+
+
+def test_asgi_cancel_sends_buffered_text_before_stream_end(monkeypatch):
+    events = run_asgi_turn(monkeypatch, [TAG, REPLY[:3], REPLY[3:8]], cancel_after=0.2)
+    end = stream_end(events)
+    assert end["interrupted"]
+    assert streamed_text(events) == end["text"] == REPLY[:8]
+    assert [event for event, _ in events].index("bot_stream_end") == len(events) - 1
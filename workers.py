@@ -0,0 +1,89 @@
+"""複数ワーカー構成での起動
+
+ASGI版サーバー (asgi_app.py) を --workers 個のプロセスで起動する。ワーカーはそれぞれ別のポートで待ち受け、
+  - セッションと会話履歴は共有の保存先 (SESSION_STORE, 既定は同じマシンで共有する sqlite)
+  - 他のワーカーに接続しているクライアントへの送信はメッセージキュー (SOCKETIO_MESSAGE_QUEUE)
+で共有する。LLMの同時生成数はワーカーごとに asgi_app.MAX_CONCURRENT_GENERATIONS 件まで。
+メッセージキューが local:// の場合は、このプロセスが簡易ブローカーを兼ねる。
+
+Socket.IO の long-polling では同じクライアントの要求が同じワーカーに届く必要がある (スティッキーセッション)。
+前段のロードバランサーでクライアントごとに振り分けること (README の nginx の設定例を参照)。
+
+使い方:
+    python workers.py --workers 4 --base-port 5001
+    python workers.py --workers 2 --message-queue redis://localhost:6379/0 --session-store redis://localhost:6379/0
+"""
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+
+from message_queue import LocalQueueBroker, parse_local_url
+
+logger = logging.getLogger("emotion_chat.workers")
+
+# asgi_app.py のあるディレクトリ。ワーカーはここで起動する (index.html や CSV などの相対パスもここが基準)
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def worker_env(session_store, message_queue):
+    env = dict(os.environ)
+    env["SESSION_STORE"] = session_store
+    env["SOCKETIO_MESSAGE_QUEUE"] = message_queue
+    return env
+
+
+def start_workers(count, host, base_port, session_store, message_queue):
+    """ワーカーを起動し、Popen のリストを返す"""
+    env = worker_env(session_store, message_queue)
+    workers = []
+    for i in range(count):
+        port = base_port + i
+        command = [sys.executable, "-m", "uvicorn", "asgi_app:asgi_app", "--host", host, "--port", str(port),
+                   "--log-level", "warning"]
+        workers.append(subprocess.Popen(command, env=env, cwd=APP_DIR))
+        logger.info("ワーカー %d を http://%s:%d で起動しました (pid=%d)", i, host, port, workers[-1].pid)
+    return workers
+
+
+def stop_workers(workers):
+    for worker in workers:
+        if worker.poll() is None:
+            worker.terminate()
+    for worker in workers:
+        try:
+            worker.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="ワーカープロセス数")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=5001, help="最初のワーカーのポート (以降は +1 ずつ)")
+    parser.add_argument("--session-store", default="sqlite", help="sqlite または redis://...")
+    parser.add_argument("--message-queue", default="local://127.0.0.1:6100", help="local://host:port または redis://...")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.session_store == "memory":
+        parser.error("複数ワーカーではセッションを共有できる保存先 (sqlite / redis://...) が必要です")
+    if args.message_queue.startswith("local://"):
+        LocalQueueBroker(parse_local_url(args.message_queue)).start()
+
+    workers = start_workers(args.workers, args.host, args.base_port, args.session_store, args.message_queue)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(workers)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,9 @@
+"""WSGIサーバー (gunicorn など) から起動するときの入口
+
+    gunicorn -k gevent -w 1 wsgi:app
+
+python app.py と同じく、要求を受け付ける前に表情の LUT とモデルのウォームアップを1回だけ済ませる。
+"""
+from app import app, prepare_server, socketio  # noqa: F401
+
+prepare_server()